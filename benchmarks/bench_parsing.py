@@ -0,0 +1,219 @@
+"""Benchmarks for the gdb and eu-unstrip output parsers.
+
+Generates synthetic tool output at realistic scale and reports throughput and
+peak memory per parser. Results can be stored as JSON and compared against a
+previous run to catch regressions, e.g. regexes that started to backtrack:
+
+    poetry run python benchmarks/bench_parsing.py --json baseline.json
+    poetry run python benchmarks/bench_parsing.py --compare baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from coredump_uploader import (
+    BacktraceParser,
+    get_frame,
+    get_images,
+    get_stacktrace,
+    get_threads,
+    iter_gdb_sections,
+)
+
+HEADER = """GNU gdb (Ubuntu 8.1-0ubuntu3.2) 8.1.0.20180409-git
+Reading symbols from a.out...done.
+Core was generated by `./a.out'.
+Program terminated with signal SIGSEGV, Segmentation fault.
+#0  0x000055931ccfe60a in crashing_function () at test.c:3
+3	  *bad_pointer = 1;
+[Current thread is 1 (LWP 1000)]
+"""
+
+FRAMES = [
+    "#%d  0x%016x in std::vector<int, std::allocator<int> >::push_back(int const&) "
+    "(this=0x7ffc2e0, __x=@0x7ffc2dc: 1) at /usr/include/c++/7/bits/stl_vector.h:%d",
+    "#%d  0x%016x in pthread_cond_wait@@GLIBC_2.3.2 () "
+    "from /lib/x86_64-linux-gnu/libpthread.so.%d",
+    "#%d  0x%016x in event_loop_run (loop=0x55d1c0) at src/event/loop.c:%d",
+    "#%d  0x%016x in ?? () from /usr/lib/libfoo.so.%d",
+]
+
+
+def frame_line(thread, depth):
+    template = FRAMES[(thread + depth) % len(FRAMES)]
+    return template % (depth, 0x7F0000000000 + thread * 0x1000 + depth * 8, depth)
+
+
+def gdb_bt_output(threads, frames, pool=False):
+    """Output of `thread apply all bt` for the given number of threads.
+
+    With pool, all threads wait at the same place like the workers of a pool.
+    """
+    lines = [HEADER, "(gdb) \n"]
+    for thread in range(threads, 0, -1):
+        lines.append(
+            "Thread %d (Thread 0x7f%010x (LWP %d)):\n" % (thread, thread, 1000 + thread)
+        )
+        for depth in range(frames):
+            lines.append(frame_line(0 if pool else thread, depth) + "\n")
+        lines.append("\n")
+    lines.append("(gdb) quit\n")
+    return "".join(lines)
+
+
+def gdb_batched_output(threads, frames):
+    """Output of a batched gdb session with section markers"""
+    marker = "(gdb) \n----- coredump-uploader: %s -----\n(gdb) "
+    return "".join(
+        [
+            HEADER,
+            marker % "backtrace",
+            gdb_bt_output(threads, frames)[len(HEADER) :],
+            marker % "registers",
+            "".join("r%d  0x%x\t%d\n" % (i, i, i) for i in range(16)),
+            marker % "version",
+            "GNU gdb (Ubuntu 8.1-0ubuntu3.2) 8.1.0.20180409-git\n(gdb) quit\n",
+        ]
+    )
+
+
+def eu_unstrip_output(modules):
+    lines = []
+    for i in range(modules):
+        address = 0x7F0000000000 + i * 0x200000
+        lines.append(
+            "0x%x+0x%x %040x@0x%x /usr/lib/x86_64-linux-gnu/libmodule%d.so.1 "
+            "/usr/lib/debug/.build-id/%02x/%038x.debug libmodule%d.so.1"
+            % (address, 0x1F0000, i * 7919, address + 0x284, i, i % 256, i, i)
+        )
+    return "\n".join(lines) + "\n"
+
+
+def pathological_frames(count, length):
+    """Frame lines with long, unbalanced argument lists"""
+    return "".join(
+        "#%d  0x%016x in f%s\n" % (i, i, " (x" * length) for i in range(count)
+    )
+
+
+def read_gdb_output(output):
+    """Parses batched gdb output line by line, like read_gdb"""
+    parser = BacktraceParser(True)
+    for section, line in iter_gdb_sections(output.splitlines(True)):
+        if section in ("header", "backtrace"):
+            parser.feed(line)
+    return parser.get_threads()
+
+
+def parse_frames(output):
+    return [get_frame(line) for line in output.splitlines()]
+
+
+def scenarios(quick):
+    thread_counts = [(1, 10), (100, 50), (1000, 100)]
+    module_counts = [50, 500, 2000]
+    if not quick:
+        thread_counts += [(5000, 100), (200, 500)]
+    for threads, frames in thread_counts:
+        name = "%dx%d" % (threads, frames)
+        items = threads * frames
+        yield "get_threads", name, get_threads, gdb_bt_output(threads, frames), items
+        output = gdb_batched_output(threads, frames)
+        yield "read_gdb", name, read_gdb_output, output, items
+    output = gdb_bt_output(1000, 100, pool=True)
+    yield "get_threads", "pool1000x100", get_threads, output, 100000
+    for frames in (10, 500):
+        output = gdb_bt_output(1, frames)
+        yield "get_stacktrace", "%d" % frames, get_stacktrace, output, frames
+        yield "parse_frames", "%d" % frames, parse_frames, output, frames
+    output = pathological_frames(10, 500)
+    yield "parse_frames", "pathological", parse_frames, output, 10
+    for modules in module_counts:
+        output = eu_unstrip_output(modules)
+        yield "get_images", "%d" % modules, get_images, output, modules
+
+
+def measure(function, output, repeat):
+    """Returns the best time of repeat runs and the peak memory of one run"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(output)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function(output)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="skip the largest inputs")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("--json", help="writes the results to this file")
+    parser.add_argument("--compare", help="compares with results of a previous run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed throughput loss when comparing (default: 0.25)",
+    )
+    args = parser.parse_args(argv)
+
+    # get_threads reports the number of threads found, keep that out of the table
+    stdout = sys.stdout
+
+    results = {}
+    print(
+        "%-18s %-12s %10s %14s %14s %12s"
+        % ("parser", "input", "MB", "MB/s", "items/s", "peak MB")
+    )
+    for name, case, function, output, items in scenarios(args.quick):
+        sys.stdout = open(os.devnull, "w")
+        try:
+            elapsed, peak = measure(function, output, args.repeat)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        size = len(output) / 1e6
+        key = "%s/%s" % (name, case)
+        results[key] = {
+            "seconds": elapsed,
+            "mb_per_second": size / elapsed,
+            "items_per_second": items / elapsed,
+            "peak_mb": peak / 1e6,
+        }
+        print(
+            "%-18s %-12s %10.2f %14.2f %14.0f %12.2f"
+            % (name, case, size, size / elapsed, items / elapsed, peak / 1e6)
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for key, result in sorted(results.items()):
+            if key not in baseline:
+                continue
+            ratio = result["mb_per_second"] / baseline[key]["mb_per_second"]
+            if ratio < 1 - args.tolerance:
+                regressions.append(
+                    "%s: %.0f%% of baseline throughput" % (key, ratio * 100)
+                )
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
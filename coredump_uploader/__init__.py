@@ -1,6 +1,8 @@
 import re
+import json
 import sentry_sdk
 import binascii
+import hashlib
 import uuid
 import subprocess
 import sys
@@ -9,9 +11,39 @@ import click
 import time
 import datetime
 import signal
+import socket
 import logging
+import threading
+from collections import OrderedDict, deque
 from watchdog.observers import Observer
-from watchdog.events import RegexMatchingEventHandler
+from watchdog.events import FileSystemEventHandler
+
+from coredump_uploader import journal, metrics, retention, sampling, tracing
+from coredump_uploader.elf import (
+    AT_ENTRY,
+    CoreFile,
+    ElfError,
+    get_build_id,
+    get_executable,
+    get_modules,
+)
+from coredump_uploader.envelope import (
+    AttachmentTooLarge,
+    CoreAttachment,
+    build_envelope,
+    build_event_envelope,
+    dump_event,
+    send_envelope,
+    zstandard,
+)
+from coredump_uploader.gdbmi import GdbMiError, GdbMiTimeout, GdbSession, GdbSessionPool
+from coredump_uploader.limits import ChildLimits, ChildTimeout
+from coredump_uploader.transport import UploaderTransport
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 if sys.version_info >= (3, 0):
     def decode(s):
@@ -20,7 +52,9 @@ else:
     def decode(s):
         return s
 
-class Frame:
+class Frame(object):
+    __slots__ = ("instruction_addr", "function", "filename", "lineno", "package")
+
     def __init__(
         self,
         instruction_addr=None,
@@ -36,10 +70,26 @@ class Frame:
         self.package = package
 
     def to_json(self):
-        return self.__dict__
+        return {
+            "instruction_addr": self.instruction_addr,
+            "function": self.function,
+            "filename": self.filename,
+            "lineno": self.lineno,
+            "package": self.package,
+        }
+
 
+class Image(object):
+    __slots__ = (
+        "type",
+        "image_addr",
+        "image_size",
+        "debug_id",
+        "code_id",
+        "code_file",
+        "arch",
+    )
 
-class Image:
     def __init__(
         self,
         type="",
@@ -59,13 +109,24 @@ class Image:
         self.arch = arch
 
     def to_json(self):
-        return self.__dict__
+        return {
+            "type": self.type,
+            "image_addr": self.image_addr,
+            "image_size": self.image_size,
+            "debug_id": self.debug_id,
+            "code_id": self.code_id,
+            "code_file": self.code_file,
+            "arch": self.arch,
+        }
+
 
+class Stacktrace(object):
+    __slots__ = ("frames", "registers", "frames_omitted")
 
-class Stacktrace:
     def __init__(self):
         self.frames = []
         self.registers = {}
+        self.frames_omitted = None
 
     def append_frame(self, frame=None):
         self.frames.append(frame)
@@ -77,15 +138,19 @@ class Stacktrace:
         self.frames.reverse()
 
     def to_json(self):
-        for i, frame in enumerate(self.frames):
-            try:
-                self.frames[i] = frame.to_json()
-            except:
-                continue
-        return self.__dict__
+        """Returns a new dict, the frames are left as they are"""
+        data = {
+            "frames": [frame.to_json() for frame in self.frames],
+            "registers": dict(self.registers),
+        }
+        if self.frames_omitted is not None:
+            data["frames_omitted"] = list(self.frames_omitted)
+        return data
 
 
-class Thread:
+class Thread(object):
+    __slots__ = ("id", "name", "crashed", "stacktrace")
+
     def __init__(self, id="", name=None, crashed=False, stacktrace=None):
         self.id = id
         self.name = name
@@ -96,87 +161,59 @@ class Thread:
         return self.stacktrace
 
     def to_json(self):
-        if self.stacktrace is not None and isinstance(self.stacktrace, Stacktrace):
-            self.stacktrace = self.stacktrace.to_json()
-        return self.__dict__
+        stacktrace = self.stacktrace
+        if stacktrace is not None:
+            stacktrace = stacktrace.to_json()
+        return {
+            "id": self.id,
+            "name": self.name,
+            "crashed": self.crashed,
+            "stacktrace": stacktrace,
+        }
+
 
+class CrashedThread(object):
+    __slots__ = ("id", "name", "crashed")
 
-class CrashedThread:
     def __init__(self, id="", name=None, crashed=False):
         self.id = id
         self.name = name
         self.crashed = crashed
 
     def to_json(self):
-        return self.__dict__
+        return {"id": self.id, "name": self.name, "crashed": self.crashed}
 
 
+# Start of a frame line of `bt`, the rest is split by get_frame. A single
+# regex for the whole line backtracks quadratically on unbalanced arguments.
 _frame_re = re.compile(
-    r"""(?xim)
-    ^
-    # frame number
+    r"""(?xi)
     \#\d+\s+
     # instruction address (missing for first frame)
     (?:
         (?P<instruction_addr>0x[0-9a-f]+)
         \sin\s
     )?
-    # function name (?? if unknown)
-    (?P<function>.*)
-    \s
-    # arguments, ignored
-    \([^)]*\)
-
-    \s*
-    (?:
-        # package name, without debug info
-        from\s
-        (?P<package>[^ ]+)
-    |
-        # file name and line number
-        at\s
-        (?P<filename>[^ ]+)
-        :
-        (?P<lineno>\d+)
-    )?
-    $
     """
 )
 
-_image_re = re.compile(
-    r"""(?x)
-
-    # address of image
-    (?P<image_addr>
-        0[xX][a-fA-F0-9]+
-    )*
+_lineno_re = re.compile(r"[^ ]+:\d+$")
 
-    # size of image
+# A line of `eu-unstrip -n`: the address and size of the image, the build-id
+# and where it's loaded, or -, then the file, the debug file and the module name
+_image_re = re.compile(
+    r"""(?xi)
+    (?P<image_addr>0x[0-9a-f]+)
     \+
-    (?P<image_size>
-        0[xX][a-fA-F0-9]+
-    )*
-
-    # code ID
-    \s
-    (?P<code_id>
-        [0-9A-Fa-f]+
-    )*
-
-    # other address of image?
-    @
+    (?P<image_size>0x[0-9a-f]+)
+    \s+
     (?:
-        0[xX][0-9A-F-a-f]+
-    )*
-
-    #Code File
-    (\s|\s\.\s\-\s)?
-    (\.\s)?
-    (-\s)*
-    \.?
-    (?P<code_file>
-        [\/|\/][\w|\S]+|\S+\.\S+|[a-zA-Z]*
-    )?
+        (?P<code_id>[0-9a-f]+)@0x[0-9a-f]+
+    |
+        -
+    )
+    (?:\s+(?P<files>.*))?
+    $
     """
 )
 
@@ -198,9 +235,14 @@ _thread_id_re = re.compile(
 
 _exit_signal_re = re.compile(r"(?i)terminated with signal (?P<type>[a-z0-9]+),")
 
-_thread_re = re.compile(
-    r"(?x)^Thread .*? (\n\n|.\(gdb\)\squit)", flags=re.DOTALL | re.MULTILINE
-)
+_mi_thread_name_re = re.compile(r"\((?P<thread_name>[^()]*)\)$")
+
+_crashed_thread_id_re = re.compile(r"(?i)current thread is (?P<thread_id>\d+)")
+
+_gdb_section_re = re.compile(r"^----- coredump-uploader: (?P<section>[a-z]+) -----$")
+
+# Sections of the batched gdb session, in the order they are requested
+_gdb_sections = ("backtrace", "registers", "version")
 
 
 def code_id_to_debug_id(code_id):
@@ -208,111 +250,765 @@ def code_id_to_debug_id(code_id):
     return str(uuid.UUID(bytes_le=binascii.unhexlify(code_id)[:16]))
 
 
-def get_frame(temp):
-    """Returns a Frame"""
-    frame = Frame()
-    if temp.group("instruction_addr") is not None:
-        frame.instruction_addr = temp.group("instruction_addr")
+def gdb_section_command(section):
+    """Returns the gdb command that prints the marker of a section"""
+    return "echo \\n----- coredump-uploader: %s -----\\n" % section
+
 
-    if temp.group("function") not in (None, "??"):
-        frame.function = temp.group("function")
+def get_gdb_commands(all_threads):
+    """Returns the gdb commands to fetch everything we need in a single session"""
+    commands = {
+        "backtrace": "thread apply all bt" if all_threads else "bt",
+        "registers": "info registers",
+        "version": "show version",
+    }
+    lines = []
+    for section in _gdb_sections:
+        lines.append(gdb_section_command(section))
+        lines.append(commands[section])
+    return "\n".join(lines) + "\n"
 
-    if temp.group("lineno") is not None:
-        frame.lineno = int(temp.group("lineno"))
 
-    if temp.group("filename") is not None:
-        frame.filename = temp.group("filename")
+def get_gdb_arguments(
+    gdb_path, path_to_executable, path_to_core=None, index_cache=None
+):
+    """Returns the command line for gdb.
+
+    With an index cache directory gdb stores the symbol index it builds from
+    the DWARF of the executable there, named by build-id, and reuses it for the
+    next cores until the executable changes.
+    """
+    arguments = [gdb_path]
+    if index_cache is not None:
+        arguments += [
+            "-iex",
+            "set index-cache directory %s" % index_cache,
+            "-iex",
+            "set index-cache on",
+        ]
+    if path_to_core is not None:
+        arguments += ["-c", path_to_core]
+    return arguments + [path_to_executable]
+
+
+def get_index_path(index_cache, build_id):
+    return os.path.join(index_cache, "%s.gdb-index" % build_id)
+
+
+def touch_index(index_cache, build_id):
+    """Marks the cached index of an executable as used.
+
+    The access time isn't reliable on noatime and relatime mounts, so the
+    modification time records the last use.
+    """
+    try:
+        os.utime(get_index_path(index_cache, build_id), None)
+    except OSError:
+        pass
+
+
+def prune_index_cache(index_cache, max_age, now=None):
+    """Removes the cached indexes that weren't used for max_age seconds"""
+    if now is None:
+        now = time.time()
+    for name in os.listdir(index_cache):
+        path = os.path.join(index_cache, name)
+        if not name.endswith(".gdb-index"):
+            continue
+        try:
+            if os.stat(path).st_mtime < now - max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
 
-    if temp.group("package") is not None:
-        frame.package = temp.group("package")
+def iter_gdb_sections(lines):
+    """Yields (section, line) for the output lines of a batched gdb session.
 
+    Everything printed before the first marker (banner, core summary, ...) ends
+    up in the "header" section. The gdb prompts around the markers are dropped
+    and every section ends with a blank line, so the last thread block is
+    terminated just like the ones before it.
+    """
+    section = "header"
+    prompt = None
+    for line in lines:
+        marker = _gdb_section_re.match(line.rstrip("\r\n"))
+        if marker is not None:
+            # the prompt right before a marker belongs to the echo command
+            prompt = None
+            yield section, "\n"
+            section = marker.group("section")
+            continue
+        if prompt is not None:
+            yield section, prompt
+            prompt = None
+        if line.startswith("(gdb) "):
+            if not line[len("(gdb) ") :].strip():
+                prompt = line
+                continue
+            # the prompt after a marker precedes the output of the command
+            line = line[len("(gdb) ") :]
+        yield section, line
+    if prompt is not None:
+        yield section, prompt
+    yield section, "\n"
+
+
+def split_frame_tail(text):
+    """Splits `... at file:line` or `... from package` off the end of a frame"""
+    head, _, last = text.rpartition(" ")
+    rest, _, keyword = head.rstrip().rpartition(" ")
+    if keyword == "at" and _lineno_re.match(last):
+        filename, _, lineno = last.rpartition(":")
+        return rest, None, filename, lineno
+    if keyword == "from" and last:
+        return rest, last, None, None
+    return None
+
+
+def split_frame_function(text):
+    """Returns the function of `function (arguments)`, None if it isn't that"""
+    text = text.rstrip()
+    if not text.endswith(")"):
+        return None
+    start = text.rfind(" (", 0, -1)
+    # The arguments are the last parenthesis, without parentheses inside
+    if start == -1 or ")" in text[start + 2 : -1]:
+        return None
+    return text[:start]
+
+
+def get_frame(line):
+    """Returns a Frame for a line of `bt`, None if it isn't a frame.
+
+    The line is split from both ends, which takes linear time.
+    """
+    line = line.rstrip("\r\n")
+    match = _frame_re.match(line)
+    if match is None:
+        return None
+    text = line[match.end() :]
+
+    package = filename = lineno = None
+    function = split_frame_function(text)
+    if function is None:
+        tail = split_frame_tail(text)
+        if tail is None:
+            return None
+        function = split_frame_function(tail[0])
+        if function is None:
+            return None
+        _, package, filename, lineno = tail
+
+    frame = Frame()
+    frame.instruction_addr = match.group("instruction_addr")
+    if function != "??":
+        frame.function = function
+    if lineno is not None:
+        frame.lineno = int(lineno)
+    frame.filename = filename
+    frame.package = package
     return frame
 
 
-def get_image(temp):
-    """Returns an Image"""
-    if temp is None:
+def get_mi_frame(record):
+    """Returns a Frame for a frame record of GDB/MI"""
+    frame = Frame()
+    frame.instruction_addr = record.get("addr")
+    if record.get("func") not in (None, "??"):
+        frame.function = record["func"]
+    if record.get("line") is not None:
+        frame.lineno = int(record["line"])
+    if record.get("file") is not None:
+        frame.filename = record["file"]
+    if record.get("from") is not None:
+        frame.package = record["from"]
+    return frame
+
+
+def get_mi_thread_name(target_id):
+    """Returns "LWP 1234" for "Thread 0x7f3c2d8f0700 (LWP 1234)" like bt does"""
+    thread_name = _mi_thread_name_re.search(target_id)
+    if thread_name is not None:
+        return thread_name.group("thread_name")
+    return target_id
+
+
+def get_image(line):
+    """Returns an Image for a line of eu-unstrip, None for images without build-id"""
+    match = _image_re.match(line.strip())
+    if match is None or match.group("code_id") is None:
         return None
 
+    # eu-unstrip prints - for files it didn't find and . for the vdso
+    files = (match.group("files") or "").split()
+    code_file = None
+    if files and files[0] not in ("-", "."):
+        code_file = files[0]
+    elif len(files) > 2:
+        code_file = files[-1]
+
     return Image(
         type="elf",
-        image_addr=temp.group("image_addr"),
-        image_size=int(temp.group("image_size"), 16),
-        code_id=temp.group("code_id"),
-        debug_id=code_id_to_debug_id(temp.group("code_id")),
-        code_file=temp.group("code_file"),
+        image_addr=match.group("image_addr"),
+        image_size=int(match.group("image_size"), 16),
+        code_id=match.group("code_id"),
+        debug_id=code_id_to_debug_id(match.group("code_id")),
+        code_file=code_file,
     )
 
 
-def get_threads(gdb_output):
-    """Returns a list with all threads and backtraces"""
-    thread_list = []
-    counter_threads = 0
-    stacktrace_temp = None
-    crashed_thread_id = re.search(
-        r"(?i)current thread is (?P<thread_id>\d+)", gdb_output,
-    )
-    if crashed_thread_id:
-        crashed_thread_id = crashed_thread_id.group("thread_id")
-    else:
-        crashed_thread_id = "1"
-    # Get the exit Signal from the gdb-output
-    exit_signal = re.search(_exit_signal_re, gdb_output)
-    if exit_signal:
-        exit_signal = exit_signal.group("type")
-    else:
-        exit_signal = "Core"
-    # Searches for threads in gdb_output
-    for temp in re.finditer(_thread_re, gdb_output):
-        thread_backtrace = str(temp.group())
+def get_images(eu_unstrip_output):
+    """Returns the images of the eu-unstrip output"""
+    images = []
+    for line in eu_unstrip_output.splitlines():
+        image = get_image(line)
+        if image is not None:
+            images.append(image)
+    return images
+
+
+def get_native_images(path_to_core):
+    """Returns the images of the core without eu-unstrip.
+
+    Returns None if the core doesn't list its mapped files.
+    """
+    try:
+        with CoreFile.open(path_to_core) as core:
+            modules = get_modules(core)
+    except (IOError, OSError, ElfError):
+        return None
+    if not modules:
+        return None
+
+    return [
+        Image(
+            type="elf",
+            image_addr="0x%x" % module.start,
+            image_size=module.end - module.start,
+            code_id=module.build_id,
+            debug_id=code_id_to_debug_id(module.build_id),
+            code_file=module.path,
+        )
+        for module in modules
+    ]
+
+
+class TruncatedFrames(object):
+    """Collects the frames of a backtrace, innermost first.
+
+    With max_frames, only the innermost and outermost frames are kept and the
+    number of frames in between is counted.
+    """
+
+    def __init__(self, max_frames=None):
+        self.head = []
+        self.max_head = None
+        self.tail = None
+        self.omitted = 0
+        if max_frames is not None:
+            self.max_head = max_frames - max_frames // 2
+            self.tail = deque(maxlen=max_frames // 2)
+
+    def append(self, frame):
+        if self.max_head is None or len(self.head) < self.max_head:
+            self.head.append(frame)
+            return
+        if len(self.tail) == self.tail.maxlen:
+            self.omitted += 1
+        if self.tail.maxlen:
+            self.tail.append(frame)
+
+    def to_stacktrace(self):
+        """Returns the Stacktrace, outermost frame first"""
         stacktrace = Stacktrace()
-        # Gets the Thread ID
-        thread_id = re.search(_thread_id_re, thread_backtrace,)
-        if thread_id is None:
-            continue
+        stacktrace.frames = self.head + list(self.tail or ())
+        stacktrace.reverse_list()
+        if self.omitted:
+            stacktrace.frames_omitted = [
+                len(self.tail),
+                len(self.tail) + self.omitted,
+            ]
+        return stacktrace
+
+
+def get_stack_key(stacktrace):
+    """Returns a key that is equal for threads with identical stacks"""
+    return tuple(
+        (frame.instruction_addr, frame.function, frame.filename, frame.lineno)
+        for frame in stacktrace.frames
+    )
+
+
+_missing = object()
+
+
+class BacktraceParser(object):
+    """Parses the backtrace output of gdb line by line.
+
+    Only the parsed frames are kept, so memory doesn't grow with the size of the
+    raw gdb output. With all_threads, frames are collected per `Thread` block of
+    `thread apply all bt`, otherwise all frames belong to a single stacktrace.
+
+    max_frames limits the frames of every stacktrace. max_threads limits the
+    number of threads, after threads with identical stacks have been merged into
+    one. The crashed thread is always kept.
+
+    Threads often share frames, e.g. the workers of a pool waiting at the same
+    place. Frame lines are parsed once and the Frame is shared, and the strings
+    of the frames are interned, so each package or function is stored once per
+    event.
+    """
+
+    # Distinct frame lines remembered, beyond that new lines are just parsed.
+    # The cache is dropped if less than a quarter of the first lines were hits.
+    max_cached_frames = 100000
+    cache_check_size = 4096
+
+    def __init__(self, all_threads, max_threads=None, max_frames=None):
+        self.all_threads = all_threads
+        self.max_threads = max_threads
+        self.max_frames = max_frames
+        self.threads_omitted = 0
+        # gdb was killed before it printed the whole backtrace
+        self.timed_out = False
+        self.crashed_thread_id = None
+        self.exit_signal = None
+        self.has_first_frame = False
+        self.frames = TruncatedFrames(max_frames)
+        self.thread_list = []
+        self.crashed_stacktrace = None
+        self.first_stacktrace = None
+        self.thread = None
+        self.frame_cache = {}
+        self.cache_hits = 0
+        self.strings = {}
+
+    def feed(self, line):
+        """Parses the next line of the gdb output"""
+        self.feed_header(line)
+        if "#0" in line:
+            self.has_first_frame = True
+
+        if not self.all_threads:
+            self.add_frame(self.frames, line)
+        elif line.startswith("Thread "):
+            self.end_thread()
+            # Gets the Thread ID
+            thread_id = _thread_id_re.search(line)
+            if thread_id is not None:
+                self.start_thread(
+                    thread_id.group("thread_id"), thread_id.group("thread_name")
+                )
+        elif self.thread is not None:
+            # Threads are separated by a blank line or end at the next prompt
+            if not line.strip() or line.startswith("(gdb)"):
+                self.end_thread()
+            else:
+                self.add_frame(self.thread[2], line)
+
+    def feed_header(self, line):
+        """Looks for the crashed thread and the exit signal in a line"""
+        if self.crashed_thread_id is None:
+            crashed_thread_id = _crashed_thread_id_re.search(line)
+            if crashed_thread_id:
+                self.crashed_thread_id = crashed_thread_id.group("thread_id")
+        # Get the exit Signal from the gdb-output
+        if self.exit_signal is None:
+            exit_signal = _exit_signal_re.search(line)
+            if exit_signal:
+                self.exit_signal = exit_signal.group("type")
+
+    def start_thread(self, thread_id, thread_name):
+        self.end_thread()
+        self.thread = (thread_id, thread_name, TruncatedFrames(self.max_frames))
+
+    def append_frame(self, frame):
+        """Adds a frame that was parsed elsewhere to the current stacktrace"""
+        self.has_first_frame = True
+        self.intern_frame(frame)
+        if self.thread is not None:
+            self.thread[2].append(frame)
         else:
-            thread_name = thread_id.group("thread_name")
-            thread_id = thread_id.group("thread_id")
-        # Gets each frame from the Thread
-        for match in re.finditer(_frame_re, thread_backtrace):
-            frame = get_frame(match)
+            self.frames.append(frame)
+
+    def add_frame(self, frames, line):
+        frame_cache = self.frame_cache
+        frame = _missing
+        if frame_cache is not None:
+            frame = frame_cache.get(line, _missing)
+        if frame is _missing:
+            frame = get_frame(line)
             if frame is not None:
-                stacktrace.append_frame(frame)
-        stacktrace.reverse_list()
-        crashed = thread_id == crashed_thread_id
+                self.intern_frame(frame)
+            if frame_cache is not None:
+                self.cache_frame(line, frame)
+        else:
+            self.cache_hits += 1
+        if frame is not None:
+            frames.append(frame)
+
+    def cache_frame(self, line, frame):
+        size = len(self.frame_cache)
+        if size == self.cache_check_size and self.cache_hits * 4 < size:
+            # Threads hardly share frames, caching them only costs time
+            self.frame_cache = None
+        elif size < self.max_cached_frames:
+            self.frame_cache[line] = frame
+
+    def intern_frame(self, frame):
+        strings = self.strings
+        if frame.function is not None:
+            frame.function = strings.setdefault(frame.function, frame.function)
+        if frame.filename is not None:
+            frame.filename = strings.setdefault(frame.filename, frame.filename)
+        if frame.package is not None:
+            frame.package = strings.setdefault(frame.package, frame.package)
+
+    def end_thread(self):
+        if self.thread is None:
+            return
+        thread_id, thread_name, frames = self.thread
+        self.thread = None
+        stacktrace = frames.to_stacktrace()
+        crashed = thread_id == (self.crashed_thread_id or "1")
         # Appends a Thread to the thread_list
         if crashed:
-            thread_list.append(CrashedThread(thread_id, thread_name, crashed))
-            stacktrace_temp = stacktrace
+            self.thread_list.append(CrashedThread(thread_id, thread_name, crashed))
+            self.crashed_stacktrace = stacktrace
         else:
-            thread_list.append(Thread(thread_id, thread_name, crashed, stacktrace))
-        if not stacktrace_temp:
-            stacktrace_temp = stacktrace
-        counter_threads += 1
+            self.thread_list.append(Thread(thread_id, thread_name, crashed, stacktrace))
+        if self.first_stacktrace is None:
+            self.first_stacktrace = stacktrace
+
+    def limit_threads(self, thread_list):
+        """Merges threads with identical stacks and drops threads over the limit"""
+        merged = OrderedDict()
+        unique_threads = []
+        for thread in thread_list:
+            if thread.crashed:
+                unique_threads.append(thread)
+                continue
+            key = get_stack_key(thread.stacktrace)
+            if key in merged:
+                merged[key][1] += 1
+            else:
+                merged[key] = [thread, 0]
+                unique_threads.append(thread)
+        for thread, count in merged.values():
+            if count:
+                thread.name = "%s (+%d threads with the same stack)" % (
+                    thread.name,
+                    count,
+                )
 
-    thread_list.reverse()
-    print("Threads found: " + str(counter_threads))
-    return thread_list, exit_signal, stacktrace_temp, crashed_thread_id
+        # One slot is reserved for the crashed thread
+        limited_threads = []
+        other_threads = 0
+        for thread in unique_threads:
+            if thread.crashed:
+                limited_threads.append(thread)
+            elif other_threads < self.max_threads - 1:
+                limited_threads.append(thread)
+                other_threads += 1
+            else:
+                self.threads_omitted += 1
+        return limited_threads
+
+    def get_threads(self):
+        """Returns the result like get_threads"""
+        self.end_thread()
+        thread_list = self.thread_list[::-1]
+        print("Threads found: " + str(len(thread_list)))
+        if self.max_threads is not None:
+            thread_list = self.limit_threads(thread_list)
+        return (
+            thread_list,
+            self.exit_signal or "Core",
+            self.crashed_stacktrace or self.first_stacktrace,
+            self.crashed_thread_id or "1",
+        )
+
+    def get_stacktrace(self):
+        """Returns the result like get_stacktrace"""
+        if not self.has_first_frame and not self.timed_out:
+            error("gdb output error")
+        return self.frames.to_stacktrace(), self.exit_signal or "Core"
+
+
+def get_threads(gdb_output):
+    """Returns a list with all threads and backtraces"""
+    parser = BacktraceParser(all_threads=True)
+    for line in gdb_output.splitlines(True):
+        parser.feed(line)
+    return parser.get_threads()
 
 
 def get_stacktrace(gdb_output):
     """Returns the stacktrace and the exit signal """
-    if not "#0" in gdb_output:
-        error("gdb output error")
+    parser = BacktraceParser(all_threads=False)
+    for line in gdb_output.splitlines(True):
+        parser.feed(line)
+    return parser.get_stacktrace()
+
+
+def get_registers(gdb_output, stacktrace):
+    """Returns the stacktrace with the registers, the gdb-version and the message."""
+    gdb_version = re.search(r"GNU gdb \(.*?\) (?P<gdb_version>.*)", gdb_output)
+    if gdb_version:
+        gdb_version = gdb_version.group("gdb_version")
+
+    message = re.search(r"(?P<message>Core was generated .*\n.*)", gdb_output)
+    if message:
+        message = message.group("message")
+
+    for match in re.finditer(_register_re, gdb_output):
+        if match is not None:
+            stacktrace.ad_register(
+                match.group("register_name"), match.group("register_value")
+            )
+    return (
+        stacktrace,
+        gdb_version,
+        message,
+    )
+
+
+def get_fingerprint(build_id, stacktrace, exit_signal):
+    """Returns a fingerprint of a crash that doesn't depend on ASLR"""
+    fingerprint = hashlib.sha1()
+    parts = [build_id or "", exit_signal or ""]
+    for frame in stacktrace.frames:
+        if frame.function is not None:
+            parts.append(
+                "%s %s %s" % (frame.function, frame.package or "", frame.filename or "")
+            )
+        else:
+            parts.append(frame.instruction_addr or "")
+    fingerprint.update("\n".join(parts).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def get_core_fingerprint(path_to_core, build_id):
+    """Returns a fingerprint of a crash read straight from the notes of the core.
+
+    Uses the signal and the program counter of the crashed thread, relative to
+    the executable. Returns None if the core has no such notes or the crash is
+    in a library: abort(), assert() and faults in memcpy() of unrelated bugs
+    all stop at the same few places in libc, only the backtrace tells them
+    apart.
+    """
+    try:
+        with CoreFile.open(path_to_core) as core:
+            threads = core.threads()
+            if not threads or threads[0].pc is None:
+                return None
+            crashed = threads[0]
+            entry = core.auxv().get(AT_ENTRY)
+            mapped_files = core.mapped_files()
+    except (IOError, OSError, ElfError):
+        return None
+
+    executable = None
+    location = None
+    for start, end, _, path in mapped_files:
+        if entry is not None and start <= entry < end:
+            executable = path
+        if start <= crashed.pc < end:
+            location = path
+    if executable is None or location != executable:
+        return None
+    base = min(start for start, _, _, path in mapped_files if path == executable)
+    location = "%s+0x%x" % (executable, crashed.pc - base)
+
+    fingerprint = hashlib.sha1()
+    fingerprint.update(
+        "\n".join(
+            ["core", build_id or "", str(core.machine), str(crashed.signal), location]
+        ).encode("utf-8")
+    )
+    return fingerprint.hexdigest()
+
+
+# Frames of the crashing thread kept to report the duplicates of a crash
+DUPLICATE_FRAMES = 16
+
+
+def get_duplicate_summary(data, max_frames=DUPLICATE_FRAMES):
+    """Returns the parts of a sent event that the report of its duplicates
+    needs: the message, the exception and the innermost frames of the crash.
+    The other threads and the images aren't kept for the dedup window."""
+    summary = dict(data)
+    summary.pop("threads", None)
+    summary.pop("debug_meta", None)
+    exception = dict(data["exception"])
     stacktrace = Stacktrace()
-    # Get the exit Signal from the gdb-output
-    exit_signal = re.search(_exit_signal_re, gdb_output)
-    if exit_signal:
-        exit_signal = exit_signal.group("type")
-    else:
-        exit_signal = "Core"
-    # Searches for frames in the GDB-Output
-    for match in re.finditer(_frame_re, gdb_output):
-        frame = get_frame(match)
-        if frame is not None:
-            stacktrace.append_frame(frame)
-    stacktrace.reverse_list()
-    return stacktrace, exit_signal
+    if exception.get("stacktrace") is not None:
+        stacktrace.frames = exception["stacktrace"].frames[-max_frames:]
+    exception["stacktrace"] = stacktrace
+    summary["exception"] = exception
+    return summary
+
+
+class DuplicateEntry(object):
+    def __init__(self, first_seen):
+        self.first_seen = first_seen
+        self.duplicates = 0
+        self.data = None
+        self.failed = False
+
+
+class FingerprintCache(object):
+    """Remembers the fingerprints of recent crashes to detect crash loops.
+
+    Entries expire `ttl` seconds after the first crash once its event was sent,
+    the least recently seen entries are evicted when there are more than
+    `max_size` of them.
+    """
+
+    def __init__(self, ttl, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.evicted = []
+        self.lock = threading.Lock()
+
+    def seen(self, fingerprint, now=None):
+        """Returns True and counts the crash if the fingerprint is known,
+        remembers the fingerprint otherwise"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.entries.pop(fingerprint, None)
+            # Crashes that are still being uploaded don't expire
+            if (
+                entry is not None
+                and entry.data is not None
+                and now - entry.first_seen >= self.ttl
+            ):
+                self.evicted.append(entry)
+                entry = None
+            if entry is not None:
+                entry.duplicates += 1
+                self.entries[fingerprint] = entry
+                return True
+
+            self.entries[fingerprint] = DuplicateEntry(now)
+            while len(self.entries) > self.max_size:
+                self.evicted.append(self.entries.popitem(last=False)[1])
+            return False
+
+    def set_event(self, fingerprint, data):
+        """Stores the event that was sent for the first crash"""
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is not None:
+                entry.data = data
+
+    def forget(self, fingerprint):
+        """Removes the entry of a first crash that failed to upload, so the
+        next identical crash is uploaded. The duplicates counted until then
+        are returned as failed by pop_expired."""
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None or entry.data is not None:
+                return
+            del self.entries[fingerprint]
+            entry.failed = True
+            self.evicted.append(entry)
+
+    def pop_expired(self, now=None, force=False):
+        """Removes expired entries, returns all removed entries with duplicates
+        that either have an event or failed"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = self.evicted
+            self.evicted = []
+            for fingerprint, entry in list(self.entries.items()):
+                if entry.data is None and not force:
+                    continue
+                if force or now - entry.first_seen >= self.ttl:
+                    expired.append(self.entries.pop(fingerprint))
+        return [
+            entry
+            for entry in expired
+            if entry.duplicates and (entry.data or entry.failed)
+        ]
+
+
+class ExecutableIndex(object):
+    """Finds executables by build-id in a set of files and directories.
+
+    Directories are searched recursively for executable files. The build-id of
+    every file is cached with its mtime, so a rescan only reads files that
+    changed. A build-id that isn't known triggers a rescan, at most every
+    `rescan_interval` seconds.
+    """
+
+    def __init__(self, search_paths, rescan_interval=60):
+        self.search_paths = search_paths
+        self.rescan_interval = rescan_interval
+        self.files = {}
+        self.build_ids = {}
+        self.last_scan = None
+        self.lock = threading.Lock()
+
+    def iter_files(self):
+        for search_path in self.search_paths:
+            if not os.path.isdir(search_path):
+                yield search_path
+                continue
+            for root, _, filenames in os.walk(search_path):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if os.access(path, os.X_OK):
+                        yield path
+
+    def scan(self):
+        files = {}
+        build_ids = {}
+        for path in self.iter_files():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            cached = self.files.get(path)
+            if cached is not None and cached[0] == mtime:
+                build_id = cached[1]
+            else:
+                build_id = get_build_id(path)
+            files[path] = (mtime, build_id)
+            if build_id is not None:
+                build_ids.setdefault(build_id, path)
+        self.files = files
+        self.build_ids = build_ids
+
+    def find(self, build_id, now=None):
+        """Returns the path of the executable with the build-id or None"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            path = self.build_ids.get(build_id)
+            if path is not None and self.files[path][0] == get_mtime(path):
+                return path
+            # A changed executable means a deployment, rescan right away
+            if (
+                path is not None
+                or self.last_scan is None
+                or now - self.last_scan >= self.rescan_interval
+            ):
+                self.last_scan = now
+                self.scan()
+            return self.build_ids.get(build_id)
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
 
 def error(message):
@@ -320,6 +1016,12 @@ def error(message):
     sys.exit(1)
 
 
+def exit_on_signal(signum, frame):
+    """Turns SIGTERM into SystemExit, which runs the regular shutdown"""
+    print("Received signal %d, shutting down" % signum)
+    sys.exit(0)
+
+
 def get_timestamp(path_to_core):
     """Returns the timestamp from a file"""
     stat = os.stat(path_to_core)
@@ -331,35 +1033,342 @@ def get_timestamp(path_to_core):
     return timestamp
 
 
+def get_size(path):
+    """Returns the size of a file, None if it doesn't exist"""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
 def signal_name_to_signal_number(signal_name):
     """Returns the Unix signal number from the signal name"""
+    match = re.match(r"SIG(?P<exit_signal>[A-Z0-9]+)$", signal_name or "")
+    if match is None:
+        return None
+    # gdb names signals without a name by their number, e.g. SIG34
+    if match.group("exit_signal").isdigit():
+        return int(match.group("exit_signal"))
+    exit_signal_number = getattr(signal, signal_name, None)
+    if exit_signal_number is None:
+        return None
+
+    return int(exit_signal_number)
+
+
+def get_elfutils_version(elfutils_path):
+    """Returns the version of elfutils, None if it isn't installed"""
     try:
-        temp = str(
-            "-l" + re.match(r"SIG(?P<exit_signal>.*)", signal_name).group("exit_signal")
+        process = subprocess.Popen(
+            [elfutils_path, "--version"], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
         )
-        # kill can be a shell builtin, or not even present...
-        exit_signal_number = subprocess.check_output(["kill", temp], shell=True)
-    except (AttributeError, subprocess.CalledProcessError):
+    except OSError:
         return None
+    elfutils_version, err = process.communicate()
+    elfutils_version = decode(elfutils_version)
+    if err:
+        print(err)
 
-    return int(exit_signal_number)
+    elfutils_version = re.search(
+        r"eu-unstrip \(elfutils\) (?P<elfutils_version>.*)", elfutils_version
+    )
+    if elfutils_version:
+        return elfutils_version.group("elfutils_version")
+    return None
+
+
+def get_os_context():
+    """Returns the sentry OS context of this host"""
+    process = subprocess.Popen(
+        ["uname", "-s", "-r"], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+    )
+    os_context, err = process.communicate()
+    os_context = decode(os_context)
+    os_context = re.search(r"(?P<name>.*?) (?P<version>.*)", os_context)
+    if os_context:
+        os_name = os_context.group("name")
+        os_version = os_context.group("version")
+    else:
+        os_name = None
+        os_version = None
+    process = subprocess.Popen(
+        ["uname", "-a"], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+    )
+    os_raw_context, err = process.communicate()
+    os_raw_context = decode(os_raw_context)
 
+    return {
+        "name": os_name,
+        "version": os_version,
+        "raw_description": os_raw_context,
+    }
 
-class CoredumpHandler(RegexMatchingEventHandler):
-    def __init__(self, uploader, *args, **kwargs):
-        super(CoredumpHandler, self).__init__(*args, **kwargs)
+
+def add_client_options(data, client):
+    """Adds what the SDK would add to events that bypass it"""
+    for key in ("release", "environment", "server_name", "dist"):
+        if client.options.get(key) and key not in data:
+            data[key] = client.options[key]
+
+
+class CoredumpWorkerPool(object):
+    """Uploads coredumps from a bounded queue with a number of worker threads.
+
+    The heavy lifting happens in gdb and elfutils subprocesses, so threads are
+    enough to process independent coredumps in parallel. When the queue is full,
+    `submit` blocks, which holds back the watchdog observer.
+    """
+
+    def __init__(
+        self, uploader, workers=1, max_queue=100, journal=None, retention=None
+    ):
         self.uploader = uploader
+        self.journal = journal
+        self.retention = retention
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = [
+            threading.Thread(target=self._work, name="coredump-worker-%d" % i)
+            for i in range(max(workers, 1))
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path_to_core):
+        """Queues a coredump, blocks while the queue is full.
+
+        Coredumps the journal knows as processed are skipped.
+        """
+        if self.journal is not None and not self.journal.discover(path_to_core):
+            return
+        self.queue.put(path_to_core)
+
+    def stop(self):
+        """Stops all workers once they finished the coredumps they process.
+
+        Queued coredumps are discarded, otherwise stopping could take as long
+        as processing a full queue. The journal resumes them on the next start,
+        without one they are only listed.
+        """
+        discarded = []
+        while True:
+            try:
+                discarded.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            self.queue.task_done()
+        if discarded and self.journal is not None:
+            print("Left %d queued coredumps for the next start" % len(discarded))
+        elif discarded:
+            print("Dropped %d queued coredumps:" % len(discarded))
+            for path_to_core in discarded:
+                print("  %s" % path_to_core)
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            path_to_core = self.queue.get()
+            try:
+                if path_to_core is None:
+                    return
+                self.set_state(path_to_core, journal.PROCESSING)
+                if self.retention is not None:
+                    self.retention.started(path_to_core)
+                with tracing.trace(path_to_core):
+                    event_id = self.uploader.upload(path_to_core)
+                    tracing.set_result(event_id=event_id)
+                self.set_state(path_to_core, journal.DONE)
+                if self.retention is not None:
+                    self.retention.processed(path_to_core, duplicate=event_id is None)
+            except (Exception, SystemExit) as err:
+                # error() exits, which must not take the worker down
+                print("Failed to upload %s: %s" % (path_to_core, err))
+                metrics.inc("cores_total", result="failed")
+                self.set_state(path_to_core, journal.FAILED)
+                if self.retention is not None:
+                    self.retention.processed(path_to_core, failed=True)
+            finally:
+                self.queue.task_done()
+
+    def set_state(self, path_to_core, state):
+        if self.journal is not None:
+            self.journal.set_state(path_to_core, state)
+
+
+class CoredumpFilter(object):
+    """Decides which files in the watched directories are coredumps.
+
+    The include and exclude regexes are matched against the path relative to
+    the watched directory, like "service/core.1234". Files in subdirectories
+    only count with recursive.
+    """
+
+    def __init__(
+        self,
+        watch_dirs,
+        include=(".*core.*",),
+        exclude=(),
+        recursive=False,
+        ignore_dirs=(),
+    ):
+        self.watch_dirs = [os.path.abspath(watch_dir) for watch_dir in watch_dirs]
+        self.include = [re.compile(regex) for regex in include]
+        self.exclude = [re.compile(regex) for regex in exclude]
+        self.recursive = recursive
+        self.ignore_dirs = [
+            os.path.join(os.path.abspath(ignore_dir), "") for ignore_dir in ignore_dirs
+        ]
+
+    def get_relative_path(self, path):
+        """Returns the path relative to the innermost watched directory"""
+        path = os.path.abspath(path)
+        if any(path.startswith(ignore_dir) for ignore_dir in self.ignore_dirs):
+            return None
+        for watch_dir in sorted(self.watch_dirs, key=len, reverse=True):
+            if path.startswith(os.path.join(watch_dir, "")):
+                return os.path.relpath(path, watch_dir)
+        return None
+
+    def matches(self, path):
+        relative_path = self.get_relative_path(path)
+        if relative_path is None:
+            return False
+        if not self.recursive and os.sep in relative_path:
+            return False
+        return any(regex.match(relative_path) for regex in self.include) and not any(
+            regex.match(relative_path) for regex in self.exclude
+        )
+
+
+def find_coredumps(coredump_filter):
+    """Returns the existing coredumps in the watched directories, oldest first"""
+    paths = set()
+    for watch_dir in coredump_filter.watch_dirs:
+        for root, dirnames, filenames in os.walk(watch_dir):
+            if not coredump_filter.recursive:
+                del dirnames[:]
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if os.path.isfile(path) and coredump_filter.matches(path):
+                    paths.add(path)
+    return sorted(paths, key=get_timestamp)
+
+
+class PendingCoredumps(object):
+    """Holds back new coredumps until the kernel has finished writing them.
+
+    A coredump is dispatched as soon as it is closed after writing, or once its
+    size didn't change for `settle_time` seconds. The latter covers platforms
+    without close events.
+    """
+
+    def __init__(self, dispatch, settle_time=5):
+        self.dispatch = dispatch
+        self.settle_time = settle_time
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def created(self, path, now=None):
+        if self.settle_time <= 0:
+            self.dispatch(path)
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.pending[path] = (get_size(path), now)
+
+    def modified(self, path, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if path in self.pending:
+                self.pending[path] = (get_size(path), now)
+
+    def closed(self, path):
+        with self.lock:
+            ready = self.pending.pop(path, None) is not None
+        if ready:
+            self.dispatch(path)
+
+    def poll(self, now=None):
+        """Dispatches all coredumps that stopped growing"""
+        if now is None:
+            now = time.time()
+        ready = []
+        with self.lock:
+            for path, (size, last_change) in list(self.pending.items()):
+                current_size = get_size(path)
+                if current_size is None:
+                    # deleted before it was complete
+                    del self.pending[path]
+                elif current_size != size:
+                    self.pending[path] = (current_size, now)
+                elif now - last_change >= self.settle_time:
+                    del self.pending[path]
+                    ready.append(path)
+        for path in ready:
+            self.dispatch(path)
+
+
+class CoredumpHandler(FileSystemEventHandler):
+    def __init__(self, pending, coredump_filter):
+        super(CoredumpHandler, self).__init__()
+        self.pending = pending
+        self.filter = coredump_filter
+
+    def dispatch(self, event):
+        if not event.is_directory:
+            super(CoredumpHandler, self).dispatch(event)
 
     def on_created(self, event):
-        """Uploads an event to sentry"""
-        self.uploader.upload(event.src_path)
+        """Waits for the coredump to be written before it is uploaded"""
+        if self.filter.matches(event.src_path):
+            self.pending.created(event.src_path)
+
+    def on_modified(self, event):
+        if self.filter.matches(event.src_path):
+            self.pending.modified(event.src_path)
+
+    def on_closed(self, event):
+        """Queues the coredump for the upload once the kernel closed it"""
+        if self.filter.matches(event.src_path):
+            self.pending.closed(event.src_path)
+
+    def on_moved(self, event):
+        """Coredumps written elsewhere and moved in are complete"""
+        if self.filter.matches(event.dest_path):
+            self.pending.created(event.dest_path)
+            self.pending.closed(event.dest_path)
 
 
 class CoredumpUploader(object):
     def __init__(
-        self, path_to_executable, sentry_dsn, gdb_path, elfutils_path, all_threads
+        self,
+        path_to_executable,
+        sentry_dsn,
+        gdb_path,
+        elfutils_path,
+        all_threads,
+        dedup_window=0,
+        dedup_size=1000,
+        native_modules=False,
+        max_threads=None,
+        max_frames=None,
+        attach_core=False,
+        attach_compression="gzip",
+        attach_max_size=None,
+        gdb_index_cache=None,
+        gdb_mi=False,
+        executable_dirs=(),
+        child_limits=None,
     ):
-        if not os.path.isfile(path_to_executable):
+        if not os.path.exists(path_to_executable):
             error("Wrong path to executable")
 
         if gdb_path is not None and os.path.exists(gdb_path) is not True:
@@ -372,103 +1381,465 @@ class CoredumpUploader(object):
         if elfutils_path is None:
             elfutils_path = "eu-unstrip"
 
+        # A directory for the executable means it's looked up for every core
+        search_paths = list(executable_dirs)
+        if os.path.isdir(path_to_executable):
+            search_paths.insert(0, path_to_executable)
+            path_to_executable = None
+        elif search_paths:
+            search_paths.insert(0, path_to_executable)
+        self.executables = None
+        if search_paths:
+            self.executables = ExecutableIndex(search_paths)
+
         self.path_to_executable = path_to_executable
         self.sentry_dsn = sentry_dsn
         self.gdb_path = gdb_path
         self.elfutils_path = elfutils_path
         self.all_threads = all_threads
+        self.native_modules = native_modules
+        self.max_threads = max_threads
+        self.max_frames = max_frames
+        if attach_core and attach_compression == "zstd" and zstandard is None:
+            error("zstd compression requires the zstandard package")
+        self.attach_core = attach_core
+        self.attach_compression = attach_compression
+        self.attach_max_size = attach_max_size
+        if gdb_index_cache is not None and not os.path.isdir(gdb_index_cache):
+            os.makedirs(gdb_index_cache)
+        self.gdb_index_cache = gdb_index_cache
+        self.child_limits = child_limits or ChildLimits()
+        self.gdb_sessions = None
+        if gdb_mi:
+            self.gdb_sessions = GdbSessionPool(self.start_gdb_session)
+        # The host and tools don't change while we are running
+        self.gdb_version = None
+        self.elfutils_version = get_elfutils_version(elfutils_path)
+        self.os_context = get_os_context()
+        self.executable_build_id = None
+        if path_to_executable is not None:
+            self.executable_build_id = get_build_id(path_to_executable)
+        if dedup_window > 0:
+            self.duplicates = FingerprintCache(dedup_window, dedup_size)
+        else:
+            self.duplicates = None
+        # Set by the watch command to bound the work in crash loops
+        self.sampler = None
+
+    def get_gdb_arguments(self, path_to_core=None, path_to_executable=None):
+        return get_gdb_arguments(
+            self.gdb_path,
+            path_to_executable or self.path_to_executable,
+            path_to_core,
+            index_cache=self.gdb_index_cache,
+        )
 
-    def execute_gdb(self, path_to_core, gdb_command):
-        """creates a subprocess for gdb and returns the output from gdb"""
+    def get_executable(self, path_to_core):
+        """Returns the path and build-id of the executable that crashed"""
+        if self.executables is None:
+            return self.path_to_executable, self.executable_build_id
 
+        module = None
         try:
-            process = subprocess.Popen(
-                [self.gdb_path, "-c", path_to_core, self.path_to_executable],
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-            )
+            with CoreFile.open(path_to_core) as core:
+                module = get_executable(core)
+        except (IOError, OSError, ElfError):
+            pass
+        if module is not None:
+            if module.build_id is not None:
+                path = self.executables.find(module.build_id)
+                if path is not None:
+                    return path, module.build_id
+            # The executable may still be where it was run from
+            if os.path.isfile(module.path) and (
+                get_build_id(module.path) == module.build_id
+            ):
+                return module.path, module.build_id
+
+        if self.path_to_executable is None:
+            error("No executable found for %s" % path_to_core)
+        print("Executable of %s not found, using the default" % path_to_core)
+        return self.path_to_executable, self.executable_build_id
+
+    def warm_index_cache(self):
+        """Loads the symbols of the executable once to fill the index cache"""
+        if self.gdb_index_cache is None or self.executable_build_id is None:
+            return
+        index = get_index_path(self.gdb_index_cache, self.executable_build_id)
+        if os.path.exists(index):
+            return
+        print("Building the gdb index for %s" % self.path_to_executable)
+        try:
+            with open(os.devnull, "w") as devnull:
+                self.child_limits.popen(
+                    self.get_gdb_arguments() + ["-batch", "-nx"],
+                    stdout=devnull,
+                    stderr=subprocess.STDOUT,
+                ).wait()
         except OSError as err:
-            error(err)
+            print("Building the gdb index failed: %s" % err)
 
-        output, errors = process.communicate(input=gdb_command.encode("utf-8"))
-        if errors:
-            error(errors)
+    def iter_gdb(self, path_to_core, gdb_command, path_to_executable=None):
+        """creates a subprocess for gdb and yields its output line by line.
 
-        return decode(output)
+        Raises ChildTimeout after the last line if gdb was killed.
+        """
 
-    def execute_elfutils(self, path_to_core):
-        """Executes eu-unstrip & returns the output"""
+        with tracing.span("gdb.spawn"):
+            try:
+                process = self.child_limits.popen(
+                    self.get_gdb_arguments(path_to_core, path_to_executable),
+                    stdout=subprocess.PIPE,
+                    stdin=subprocess.PIPE,
+                )
+            except OSError as err:
+                metrics.inc("subprocess_failures_total", tool="gdb", reason="spawn")
+                error(err)
+
+        # The commands fit into the pipe buffer, gdb reads them as it goes
+        process.stdin.write(gdb_command.encode("utf-8"))
+        process.stdin.close()
+        watchdog = self.child_limits.watch(process)
         try:
-            process = subprocess.Popen(
-                [
-                    self.elfutils_path,
-                    "-n",
-                    "--core",
-                    path_to_core,
-                    "-e",
-                    self.path_to_executable,
-                ],
-                stdout=subprocess.PIPE,
-            )
-        except OSError as err:
-            error(err)
-
-        output, errors = process.communicate()
+            for line in iter(process.stdout.readline, b""):
+                yield decode(line)
+        finally:
+            watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+        if watchdog.timed_out:
+            raise ChildTimeout("gdb")
+
+    def execute_elfutils(self, path_to_core, path_to_executable=None):
+        """Executes eu-unstrip & returns the output"""
+        with tracing.span("eu-unstrip.spawn"):
+            try:
+                process = self.child_limits.popen(
+                    [
+                        self.elfutils_path,
+                        "-n",
+                        "--core",
+                        path_to_core,
+                        "-e",
+                        path_to_executable or self.path_to_executable,
+                    ],
+                    stdout=subprocess.PIPE,
+                )
+            except OSError as err:
+                metrics.inc(
+                    "subprocess_failures_total", tool="eu-unstrip", reason="spawn"
+                )
+                error(err)
+
+        with tracing.span("eu-unstrip.wait") as span:
+            with self.child_limits.watch(process) as watchdog:
+                output, errors = process.communicate()
+            span.args["output_size"] = len(output)
+        if watchdog.timed_out:
+            raise ChildTimeout("eu-unstrip", decode(output))
         if errors:
+            metrics.inc("subprocess_failures_total", tool="eu-unstrip", reason="error")
             error(errors)
 
         return decode(output)
 
-    def get_registers(self, path_to_core, stacktrace):
-        """Returns the stacktrace with the registers, the gdb-version and the message."""
-        gdb_output = self.execute_gdb(path_to_core, "info registers")
-        gdb_version = re.match(r"GNU gdb \(.*?\) (?P<gdb_version>.*)", gdb_output)
-        if gdb_version:
-            gdb_version = gdb_version.group("gdb_version")
+    def flush_aggregates(self, force=False):
+        """Sends one event with the occurrence count for each repeated crash
+        and one with the counts of the coredumps skipped by sampling"""
+        if self.sampler is not None:
+            skipped = self.sampler.pop_skipped(force=force)
+            if skipped:
+                self.send_skipped(skipped)
+        if self.duplicates is None:
+            return
+        for entry in self.duplicates.pop_expired(force=force):
+            if entry.data is None:
+                print(
+                    "Skipped %d duplicates of a core dump that failed to upload"
+                    % entry.duplicates
+                )
+                continue
+            data = dict(entry.data)
+            data["event_id"] = uuid.uuid4().hex
+            data["timestamp"] = time.time()
+            data["extra"] = dict(data.get("extra") or {}, occurrences=entry.duplicates)
+            event_id = self.send_event(data)
+            print(
+                "Core dump repeated %d times sent to sentry: %s"
+                % (entry.duplicates, event_id)
+            )
 
-        message = re.search(r"(?P<message>Core was generated .*\n.*)", gdb_output)
-        if message:
-            message = message.group("message")
+    def send_skipped(self, skipped):
+        total = sum(count for _, _, _, count in skipped)
+        data = {
+            "event_id": uuid.uuid4().hex,
+            "timestamp": time.time(),
+            "platform": "native",
+            "level": "info",
+            "message": {
+                "message": "%d core dumps skipped by sampling and rate limits" % total
+            },
+            "fingerprint": ["coredump-uploader-skipped"],
+            "contexts": {"os": dict(self.os_context)},
+            "extra": {
+                "skipped": [
+                    {
+                        "executable": executable,
+                        "signature": signature,
+                        "reason": reason,
+                        "count": count,
+                    }
+                    for executable, signature, reason, count in skipped
+                ]
+            },
+            "sdk": {"name": "coredump.uploader.sdk", "version": "0.0.1"},
+        }
+        event_id = self.send_event(data)
+        print("%d skipped core dumps reported to sentry: %s" % (total, event_id))
+
+    def sample(self, path_to_core, executable, signature, check_executable=True):
+        if self.sampler is None or self.sampler.sample(
+            executable, signature, check_executable
+        ):
+            return True
+        print("Core dump skipped by sampling: %s" % path_to_core)
+        metrics.inc("cores_total", result="sampled")
+        return False
+
+    def read_gdb(self, path_to_core, path_to_executable=None):
+        """Returns the parsed backtrace, the registers, the gdb version and message"""
+        # Runs a single gdb session for the backtrace, registers and version.
+        # The backtrace is parsed while gdb is still printing it, only the
+        # other sections are kept as text.
+        parser = BacktraceParser(
+            self.all_threads, max_threads=self.max_threads, max_frames=self.max_frames
+        )
+        gdb_output = []
+        gdb_lines = self.iter_gdb(
+            path_to_core, get_gdb_commands(self.all_threads), path_to_executable
+        )
+        # Reading includes parsing the backtrace while gdb prints it
+        with tracing.span("gdb.read", profile=True) as span:
+            output_size = 0
+            try:
+                for section, line in iter_gdb_sections(gdb_lines):
+                    output_size += len(line)
+                    if section in ("header", "backtrace"):
+                        parser.feed(line)
+                    if section != "backtrace":
+                        gdb_output.append(line)
+            except ChildTimeout:
+                print("gdb timed out on %s, sending what it printed" % path_to_core)
+                parser.timed_out = True
+            span.args["output_size"] = output_size
+
+        with tracing.span("parse.registers", profile=True):
+            registers, gdb_version, message = get_registers(
+                "".join(gdb_output), Stacktrace()
+            )
+        return parser, list(registers.registers.items()), gdb_version, message
 
-        for match in re.finditer(_register_re, gdb_output):
-            if match is not None:
-                stacktrace.ad_register(
-                    match.group("register_name"), match.group("register_value")
-                )
-        return (
-            stacktrace,
-            gdb_version,
-            message,
+    def start_gdb_session(self, path_to_executable):
+        arguments = get_gdb_arguments(
+            self.gdb_path, path_to_executable, index_cache=self.gdb_index_cache
         )
+        try:
+            return GdbSession(
+                self.child_limits.get_arguments(
+                    arguments[:1] + ["--interpreter=mi2", "-q"] + arguments[1:]
+                ),
+                timeout=self.child_limits.timeout,
+            )
+        except OSError as err:
+            metrics.inc("subprocess_failures_total", tool="gdb", reason="spawn")
+            error(err)
+
+    def read_gdb_mi(self, path_to_core, path_to_executable=None):
+        """Like read_gdb, but uses a persistent gdb session driven through GDB/MI"""
+        parser = BacktraceParser(
+            self.all_threads, max_threads=self.max_threads, max_frames=self.max_frames
+        )
+        try:
+            with tracing.span("gdb.acquire"):
+                session = self.gdb_sessions.acquire(
+                    path_to_executable or self.path_to_executable
+                )
+        except GdbMiTimeout as err:
+            # The one-shot gdb gets its own timeout and sends what it printed
+            metrics.inc("subprocess_failures_total", tool="gdb", reason="timeout")
+            print("%s, running gdb for %s alone" % (err, path_to_core))
+            return self.read_gdb(path_to_core, path_to_executable)
+        except GdbMiError as err:
+            metrics.inc("subprocess_failures_total", tool="gdb", reason="spawn")
+            error("Starting gdb failed: %s" % err)
+
+        reusable = False
+        output = ""
+        registers = []
+        watchdog = self.child_limits.watch(session.process)
+        try:
+            with tracing.span("gdb.load_core"):
+                output = session.load_core(path_to_core)
+            try:
+                with tracing.span("gdb.backtrace", profile=True):
+                    for line in output.splitlines():
+                        parser.feed_header(line)
+                    threads, crashed_thread_id = session.thread_info()
+                    if crashed_thread_id is not None:
+                        parser.crashed_thread_id = crashed_thread_id
+                    if self.all_threads:
+                        # In the order of `thread apply all bt`, highest id first
+                        for thread in reversed(threads):
+                            parser.start_thread(
+                                thread["id"],
+                                get_mi_thread_name(thread.get("target-id", "")),
+                            )
+                            for frame in session.frames(thread["id"]):
+                                parser.append_frame(get_mi_frame(frame))
+                        parser.end_thread()
+                    else:
+                        for frame in session.frames(crashed_thread_id):
+                            parser.append_frame(get_mi_frame(frame))
+                with tracing.span("gdb.registers"):
+                    registers = session.registers(crashed_thread_id)
+            finally:
+                session.unload_core()
+            output += session.version()
+            reusable = True
+        except GdbMiError as err:
+            if not watchdog.timed_out:
+                metrics.inc("subprocess_failures_total", tool="gdb", reason="error")
+                error("gdb failed: %s" % err)
+            print("gdb timed out on %s, sending what it printed" % path_to_core)
+            parser.timed_out = True
+        finally:
+            watchdog.cancel()
+            self.gdb_sessions.release(session, reusable)
+
+        _, gdb_version, message = get_registers(output, Stacktrace())
+        return parser, registers, gdb_version, message
+
+    def close(self):
+        if self.gdb_sessions is not None:
+            self.gdb_sessions.close()
 
     def upload(self, path_to_core):
-        """Uploads the event to sentry"""
+        """Uploads the event to sentry, returns None for skipped crashes.
+
+        Crashes are skipped when they are duplicates or sampled out, failures
+        exit through error().
+        """
+        claimed = []
+        try:
+            return self.upload_core(path_to_core, claimed)
+        except (Exception, SystemExit):
+            # Identical crashes must not be skipped as duplicates of a failure
+            for fingerprint in claimed:
+                self.duplicates.forget(fingerprint)
+            raise
+
+    def is_duplicate(self, path_to_core, fingerprint, claimed):
+        """Returns True for crashes already seen within the dedup window,
+        adds the fingerprint of new ones to claimed"""
+        if self.duplicates is None or fingerprint is None:
+            return False
+        if self.duplicates.seen(fingerprint):
+            print("Duplicate core dump skipped: %s" % path_to_core)
+            metrics.inc("cores_total", result="duplicate")
+            return True
+        claimed.append(fingerprint)
+        return False
+
+    def upload_core(self, path_to_core, claimed):
         # Validate input Path
         if os.path.isfile(path_to_core) is not True:
             error("Wrong path to coredump")
 
-        if self.all_threads:
-            gdb_output = self.execute_gdb(path_to_core, "thread apply all bt")
-            (thread_list, exit_signal, stacktrace, crashed_thread_id,) = get_threads(
-                gdb_output
-            )
+        self.flush_aggregates()
+
+        core_size = get_size(path_to_core)
+        if core_size is not None:
+            metrics.observe("core_size_bytes", core_size)
+        tracing.set_result(size=core_size)
+
+        with metrics.stage("executable"):
+            path_to_executable, build_id = self.get_executable(path_to_core)
+        if self.gdb_index_cache is not None and build_id is not None:
+            touch_index(self.gdb_index_cache, build_id)
+
+        # Skips crashes that are sampled out or were already uploaded within
+        # the dedup window, without running gdb if the core has the notes to
+        # tell. Sampling comes first, so crashes it skips are counted in its
+        # reports and don't leave a fingerprint without an event behind.
+        fingerprint = None
+        if self.duplicates is not None or self.sampler is not None:
+            with metrics.stage("fingerprint"):
+                fingerprint = get_core_fingerprint(path_to_core, build_id)
+        # Without the notes only the executable is limited before running gdb
+        if not self.sample(path_to_core, path_to_executable, fingerprint):
+            return None
+        if self.is_duplicate(path_to_core, fingerprint, claimed):
+            return None
+
+        if self.gdb_sessions is not None:
+            read_gdb = self.read_gdb_mi
         else:
-            gdb_output = self.execute_gdb(path_to_core, "bt")
-            stacktrace, exit_signal = get_stacktrace(gdb_output)
-            thread_list = None
-            crashed_thread_id = None
-
-        # gets the registers, the gdb-version and the message
-        stacktrace, gdb_version, message = self.get_registers(path_to_core, stacktrace)
+            read_gdb = self.read_gdb
+        with metrics.stage("gdb"):
+            parser, registers, gdb_version, message = read_gdb(
+                path_to_core, path_to_executable
+            )
 
-        image_list = []
+        with tracing.span("parse.threads", profile=True):
+            if self.all_threads:
+                (
+                    thread_list,
+                    exit_signal,
+                    stacktrace,
+                    crashed_thread_id,
+                ) = parser.get_threads()
+            else:
+                stacktrace, exit_signal = parser.get_stacktrace()
+                thread_list = None
+                crashed_thread_id = None
+        # The parts of the analysis that were killed after the timeout
+        timed_out = ["gdb"] if parser.timed_out else []
+        if stacktrace is None:
+            stacktrace = Stacktrace()
+
+        for name, value in registers:
+            stacktrace.ad_register(name, value)
+
+        if fingerprint is None and (
+            self.duplicates is not None or self.sampler is not None
+        ):
+            fingerprint = get_fingerprint(build_id, stacktrace, exit_signal)
+            if not self.sample(
+                path_to_core, path_to_executable, fingerprint, check_executable=False
+            ):
+                return None
+            if self.is_duplicate(path_to_core, fingerprint, claimed):
+                return None
+
+        image_list = None
+        if self.native_modules:
+            with metrics.stage("modules"):
+                image_list = get_native_images(path_to_core)
 
         # Searches for images in the Eu-Unstrip Output
-        eu_unstrip_output = self.execute_elfutils(path_to_core)
-        for match in re.finditer(_image_re, eu_unstrip_output):
-            image = get_image(match)
-            if image is not None:
-                image_list.append(image)
+        if image_list is None:
+            with metrics.stage("eu-unstrip"):
+                try:
+                    eu_unstrip_output = self.execute_elfutils(
+                        path_to_core, path_to_executable
+                    )
+                except ChildTimeout as err:
+                    eu_unstrip_output = err.output
+                    timed_out.append(err.name)
+                with tracing.span("parse.images", profile=True):
+                    image_list = get_images(eu_unstrip_output)
 
         # Get timestamp
         timestamp = get_timestamp(path_to_core)
@@ -476,47 +1847,26 @@ class CoredumpUploader(object):
         # Get signal Number from signal name
         exit_signal_number = signal_name_to_signal_number(exit_signal)
 
-        # Get elfutils version
-        process = subprocess.Popen(
-            [self.elfutils_path, "--version"],
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-        elfutils_version, err = process.communicate()
-        elfutils_version = decode(elfutils_version)
-        if err:
-            print(err)
-
-        if elfutils_version:
-            elfutils_version = re.search(
-                r"eu-unstrip \(elfutils\) (?P<elfutils_version>.*)", elfutils_version
-            ).group("elfutils_version")
-
-        # Get OS context
-        process = subprocess.Popen(
-            ["uname", "-s", "-r"], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-        )
-        os_context, err = process.communicate()
-        os_context = decode(os_context)
-        os_context = re.search(r"(?P<name>.*?) (?P<version>.*)", os_context)
-        if os_context:
-            os_name = os_context.group("name")
-            os_version = os_context.group("version")
-        else:
-            os_name = None
-            os_version = None
-        process = subprocess.Popen(
-            ["uname", "-a"], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-        )
-        os_raw_context, err = process.communicate()
-        os_raw_context = decode(os_raw_context)
+        # gdb stays the same, keep its version for outputs that lack it
+        if gdb_version:
+            self.gdb_version = gdb_version
 
         # Get App Contex
-        process = subprocess.Popen(
-            ["file", path_to_core], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-        )
+        with metrics.stage("file"):
+            with tracing.span("file.spawn"):
+                process = self.child_limits.popen(
+                    ["file", path_to_core],
+                    stdout=subprocess.PIPE,
+                    stdin=subprocess.PIPE,
+                )
+            with tracing.span("file.wait"):
+                with self.child_limits.watch(process) as watchdog:
+                    app_context, err = process.communicate()
+        if watchdog.timed_out:
+            timed_out.append("file")
+        for name in timed_out:
+            metrics.inc("subprocess_failures_total", tool=name, reason="timeout")
         args = app_name = arch = ""
-        app_context, err = process.communicate()
         app_context = decode(app_context)
         app_context = re.search(
             r"from '.*?( (?P<args>.*))?', .* execfn: '.*\/(?P<app_name>.*?)', platform: '(?P<arch>.*?)'",
@@ -527,30 +1877,23 @@ class CoredumpUploader(object):
             app_name = app_context.group("app_name")
             arch = app_context.group("arch")
 
-        # Make a json from the Thread_list
-        if thread_list:
-            for i, thread in enumerate(thread_list):
-                thread_list[i] = thread.to_json()
-
-        # Make the image_list to json
-        for i, image in enumerate(image_list):
-            try:
-                if arch:
-                    image_list[i].arch = arch
-                image_list[i] = image.to_json()
-            except:
-                continue
-
-        # Get value, exception from message
-        message = re.search(
-            r"(?P<message>.*)\n(?P<value>.*?, (?P<type>.*?)\.)", message
-        )
-        if message:
-            value_exception = message.group("value")
-            type_exception = message.group("type")
-            message = message.group("message")
-        if type_exception is None:
-            type_exception = exit_signal
+        # The models are serialized when the event is sent
+        if arch:
+            for image in image_list:
+                image.arch = arch
+
+        # Get value, exception from message, which gdb may not have printed
+        # before it timed out
+        value_exception = None
+        type_exception = exit_signal
+        if message is not None:
+            match = re.search(
+                r"(?P<message>.*)\n(?P<value>.*?, (?P<type>.*?)\.)", message
+            )
+            if match:
+                value_exception = match.group("value")
+                type_exception = match.group("type") or exit_signal
+                message = match.group("message")
 
         # Build the json for sentry
         sentry_sdk.integrations.modules.ModulesIntegration = None
@@ -579,20 +1922,20 @@ class CoredumpUploader(object):
                         },
                     },
                 },
-                "stacktrace": stacktrace.to_json(),
+                "stacktrace": stacktrace,
             },
             "contexts": {
-                "gdb": {"type": "runtime", "name": "gdb", "version": gdb_version,},
+                "gdb": {
+                    "type": "runtime",
+                    "name": "gdb",
+                    "version": self.gdb_version,
+                },
                 "elfutils": {
                     "type": "runtime",
                     "name": "elfutils",
-                    "version": elfutils_version,
-                },
-                "os": {
-                    "name": os_name,
-                    "version": os_version,
-                    "raw_description": os_raw_context,
+                    "version": self.elfutils_version,
                 },
+                "os": dict(self.os_context),
                 "runtime": None,
                 "app": {"app_name": app_name, "argv": args,},
             },
@@ -601,9 +1944,80 @@ class CoredumpUploader(object):
         }
         if thread_list:
             data["threads"] = {"values": thread_list}
-
-        event_id = sentry_sdk.capture_event(data)
+        extra = {}
+        if parser.threads_omitted:
+            extra["threads_omitted"] = parser.threads_omitted
+        if timed_out:
+            extra["timed_out"] = timed_out
+            data["tags"] = {"partial": "true"}
+        if extra:
+            data["extra"] = extra
+
+        with metrics.stage("send"):
+            if self.attach_core:
+                event_id = self.send_with_core(data, path_to_core)
+            else:
+                event_id = self.send_event(data)
+
+        # A failed send fails the core, which is then kept for another try
+        # and doesn't make identical crashes duplicates
+        if event_id is None:
+            error("Sending the event of %s failed" % path_to_core)
+        for fingerprint in claimed:
+            self.duplicates.set_event(fingerprint, get_duplicate_summary(data))
+        metrics.inc("cores_total", result="uploaded")
         print("Core dump sent to sentry: %s" % (event_id))
+        return event_id
+
+    def send_event(self, data):
+        """Sends an event that may contain model objects, returns its id"""
+        client = sentry_sdk.Hub.current.client
+        if client is not None and isinstance(client.transport, UploaderTransport):
+            add_client_options(data, client)
+            with tracing.span("serialize") as span:
+                envelope = build_event_envelope(data)
+                span.args["size"] = len(envelope)
+            if not client.transport.submit(envelope):
+                return None
+            return data["event_id"]
+        # The SDK processes the event itself and needs plain data for that
+        with tracing.span("serialize"):
+            data = json.loads(dump_event(data).decode("utf-8"))
+        return sentry_sdk.capture_event(data)
+
+    def send_with_core(self, data, path_to_core):
+        """Sends the event with the compressed core as attachment"""
+        client = sentry_sdk.Hub.current.client
+        if client is None or client.dsn is None:
+            return self.send_event(data)
+
+        try:
+            attachment = CoreAttachment(
+                path_to_core, self.attach_compression, self.attach_max_size
+            )
+        except AttachmentTooLarge as err:
+            print("Core dump not attached: %s" % err)
+            data["extra"] = dict(data.get("extra") or {}, core_attachment=str(err))
+            return self.send_event(data)
+
+        add_client_options(data, client)
+        try:
+            with tracing.span("serialize") as span:
+                body, length = build_envelope(data, attachment)
+                span.args["size"] = length
+            if isinstance(client.transport, UploaderTransport):
+                if not client.transport.capture_file(body):
+                    return None
+                return data["event_id"]
+            with tracing.span("post") as span:
+                status = send_envelope(client.dsn, body, length)
+                span.args["status"] = status
+        finally:
+            attachment.close()
+        if status != 200:
+            print("Sending the core dump failed with status %d" % status)
+            return None
+        return data["event_id"]
 
 
 @click.group()
@@ -614,20 +2028,241 @@ class CoredumpUploader(object):
 @click.option(
     "--all-threads", is_flag=True, help="Sends the backtrace from all threads to sentry"
 )
+@click.option(
+    "--dedup-window",
+    default=0,
+    help="Seconds during which identical crashes are only counted (0 disables)",
+)
+@click.option(
+    "--dedup-size", default=1000, help="Maximum number of remembered crashes"
+)
+@click.option(
+    "--native-modules",
+    is_flag=True,
+    help="Reads the loaded modules from the core instead of running eu-unstrip",
+)
+@click.option(
+    "--max-threads",
+    type=click.IntRange(min=1),
+    help="Maximum number of threads sent, threads with identical stacks are merged",
+)
+@click.option(
+    "--max-frames",
+    type=click.IntRange(min=1),
+    help="Maximum number of frames per thread, keeps the innermost and outermost",
+)
+@click.option(
+    "--attach-core",
+    is_flag=True,
+    help="Attaches the compressed core dump to the event",
+)
+@click.option(
+    "--attach-compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default="gzip",
+    help="Compression of the attached core dump, zstd needs zstandard",
+)
+@click.option(
+    "--attach-max-size",
+    default=100 * 1024 * 1024,
+    help="Maximum size of the compressed core dump in bytes",
+)
+@click.option(
+    "--executable-dir",
+    "executable_dirs",
+    multiple=True,
+    help="Directory searched for the executable of each core, can be repeated",
+)
+@click.option(
+    "--gdb-index-cache",
+    help="Directory caching the symbol index gdb builds for the executable",
+)
+@click.option(
+    "--gdb-index-max-age",
+    default=30 * 24 * 3600,
+    help="Seconds after which watch removes cached indexes that weren't used",
+)
+@click.option(
+    "--gdb-mi",
+    is_flag=True,
+    help="Keeps gdb running between cores and reads the backtraces through GDB/MI",
+)
+@click.option(
+    "--send-queue",
+    default=1000,
+    help="Maximum number of events waiting to be sent to sentry",
+)
+@click.option(
+    "--send-workers", default=2, help="Number of connections used to send events"
+)
+@click.option(
+    "--send-retries",
+    default=5,
+    help="Retries with exponential backoff before an event is spooled",
+)
+@click.option(
+    "--spool-dir",
+    help="Directory keeping the events that could not be sent, to send them later",
+)
+@click.option(
+    "--flush-timeout",
+    default=60,
+    help="Seconds to wait for queued events to be sent before exiting",
+)
+@click.option(
+    "--nice",
+    type=click.IntRange(0, 19),
+    help="Lowers the CPU priority of gdb, eu-unstrip and file by this much",
+)
+@click.option(
+    "--ionice",
+    "ionice_class",
+    type=click.Choice(["best-effort", "idle"]),
+    help="I/O scheduling class of gdb, eu-unstrip and file",
+)
+@click.option(
+    "--ionice-level",
+    type=click.IntRange(0, 7),
+    help="I/O priority within the best-effort class, 7 is the lowest",
+)
+@click.option(
+    "--child-max-memory",
+    type=int,
+    help="Bytes of address space gdb, eu-unstrip and file may use",
+)
+@click.option(
+    "--child-timeout",
+    type=float,
+    help="Seconds after which gdb, eu-unstrip and file are killed, "
+    "the event is sent with what they printed until then",
+)
+@click.option(
+    "--statsd", help="Also sends the metrics to the StatsD server at host:port",
+)
+@click.option(
+    "--statsd-prefix",
+    default="coredump_uploader",
+    help="Prefix of the metric names sent to StatsD",
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    help="Appends a trace of the time spent in each stage of every core to this file",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice([tracing.JSON_LINES, tracing.CHROME]),
+    default=tracing.JSON_LINES,
+    help="Writes the trace as JSON lines or in the Chrome trace format",
+)
+@click.option(
+    "--profile-python",
+    is_flag=True,
+    help="Profiles the parsing with cProfile, writes the statistics next to the trace",
+)
 @click.pass_context
-def cli(context, path_to_executable, sentry_dsn, gdb_path, elfutils_path, all_threads):
+def cli(
+    context,
+    path_to_executable,
+    sentry_dsn,
+    gdb_path,
+    elfutils_path,
+    all_threads,
+    dedup_window,
+    dedup_size,
+    native_modules,
+    max_threads,
+    max_frames,
+    attach_core,
+    attach_compression,
+    attach_max_size,
+    executable_dirs,
+    gdb_index_cache,
+    gdb_index_max_age,
+    gdb_mi,
+    send_queue,
+    send_workers,
+    send_retries,
+    spool_dir,
+    flush_timeout,
+    nice,
+    ionice_class,
+    ionice_level,
+    child_max_memory,
+    child_timeout,
+    statsd,
+    statsd_prefix,
+    profile_path,
+    profile_format,
+    profile_python,
+):
     """Sentry coredump uploader
 
     This utility can upload core dumps to sentry by stack walking them with the help
-    of GDB.
+    of GDB. PATH_TO_EXECUTABLE can also be a directory, then the executable of every
+    core is looked up in it by build-id.
     """
-    sentry_sdk.init(sentry_dsn, max_breadcrumbs=0)
+    if statsd is not None:
+        try:
+            metrics.configure_statsd(statsd, statsd_prefix)
+        except (ValueError, socket.error) as err:
+            error("Invalid --statsd address %s: %s" % (statsd, err))
+    if profile_path is not None:
+        try:
+            tracing.configure(profile_path, profile_format, profile_python)
+        except (IOError, OSError) as err:
+            error("Opening the profile failed: %s" % err)
+
+    transport = None
+    dsn = sentry_dsn or os.environ.get("SENTRY_DSN")
+    if dsn:
+        transport = UploaderTransport(
+            {"dsn": dsn},
+            queue_size=send_queue,
+            workers=send_workers,
+            max_retries=send_retries,
+            spool_dir=spool_dir,
+        )
+    sentry_sdk.init(
+        sentry_dsn,
+        max_breadcrumbs=0,
+        transport=transport,
+        shutdown_timeout=flush_timeout,
+    )
+    try:
+        child_limits = ChildLimits(
+            nice=nice,
+            ionice_class=ionice_class,
+            ionice_level=ionice_level,
+            max_memory=child_max_memory,
+            timeout=child_timeout,
+        )
+    except OSError as err:
+        error(err)
     uploader = CoredumpUploader(
-        path_to_executable, sentry_dsn, gdb_path, elfutils_path, all_threads
+        path_to_executable,
+        sentry_dsn,
+        gdb_path,
+        elfutils_path,
+        all_threads,
+        dedup_window=dedup_window,
+        dedup_size=dedup_size,
+        native_modules=native_modules,
+        max_threads=max_threads,
+        max_frames=max_frames,
+        attach_core=attach_core,
+        attach_compression=attach_compression,
+        attach_max_size=attach_max_size,
+        gdb_index_cache=gdb_index_cache,
+        gdb_mi=gdb_mi,
+        executable_dirs=executable_dirs,
+        child_limits=child_limits,
     )
 
     context.ensure_object(dict)
     context.obj["uploader"] = uploader
+    context.obj["flush_timeout"] = flush_timeout
+    context.obj["gdb_index_max_age"] = gdb_index_max_age
 
 
 @cli.command()
@@ -636,13 +2271,130 @@ def cli(context, path_to_executable, sentry_dsn, gdb_path, elfutils_path, all_th
 def upload(context, path_to_core):
     """Uploads the coredump"""
     uploader = context.obj["uploader"]
-    uploader.upload(path_to_core)
+    with tracing.trace(path_to_core):
+        tracing.set_result(event_id=uploader.upload(path_to_core))
+    uploader.close()
+    sentry_sdk.flush(timeout=context.obj["flush_timeout"])
 
 
 @cli.command()
-@click.argument("watch_dir")
+@click.argument("watch_dirs", metavar="WATCH_DIR...", nargs=-1, required=True)
+@click.option("--recursive", is_flag=True, help="Also watches the subdirectories")
+@click.option(
+    "--include",
+    multiple=True,
+    help="Regex for the paths of coredumps relative to the watched directory, "
+    "can be repeated (default: .*core.*)",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help="Regex for relative paths to ignore, can be repeated",
+)
+@click.option(
+    "--workers", default=1, help="Number of coredumps processed in parallel"
+)
+@click.option(
+    "--max-queue",
+    default=100,
+    help="Maximum number of coredumps waiting to be processed",
+)
+@click.option(
+    "--settle-time",
+    default=5,
+    help="Seconds a coredump must not grow before it is processed",
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    help="SQLite file recording processed coredumps, to resume after restarts",
+)
+@click.option(
+    "--retention",
+    "retention_policy",
+    type=click.Choice(retention.POLICIES),
+    default=retention.KEEP,
+    help="What happens to a coredump after it was processed",
+)
+@click.option(
+    "--archive-dir",
+    help="Directory for moved and compressed coredumps, next to the coredump if unset",
+)
+@click.option(
+    "--retention-compression",
+    type=click.Choice(["gzip", "zstd"]),
+    default="gzip",
+    help="Compression used by --retention compress",
+)
+@click.option(
+    "--max-total-size",
+    type=int,
+    help="Bytes the coredumps may take up, older ones are removed beyond that",
+)
+@click.option(
+    "--max-count",
+    type=int,
+    help="Number of coredumps to keep, older ones are removed beyond that",
+)
+@click.option(
+    "--min-free-space",
+    type=int,
+    help="Bytes of free disk space below which coredumps are removed eagerly",
+)
+@click.option(
+    "--executable-rate",
+    type=float,
+    help="Coredumps per minute analyzed for each executable",
+)
+@click.option(
+    "--signature-rate",
+    type=float,
+    help="Coredumps per minute analyzed for each crash signature",
+)
+@click.option(
+    "--sample-target",
+    type=float,
+    help="Coredumps per hour of a crash signature analyzed before sampling",
+)
+@click.option(
+    "--skipped-report-interval",
+    default=300,
+    help="Seconds between the events counting the coredumps that were skipped",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serves metrics for Prometheus on this port at /metrics",
+)
+@click.option(
+    "--metrics-address",
+    default="127.0.0.1",
+    help="Address the metrics are served on",
+)
 @click.pass_context
-def watch(context, watch_dir):
+def watch(
+    context,
+    watch_dirs,
+    recursive,
+    include,
+    exclude,
+    workers,
+    max_queue,
+    settle_time,
+    journal_path,
+    retention_policy,
+    archive_dir,
+    retention_compression,
+    max_total_size,
+    max_count,
+    min_free_space,
+    executable_rate,
+    signature_rate,
+    sample_target,
+    skipped_report_interval,
+    metrics_port,
+    metrics_address,
+):
     """Starts the Observer and creates the CoredumpHandler"""
     uploader = context.obj["uploader"]
 
@@ -654,21 +2406,123 @@ def watch(context, watch_dir):
 
     print("Starting watchdog...")
 
-    regexes = [".*core.*"]
-    handler = CoredumpHandler(uploader, ignore_directories=True, regexes=regexes)
+    # Service managers stop us with SIGTERM, queued events are sent or
+    # spooled on the way out
+    signal.signal(signal.SIGTERM, exit_on_signal)
+
+    if metrics_port is not None:
+        try:
+            metrics.start_http_server(metrics_port, metrics_address)
+        except socket.error as err:
+            error("Serving metrics failed: %s" % err)
+
+    coredump_journal = None
+    if journal_path is not None:
+        coredump_journal = journal.CoredumpJournal(journal_path)
+        coredump_journal.prune()
+
+    if executable_rate or signature_rate or sample_target:
+        uploader.sampler = sampling.CrashSampler(
+            executable_rate=executable_rate,
+            signature_rate=signature_rate,
+            sample_target=sample_target,
+            report_interval=skipped_report_interval,
+        )
+
+    retention_manager = None
+    ignore_dirs = (archive_dir,) if archive_dir is not None else ()
+    if retention_policy == retention.COMPRESS:
+        # Compressed coredumps are not new ones
+        exclude = exclude + (retention.get_exclude(retention_compression),)
+    coredump_filter = CoredumpFilter(
+        watch_dirs,
+        include=include or (".*core.*",),
+        exclude=exclude,
+        recursive=recursive,
+        ignore_dirs=ignore_dirs,
+    )
+    if (
+        retention_policy != retention.KEEP
+        or max_total_size is not None
+        or max_count is not None
+        or min_free_space is not None
+    ):
+        if retention_policy == retention.MOVE and archive_dir is None:
+            error("--retention move requires --archive-dir")
+        retention_manager = retention.RetentionManager(
+            coredump_filter,
+            policy=retention_policy,
+            archive_dir=archive_dir,
+            compression=retention_compression,
+            max_total_size=max_total_size,
+            max_count=max_count,
+            min_free_space=min_free_space,
+            journal=coredump_journal,
+        )
+        retention_manager.enforce(force=True)
+
+    pool = CoredumpWorkerPool(
+        uploader,
+        workers=workers,
+        max_queue=max_queue,
+        journal=coredump_journal,
+        retention=retention_manager,
+    )
+    pool.start()
+
+    if uploader.gdb_index_cache is not None:
+        prune_index_cache(
+            uploader.gdb_index_cache, max_age=context.obj["gdb_index_max_age"]
+        )
+        warmup = threading.Thread(target=uploader.warm_index_cache)
+        warmup.daemon = True
+        warmup.start()
 
+    pending = PendingCoredumps(pool.submit, settle_time=settle_time)
+
+    handler = CoredumpHandler(pending, coredump_filter)
+
+    # One observer and one pipeline for all directories
     observer = Observer()
-    observer.schedule(handler, watch_dir, recursive=False)
+    for watch_dir in coredump_filter.watch_dirs:
+        observer.schedule(handler, watch_dir, recursive=recursive)
     observer.start()
 
-    print("Watchdog started, looking for new coredumps in : %s" % watch_dir)
+    # Picks up the coredumps created while we were not running
+    if coredump_journal is not None:
+        unfinished = coredump_journal.unfinished()
+        for path_to_core in find_coredumps(coredump_filter):
+            if path_to_core not in unfinished:
+                unfinished.append(path_to_core)
+        print("Checking %d existing coredumps against the journal" % len(unfinished))
+        for path_to_core in unfinished:
+            pending.created(path_to_core)
+
+    print(
+        "Watchdog started, looking for new coredumps in : %s"
+        % ", ".join(coredump_filter.watch_dirs)
+    )
     print("Press ctrl+c to stop\n")
 
     try:
-        signal.pause()
+        while True:
+            time.sleep(1)
+            pending.poll()
+            metrics.set_gauge("queue_depth", pool.queue.qsize())
+            metrics.set_gauge("pending_cores", len(pending.pending))
+            uploader.flush_aggregates()
+            if retention_manager is not None:
+                retention_manager.enforce()
     except (KeyboardInterrupt, SystemExit):
         observer.stop()
         observer.join()
+        pool.stop()
+        uploader.close()
+        uploader.flush_aggregates(force=True)
+        print("Sending the remaining events...")
+        sentry_sdk.flush(timeout=context.obj["flush_timeout"])
+        if coredump_journal is not None:
+            coredump_journal.close()
         print("")
 
 
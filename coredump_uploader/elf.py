@@ -0,0 +1,352 @@
+"""Minimal reader for ELF files and core dumps.
+
+Only the bits the uploader needs are parsed: the file header, program and
+section headers and note entries. Files are memory-mapped, so only the pages
+that are actually touched get read from disk.
+"""
+import binascii
+import mmap
+import struct
+from collections import OrderedDict
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_CORE = 4
+
+EM_386 = 3
+EM_ARM = 40
+EM_X86_64 = 62
+EM_AARCH64 = 183
+
+PT_LOAD = 1
+PT_NOTE = 4
+SHT_NOTE = 7
+
+NT_PRSTATUS = 1
+NT_GNU_BUILD_ID = 3
+NT_AUXV = 6
+NT_FILE = 0x46494C45
+
+AT_NULL = 0
+AT_ENTRY = 9
+
+# Offset of pr_reg in the prstatus struct and index of the program counter in it
+_prstatus_pc = {
+    EM_386: (72, 12),
+    EM_ARM: (72, 15),
+    EM_X86_64: (112, 16),
+    EM_AARCH64: (112, 32),
+}
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+    def __init__(self, data):
+        if len(data) < 52 or data[:4] != b"\x7fELF":
+            raise ElfError("not an ELF file")
+
+        self.data = data
+        self.elf_class = bytearray(data[4:5])[0]
+        elf_data = bytearray(data[5:6])[0]
+        if self.elf_class not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError("unknown ELF class %d" % self.elf_class)
+        if elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ElfError("unknown ELF data encoding %d" % elf_data)
+        self.endian = "<" if elf_data == ELFDATA2LSB else ">"
+
+        if self.elf_class == ELFCLASS64:
+            header = self.unpack("HHIQQQIHHHHHH", 16)
+        else:
+            header = self.unpack("HHIIIIIHHHHHH", 16)
+        (
+            self.type,
+            self.machine,
+            _,
+            self.entry,
+            self.phoff,
+            self.shoff,
+            _,
+            _,
+            self.phentsize,
+            self.phnum,
+            self.shentsize,
+            self.shnum,
+            _,
+        ) = header
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps the file at path, use close() to release it"""
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                raise ElfError("empty file")
+        try:
+            return cls(data)
+        except Exception:
+            data.close()
+            raise
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        if offset < 0 or offset + struct.calcsize(fmt) > len(self.data):
+            raise ElfError("truncated ELF file")
+        return struct.unpack_from(fmt, self.data, offset)
+
+    @property
+    def word(self):
+        """struct format of an address sized word"""
+        return "Q" if self.elf_class == ELFCLASS64 else "I"
+
+    def program_headers(self):
+        """Returns (type, offset, vaddr, filesz, memsz, align) per segment"""
+        headers = []
+        for i in range(self.phnum):
+            offset = self.phoff + i * self.phentsize
+            if self.elf_class == ELFCLASS64:
+                p_type, _, p_offset, p_vaddr, _, p_filesz, p_memsz, p_align = self.unpack(
+                    "IIQQQQQQ", offset
+                )
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, _, p_align = self.unpack(
+                    "IIIIIIII", offset
+                )
+            headers.append((p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_align))
+        return headers
+
+    def section_headers(self):
+        """Returns (type, offset, size, align) per section"""
+        headers = []
+        for i in range(self.shnum):
+            offset = self.shoff + i * self.shentsize
+            if self.elf_class == ELFCLASS64:
+                _, sh_type, _, _, sh_offset, sh_size, _, _, sh_align, _ = self.unpack(
+                    "IIQQQQIIQQ", offset
+                )
+            else:
+                _, sh_type, _, _, sh_offset, sh_size, _, _, sh_align, _ = self.unpack(
+                    "IIIIIIIIII", offset
+                )
+            headers.append((sh_type, sh_offset, sh_size, sh_align))
+        return headers
+
+    def parse_notes(self, offset, size, align=4):
+        """Yields (name, type, desc offset, desc size) for every note in the range"""
+        align = 8 if align == 8 else 4
+        end = min(offset + size, len(self.data))
+        while offset + 12 <= end:
+            namesz, descsz, note_type = self.unpack("III", offset)
+            offset += 12
+            name = bytes(self.data[offset : offset + namesz]).rstrip(b"\0")
+            offset += (namesz + align - 1) & ~(align - 1)
+            desc_offset = offset
+            offset += (descsz + align - 1) & ~(align - 1)
+            if desc_offset + descsz > end:
+                break
+            yield name, note_type, desc_offset, descsz
+
+    def iter_notes(self):
+        """Yields (name, type, desc offset, desc size) from the note segments.
+
+        Falls back to the note sections for files without program headers.
+        """
+        segments = [
+            (offset, size, align)
+            for p_type, offset, _, size, _, align in self.program_headers()
+            if p_type == PT_NOTE
+        ]
+        if not segments:
+            segments = [
+                (offset, size, align)
+                for sh_type, offset, size, align in self.section_headers()
+                if sh_type == SHT_NOTE
+            ]
+        for offset, size, align in segments:
+            for note in self.parse_notes(offset, size, align):
+                yield note
+
+    def build_id(self):
+        """Returns the GNU build-id as hex string or None"""
+        for name, note_type, offset, size in self.iter_notes():
+            if name == b"GNU" and note_type == NT_GNU_BUILD_ID:
+                return binascii.hexlify(bytes(self.data[offset : offset + size])).decode(
+                    "ascii"
+                )
+        return None
+
+
+class ThreadStatus(object):
+    def __init__(self, pid, signal, pc):
+        self.pid = pid
+        self.signal = signal
+        self.pc = pc
+
+
+class CoreFile(ElfFile):
+    """Reads the process information the kernel stores in the notes of a core"""
+
+    def __init__(self, data):
+        super(CoreFile, self).__init__(data)
+        if self.type != ET_CORE:
+            raise ElfError("not a core file")
+
+    def threads(self):
+        """Returns a ThreadStatus per NT_PRSTATUS note, the crashed thread first"""
+        threads = []
+        pr_reg, pc_index = _prstatus_pc.get(self.machine, (None, None))
+        word_size = 8 if self.elf_class == ELFCLASS64 else 4
+        # pr_pid follows elf_siginfo, pr_cursig and the two signal masks
+        pr_pid = 16 + 2 * word_size
+        for name, note_type, offset, size in self.iter_notes():
+            if name != b"CORE" or note_type != NT_PRSTATUS or size < pr_pid + 4:
+                continue
+            signal = self.unpack("h", offset + 12)[0]
+            pid = self.unpack("i", offset + pr_pid)[0]
+            pc = None
+            if pr_reg is not None and pr_reg + (pc_index + 1) * word_size <= size:
+                pc = self.unpack(self.word, offset + pr_reg + pc_index * word_size)[0]
+            threads.append(ThreadStatus(pid, signal, pc))
+        return threads
+
+    def read_memory(self, address, size):
+        """Returns up to size bytes of process memory, None if it wasn't dumped"""
+        for p_type, offset, vaddr, filesz, _, _ in self.program_headers():
+            if p_type == PT_LOAD and vaddr <= address < vaddr + filesz:
+                size = min(size, vaddr + filesz - address)
+                offset += address - vaddr
+                return bytes(self.data[offset : offset + size])
+        return None
+
+    def auxv(self):
+        """Returns the auxiliary vector of the process as dict"""
+        word = self.word
+        entry_size = 2 * struct.calcsize(word)
+        for name, note_type, offset, size in self.iter_notes():
+            if name != b"CORE" or note_type != NT_AUXV:
+                continue
+            auxv = {}
+            for entry in range(offset, offset + size - entry_size + 1, entry_size):
+                key, value = self.unpack(word * 2, entry)
+                if key == AT_NULL:
+                    break
+                auxv[key] = value
+            return auxv
+        return {}
+
+    def mapped_files(self):
+        """Returns (start, end, file offset, path) per file mapping of NT_FILE"""
+        word = self.word
+        word_size = struct.calcsize(word)
+        for name, note_type, offset, size in self.iter_notes():
+            if name != b"CORE" or note_type != NT_FILE:
+                continue
+            end = offset + size
+            count, page_size = self.unpack(word * 2, offset)
+            offset += 2 * word_size
+            if offset + count * 3 * word_size > end:
+                raise ElfError("truncated NT_FILE note")
+            ranges = [
+                self.unpack(word * 3, offset + i * 3 * word_size) for i in range(count)
+            ]
+            names = bytes(self.data[offset + count * 3 * word_size : end]).split(b"\0")
+            return [
+                (start, stop, file_offset * page_size, path.decode("utf-8", "replace"))
+                for (start, stop, file_offset), path in zip(ranges, names)
+            ]
+        return []
+
+
+class Module(object):
+    def __init__(self, path, start, end, build_id=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.build_id = build_id
+
+
+def get_modules(core, page_size=4096):
+    """Returns the ELF modules mapped into the crashed process.
+
+    Modules are taken from the NT_FILE note. The build-id is read from the ELF
+    headers dumped into the core and falls back to the file on disk. Mapped
+    files that aren't ELF files, like locale archives, are skipped.
+    """
+    modules = OrderedDict()
+    for start, end, offset, path in core.mapped_files():
+        module = modules.get(path)
+        if module is None:
+            modules[path] = Module(path, start, end)
+        else:
+            module.start = min(module.start, start)
+            module.end = max(module.end, end)
+
+    result = []
+    for module in modules.values():
+        try:
+            module.build_id = read_build_id(core, module, page_size)
+        except ElfError:
+            continue
+        if module.build_id is not None:
+            result.append(module)
+    return result
+
+
+def read_build_id(core, module, page_size=4096):
+    """Returns the build-id of a module from the core or else from the disk.
+
+    Raises ElfError if the dumped header shows that it isn't an ELF file.
+    """
+    header = core.read_memory(module.start, page_size)
+    if header is not None:
+        build_id = ElfFile(header).build_id()
+        if build_id is not None:
+            return build_id
+    return get_build_id(module.path)
+
+
+def get_executable(core, page_size=4096):
+    """Returns the Module of the crashed executable, found by its entry point"""
+    entry = core.auxv().get(AT_ENTRY)
+    if entry is None:
+        return None
+    mappings = core.mapped_files()
+    paths = [path for start, end, _, path in mappings if start <= entry < end]
+    if not paths:
+        return None
+    # The ELF header is at the start of the first mapping of the file
+    ranges = [(start, end) for start, end, _, path in mappings if path == paths[0]]
+    module = Module(
+        paths[0], min(start for start, _ in ranges), max(end for _, end in ranges)
+    )
+    try:
+        module.build_id = read_build_id(core, module, page_size)
+    except ElfError:
+        return None
+    return module
+
+
+def get_build_id(path):
+    """Returns the GNU build-id of an ELF file or None"""
+    try:
+        with ElfFile.open(path) as elf:
+            return elf.build_id()
+    except (IOError, OSError, ElfError):
+        return None
@@ -0,0 +1,208 @@
+"""Sends events together with the compressed core dump as Sentry envelope.
+
+The core is streamed through the compressor into a temporary file and from
+there into the HTTP request, so it is never loaded into memory as a whole.
+"""
+import json
+import os
+import tempfile
+import zlib
+
+import urllib3
+from sentry_sdk.utils import Dsn
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1 << 20
+
+_zeros = bytearray(CHUNK_SIZE)
+
+_content_types = {
+    "gzip": ("gz", "application/gzip"),
+    "zstd": ("zst", "application/zstd"),
+}
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def get_compressor(compression):
+    """Returns a compressor object with compress() and flush()"""
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compressobj()
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raise ValueError("unknown compression %r" % compression)
+
+
+def iter_chunks(f, chunk_size=CHUNK_SIZE):
+    """Yields the content of a file in chunks.
+
+    Holes of sparse files, which the kernel leaves for unused memory when it
+    writes a core, are yielded as zeros without reading them from disk.
+    """
+    fd = f.fileno()
+    size = os.fstat(fd).st_size
+    offset = 0
+    while offset < size:
+        data_end = size
+        if hasattr(os, "SEEK_DATA"):
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # there is only a hole left
+                data_start = size
+            if data_start > offset:
+                while offset < data_start:
+                    length = min(chunk_size, data_start - offset)
+                    yield memoryview(_zeros)[:length]
+                    offset += length
+                continue
+            data_end = os.lseek(fd, offset, os.SEEK_HOLE)
+        os.lseek(fd, offset, os.SEEK_SET)
+        while offset < data_end:
+            chunk = os.read(fd, min(chunk_size, data_end - offset))
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+
+class CoreAttachment(object):
+    """A compressed core dump in a temporary file"""
+
+    def __init__(self, path_to_core, compression="gzip", max_size=None):
+        extension, self.content_type = _content_types[compression]
+        self.filename = "%s.%s" % (os.path.basename(path_to_core), extension)
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        try:
+            self.compress(path_to_core, compression, max_size)
+        except Exception:
+            self.close()
+            raise
+
+    def compress(self, path_to_core, compression, max_size):
+        compressor = get_compressor(compression)
+        with open(path_to_core, "rb") as f:
+            for chunk in iter_chunks(f):
+                self.write(compressor.compress(chunk), max_size)
+        self.write(compressor.flush(), max_size)
+        self.file.seek(0)
+
+    def write(self, data, max_size):
+        self.file.write(data)
+        self.size += len(data)
+        if max_size is not None and self.size > max_size:
+            raise AttachmentTooLarge(
+                "compressed core is larger than %d bytes" % max_size
+            )
+
+    def close(self):
+        self.file.close()
+
+
+class ChainedReader(object):
+    """File-like object reading from a list of byte strings and files"""
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    def read(self, size=-1):
+        while self.parts:
+            part = self.parts[0]
+            if isinstance(part, bytes):
+                data = part if size < 0 else part[:size]
+                rest = part[len(data) :]
+                if rest:
+                    self.parts[0] = rest
+                else:
+                    self.parts.pop(0)
+            else:
+                data = part.read(size)
+                if not data:
+                    self.parts.pop(0)
+                    continue
+            return data
+        return b""
+
+
+def item_header(**headers):
+    return json.dumps(headers).encode("utf-8") + b"\n"
+
+
+def to_json(obj):
+    """Converts the Frame, Stacktrace, Thread and Image objects of an event"""
+    convert = getattr(obj, "to_json", None)
+    if convert is None:
+        raise TypeError("%r is not JSON serializable" % (obj,))
+    return convert()
+
+
+def dump_event(event):
+    """Serializes an event in a single pass.
+
+    The event may contain the model objects, each is converted while it's
+    written and left unchanged, so the same event can be serialized again.
+    """
+    return json.dumps(event, default=to_json, separators=(",", ":")).encode("utf-8")
+
+
+def build_event_envelope(event):
+    """Returns the envelope body with just the event"""
+    payload = dump_event(event)
+    return b"".join(
+        [
+            item_header(event_id=event["event_id"]),
+            item_header(type="event", length=len(payload)),
+            payload,
+            b"\n",
+        ]
+    )
+
+
+def build_envelope(event, attachment):
+    """Returns the envelope body as file-like object and its length"""
+    payload = dump_event(event)
+    parts = [
+        item_header(event_id=event["event_id"]),
+        item_header(type="event", length=len(payload)),
+        payload,
+        b"\n",
+        item_header(
+            type="attachment",
+            length=attachment.size,
+            filename=attachment.filename,
+            content_type=attachment.content_type,
+            attachment_type="event.attachment",
+        ),
+        attachment.file,
+        b"\n",
+    ]
+    length = sum(len(part) for part in parts if isinstance(part, bytes))
+    return ChainedReader(parts), length + attachment.size
+
+
+def send_envelope(dsn, body, length, http=None):
+    """Posts an envelope to sentry, returns the HTTP status"""
+    auth = Dsn(dsn).to_auth("coredump.uploader.sdk/0.0.1")
+    if http is None:
+        http = urllib3.PoolManager()
+    response = http.urlopen(
+        "POST",
+        auth.get_api_url("envelope"),
+        body=body,
+        headers={
+            "Content-Type": "application/x-sentry-envelope",
+            "Content-Length": str(length),
+            "X-Sentry-Auth": auth.to_header(),
+        },
+        preload_content=True,
+    )
+    return response.status
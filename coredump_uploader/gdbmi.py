@@ -0,0 +1,318 @@
+"""Persistent gdb processes driven through the GDB/MI interface.
+
+Starting gdb and loading the symbols of a large executable takes much longer
+than walking the stacks of a core. A `GdbSession` keeps gdb running with the
+executable loaded and only switches the core file, and `GdbSessionPool` hands
+out idle sessions to the workers. The output are structured MI records instead
+of text meant for humans.
+"""
+import codecs
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from coredump_uploader.limits import ChildWatchdog
+
+if sys.version_info >= (3, 0):
+    text_type = str
+else:
+    text_type = unicode  # noqa: F821
+
+_c_string_re = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_variable_re = re.compile(r"([a-zA-Z_][\w-]*)=")
+_record_re = re.compile(r"^(?P<token>\d*)(?P<kind>[\^*+=])(?P<class>[\w-]+),?")
+
+
+class GdbMiError(Exception):
+    pass
+
+
+class GdbMiTimeout(GdbMiError):
+    """gdb was killed because it didn't finish loading the executable in time"""
+
+
+class MiRecord(object):
+    """A result or async record: ^done,..., *stopped,..., =thread-created,..."""
+
+    def __init__(self, token, kind, record_class, results):
+        self.token = token
+        self.kind = kind
+        self.record_class = record_class
+        self.results = results
+
+
+class MiResult(object):
+    """The result of a command together with the console output it caused"""
+
+    def __init__(self, record_class, results, console):
+        self.record_class = record_class
+        self.results = results
+        self.console = console
+
+
+def unescape(text):
+    if "\\" not in text:
+        return text
+    # Octal escapes encode the bytes of UTF-8 characters one by one
+    data = codecs.decode(text.encode("utf-8"), "unicode_escape")
+    return data.encode("latin-1").decode("utf-8", "replace")
+
+
+def quote(argument):
+    return '"%s"' % argument.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parse_value(text, pos):
+    """Parses a c-string, tuple or list, returns the value and the next position"""
+    char = text[pos]
+    if char == '"':
+        match = _c_string_re.match(text, pos)
+        if match is None:
+            raise GdbMiError("unterminated string in %r" % text)
+        return unescape(match.group(1)), match.end()
+    if char == "{":
+        return parse_results(text, pos + 1, "}")
+    if char == "[":
+        # Lists hold either values or results, results are reduced to values
+        values = []
+        pos += 1
+        while text[pos] != "]":
+            variable = _variable_re.match(text, pos)
+            if variable is not None:
+                pos = variable.end()
+            value, pos = parse_value(text, pos)
+            values.append(value)
+            if text[pos] == ",":
+                pos += 1
+        return values, pos + 1
+    raise GdbMiError("unexpected %r at %d in %r" % (char, pos, text))
+
+
+def parse_results(text, pos, end=None):
+    """Parses variable=value pairs up to the end character or end of text"""
+    results = {}
+    while pos < len(text) and text[pos] != end:
+        variable = _variable_re.match(text, pos)
+        if variable is None:
+            raise GdbMiError("expected a result at %d in %r" % (pos, text))
+        results[variable.group(1)], pos = parse_value(text, variable.end())
+        if pos < len(text) and text[pos] == ",":
+            pos += 1
+    return results, pos + 1
+
+
+def parse_record(line):
+    """Parses a line of MI output.
+
+    Returns a MiRecord, a (kind, text) tuple for stream records or None for
+    the prompt.
+    """
+    line = line.rstrip("\r\n")
+    if not line or line.startswith("(gdb)"):
+        return None
+    if line[0] in "~@&":
+        text = line[1:]
+        if text.startswith('"'):
+            text = parse_value(text, 0)[0]
+        return line[0], text
+    match = _record_re.match(line)
+    if match is None:
+        # Output of the program or gdb that doesn't follow the syntax
+        return "@", line
+    try:
+        results, _ = parse_results(line, match.end())
+    except IndexError:
+        raise GdbMiError("truncated record %r" % line)
+    return MiRecord(
+        match.group("token") or None,
+        match.group("kind"),
+        match.group("class"),
+        results,
+    )
+
+
+class GdbSession(object):
+    """A gdb process with the executable loaded that analyzes one core at a time.
+
+    gdb is killed if loading the executable takes longer than timeout.
+    """
+
+    def __init__(self, arguments, timeout=None):
+        with open(os.devnull, "w") as devnull:
+            self.process = subprocess.Popen(
+                arguments,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+            )
+        self.key = None
+        self.token = 0
+        self.uses = 0
+        self.register_names = None
+        # Waits for the symbols to be loaded
+        watchdog = ChildWatchdog(self.process, timeout)
+        try:
+            self.read_result(None)
+        except GdbMiError:
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            if watchdog.timed_out:
+                raise GdbMiTimeout("gdb timed out loading the executable")
+            raise
+        finally:
+            watchdog.cancel()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def read_result(self, token):
+        """Reads the records up to the result of the command and its prompt"""
+        console = []
+        result = None
+        for line in iter(self.process.stdout.readline, b""):
+            line = line.decode("utf-8", "replace")
+            if line.startswith("(gdb)"):
+                if token is None or result is not None:
+                    return result, "".join(console)
+                continue
+            record = parse_record(line)
+            if isinstance(record, MiRecord):
+                if record.kind == "^" and record.token == token:
+                    result = record
+            elif record is not None and record[0] == "~":
+                console.append(record[1])
+        raise GdbMiError("gdb exited unexpectedly")
+
+    def command(self, command):
+        """Runs an MI command and returns its MiResult"""
+        self.token += 1
+        token = str(self.token)
+        try:
+            self.process.stdin.write(("%s%s\n" % (token, command)).encode("utf-8"))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            raise GdbMiError("gdb exited unexpectedly")
+        result, console = self.read_result(token)
+        if result.record_class == "error":
+            raise GdbMiError(result.results.get("msg", "%s failed" % command))
+        return MiResult(result.record_class, result.results, console)
+
+    def console(self, command):
+        """Runs a CLI command and returns its output"""
+        return self.command("-interpreter-exec console %s" % quote(command)).console
+
+    def load_core(self, path_to_core):
+        """Switches to the core, returns what gdb prints about it"""
+        self.uses += 1
+        return self.command("-target-select core %s" % quote(path_to_core)).console
+
+    def unload_core(self):
+        self.console("core-file")
+
+    def thread_info(self):
+        """Returns the threads and the id of the current thread"""
+        results = self.command("-thread-info").results
+        return results.get("threads", []), results.get("current-thread-id")
+
+    def frames(self, thread_id=None):
+        command = "-stack-list-frames"
+        if thread_id is not None:
+            command += " --thread %s" % thread_id
+        return self.command(command).results.get("stack", [])
+
+    def registers(self, thread_id=None):
+        """Returns (name, value) of the registers of the innermost frame in hex.
+
+        Vector registers are skipped, their values are tuples.
+        """
+        if self.register_names is None:
+            names = self.command("-data-list-register-names").results
+            self.register_names = names.get("register-names", [])
+        command = "-data-list-register-values"
+        if thread_id is not None:
+            command += " --thread %s --frame 0" % thread_id
+        values = self.command(command + " --skip-unavailable x")
+        registers = []
+        for register in values.results.get("register-values", []):
+            number = int(register["number"])
+            value = register.get("value")
+            if number >= len(self.register_names) or not self.register_names[number]:
+                continue
+            if isinstance(value, text_type) and value.startswith("0x"):
+                registers.append((self.register_names[number], value))
+        return registers
+
+    def version(self):
+        return self.command("-gdb-version").console
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write(b"-gdb-exit\n")
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            # Popen.wait() has no timeout on Python 2
+            with ChildWatchdog(self.process, 5):
+                self.process.wait()
+        self.process.stdout.close()
+
+
+class GdbSessionPool(object):
+    """Hands out idle gdb sessions per executable.
+
+    Sessions are started by factory(path_to_executable) when none is idle.
+    They are replaced after max_uses cores to keep the memory of gdb in check,
+    and when the executable was changed since they loaded it.
+    """
+
+    def __init__(self, factory, max_idle=4, max_uses=1000):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, path_to_executable):
+        try:
+            return path_to_executable, os.stat(path_to_executable).st_mtime
+        except OSError:
+            return path_to_executable, None
+
+    def acquire(self, path_to_executable):
+        key = self.get_key(path_to_executable)
+        stale = []
+        session = None
+        with self.lock:
+            for other in list(self.idle):
+                if other[0] == path_to_executable and other != key:
+                    stale.extend(self.idle.pop(other))
+            sessions = self.idle.get(key)
+            if sessions:
+                session = sessions.pop()
+        for old in stale:
+            old.close()
+        if session is None:
+            session = self.factory(path_to_executable)
+            session.key = key
+        return session
+
+    def release(self, session, reusable=True):
+        """Returns a session, closes it if it failed or isn't needed anymore"""
+        if reusable and session.alive() and session.uses < self.max_uses:
+            with self.lock:
+                sessions = self.idle.setdefault(session.key, [])
+                if len(sessions) < self.max_idle:
+                    sessions.append(session)
+                    return
+        session.close()
+
+    def close(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle = {}
+        for session in sessions:
+            session.close()
@@ -0,0 +1,88 @@
+"""Durable record of the coredumps seen by the watcher.
+
+Every coredump goes through the states discovered -> processing -> done (or
+failed). After a restart, coredumps that never reached done or failed are
+processed again, so nothing found while the uploader was busy or down gets
+lost.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+DISCOVERED = "discovered"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+class CoredumpJournal(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS coredumps (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def discover(self, path):
+        """Records a coredump, returns False if it was already processed.
+
+        A file with the same path but a different mtime is a new coredump.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mtime, state FROM coredumps WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None and row[0] == mtime and row[1] in (DONE, FAILED):
+                return False
+            if row is None or row[0] != mtime:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO coredumps VALUES (?, ?, ?, ?)",
+                    (path, mtime, DISCOVERED, time.time()),
+                )
+            return True
+
+    def set_state(self, path, state):
+        with self.lock:
+            self.db.execute(
+                "UPDATE coredumps SET state = ?, updated = ? WHERE path = ?",
+                (state, time.time(), path),
+            )
+
+    def get_state(self, path):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT state FROM coredumps WHERE path = ?", (path,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def unfinished(self):
+        """Returns the coredumps that were discovered or in flight, oldest first"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path FROM coredumps WHERE state IN (?, ?) ORDER BY updated",
+                (DISCOVERED, PROCESSING),
+            ).fetchall()
+        return [path for (path,) in rows]
+
+    def prune(self):
+        """Removes the entries of coredumps that don't exist anymore"""
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM coredumps").fetchall()
+            for (path,) in rows:
+                if not os.path.isfile(path):
+                    self.db.execute("DELETE FROM coredumps WHERE path = ?", (path,))
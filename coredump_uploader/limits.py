@@ -0,0 +1,122 @@
+"""Keeps gdb, eu-unstrip and file from taking over the host during crash storms.
+
+The children run with a lower CPU priority (nice), an I/O scheduling class
+(ionice), a limit of their address space (RLIMIT_AS) and a timeout after which
+they are killed. The analysis then goes on with the output read so far.
+
+The limits are applied by prefixing the command with nice, ionice and prlimit,
+which execute it in place. A preexec_fn isn't safe while the uploader runs
+threads, the forked child could deadlock.
+"""
+import subprocess
+import threading
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+
+def find_tool(name):
+    path = which(name)
+    if path is None:
+        raise OSError("%s was not found" % name)
+    return path
+
+
+class ChildTimeout(Exception):
+    """A child was killed after the timeout, output is what it printed until then"""
+
+    def __init__(self, name, output=""):
+        Exception.__init__(self, "%s timed out" % name)
+        self.name = name
+        self.output = output
+
+
+class ChildLimits(object):
+    """Priority and resource limits of the child processes.
+
+    Unset limits aren't applied, the children then inherit them from us.
+    """
+
+    def __init__(
+        self,
+        nice=None,
+        ionice_class=None,
+        ionice_level=None,
+        max_memory=None,
+        timeout=None,
+    ):
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.nice_path = None
+        self.ionice = None
+        self.prlimit = None
+        if nice is not None:
+            self.nice_path = find_tool("nice")
+        if ionice_class is not None or ionice_level is not None:
+            self.ionice = find_tool("ionice")
+        if max_memory is not None:
+            self.prlimit = find_tool("prlimit")
+
+    def get_arguments(self, arguments):
+        """Prefixes the command with nice, ionice and prlimit"""
+        prefix = []
+        if self.nice_path is not None:
+            prefix += [self.nice_path, "-n", str(self.nice)]
+        if self.ionice is not None:
+            ionice_class = IONICE_CLASSES[self.ionice_class or "best-effort"]
+            prefix += [self.ionice, "-c", ionice_class]
+            if self.ionice_level is not None and self.ionice_class != "idle":
+                prefix += ["-n", str(self.ionice_level)]
+        if self.prlimit is not None:
+            prefix += [self.prlimit, "--as=%d" % self.max_memory]
+        return prefix + list(arguments)
+
+    def popen(self, arguments, **kwargs):
+        return subprocess.Popen(self.get_arguments(arguments), **kwargs)
+
+    def watch(self, process):
+        """Returns a started ChildWatchdog for the process"""
+        return ChildWatchdog(process, self.timeout)
+
+
+class ChildWatchdog(object):
+    """Kills a child process that is still running after the timeout.
+
+    Also works for children that are read line by line, where communicate()
+    with a timeout doesn't help.
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timed_out = False
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        if self.process.poll() is not None:
+            return
+        self.timed_out = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cancel()
@@ -0,0 +1,263 @@
+"""Counters, gauges and histograms of the uploader pipeline.
+
+The metrics are kept in a process wide registry, like the SDK keeps its client,
+so every part of the pipeline can record them without passing a registry
+around. They are exposed in the Prometheus text format by `start_http_server`
+and, after `configure_statsd`, also sent to StatsD as they are recorded.
+"""
+import socket
+import threading
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from coredump_uploader import tracing
+
+PREFIX = "coredump_uploader_"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (1e6, 1e7, 1e8, 1e9, 1e10, 1e11)
+
+# name: (type, help, label names, buckets)
+METRICS = {
+    "stage_seconds": (
+        HISTOGRAM,
+        "Time spent in each stage of processing a coredump",
+        ("stage",),
+        SECONDS_BUCKETS,
+    ),
+    "core_size_bytes": (
+        HISTOGRAM,
+        "Size of the processed coredumps",
+        (),
+        BYTES_BUCKETS,
+    ),
+    "cores_total": (
+        COUNTER,
+        "Processed coredumps by result: uploaded, duplicate, sampled or failed",
+        ("result",),
+        None,
+    ),
+    "subprocess_failures_total": (
+        COUNTER,
+        "gdb, eu-unstrip and file runs that failed to start, failed or timed out",
+        ("tool", "reason"),
+        None,
+    ),
+    "events_dropped_total": (
+        COUNTER,
+        "Events that were not sent to Sentry",
+        ("reason",),
+        None,
+    ),
+    "queue_depth": (GAUGE, "Coredumps waiting for a worker", (), None),
+    "pending_cores": (GAUGE, "Coredumps still being written", (), None),
+}
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class StatsdClient(object):
+    """Sends metrics as StatsD lines over UDP, label values become name parts"""
+
+    def __init__(self, host, port, prefix="coredump_uploader"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, labels, value, kind):
+        parts = [self.prefix, name] + [
+            str(label).replace(".", "_").replace(":", "_") for label in labels
+        ]
+        line = "%s:%s|%s" % (".".join(parts), value, kind)
+        try:
+            self.socket.sendto(line.encode("utf-8"), self.address)
+        except (IOError, OSError):
+            pass
+
+    def record(self, metric_type, name, labels, value):
+        if metric_type == COUNTER:
+            self.send(name, labels, value, "c")
+        elif metric_type == GAUGE:
+            self.send(name, labels, value, "g")
+        elif name.endswith("_seconds"):
+            self.send(name[: -len("_seconds")], labels, int(value * 1000), "ms")
+        else:
+            self.send(name, labels, value, "h")
+
+
+class Registry(object):
+    def __init__(self):
+        self.values = {}
+        self.statsd = None
+        self.lock = threading.Lock()
+
+    def record(self, name, value, labels):
+        metric_type, _, label_names, buckets = METRICS[name]
+        key = (name, tuple(labels.get(label, "") for label in label_names))
+        with self.lock:
+            if metric_type == COUNTER:
+                self.values[key] = self.values.get(key, 0) + value
+            elif metric_type == GAUGE:
+                self.values[key] = value
+            else:
+                histogram = self.values.get(key)
+                if histogram is None:
+                    histogram = self.values[key] = Histogram(buckets)
+                histogram.observe(value)
+        if self.statsd is not None:
+            self.statsd.record(metric_type, name, key[1], value)
+
+    def get(self, name, **labels):
+        label_names = METRICS[name][2]
+        key = (name, tuple(labels.get(label, "") for label in label_names))
+        with self.lock:
+            return self.values.get(key)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format"""
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: item[0])
+            lines = []
+            for name in sorted(METRICS):
+                metric_type, help_text, label_names, _ = METRICS[name]
+                lines.append("# HELP %s%s %s" % (PREFIX, name, help_text))
+                lines.append("# TYPE %s%s %s" % (PREFIX, name, metric_type))
+                for (value_name, label_values), value in values:
+                    if value_name != name:
+                        continue
+                    labels = list(zip(label_names, label_values))
+                    if metric_type != HISTOGRAM:
+                        lines.append(format_sample(name, labels, value))
+                        continue
+                    lines.extend(format_histogram(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+def format_histogram(name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        le = [("le", format_value(bound))]
+        yield format_sample(name + "_bucket", labels + le, cumulative)
+    inf = [("le", "+Inf")]
+    yield format_sample(name + "_bucket", labels + inf, histogram.count)
+    yield format_sample(name + "_sum", labels, histogram.sum)
+    yield format_sample(name + "_count", labels, histogram.count)
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_sample(name, labels, value):
+    if labels:
+        label_text = ",".join(
+            '%s="%s"' % (label, escape(label_value)) for label, label_value in labels
+        )
+        return "%s%s{%s} %s" % (PREFIX, name, label_text, format_value(value))
+    return "%s%s %s" % (PREFIX, name, format_value(value))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    _registry.record(name, value, labels)
+
+
+def set_gauge(name, value, **labels):
+    _registry.record(name, value, labels)
+
+
+def observe(name, value, **labels):
+    _registry.record(name, value, labels)
+
+
+def get(name, **labels):
+    """Returns the value of a counter or gauge, or the Histogram"""
+    return _registry.get(name, **labels)
+
+
+@contextmanager
+def stage(name, **args):
+    """Measures the time of a stage of processing a coredump, also traced"""
+    span = None
+    try:
+        with tracing.span(name, **args) as span:
+            yield span
+    finally:
+        observe("stage_seconds", span.duration, stage=name)
+
+
+def render():
+    return _registry.render()
+
+
+def reset():
+    global _registry
+    _registry = Registry()
+
+
+def configure_statsd(address, prefix="coredump_uploader"):
+    """Sends the metrics also to the StatsD server at host:port"""
+    host, _, port = address.rpartition(":")
+    _registry.statsd = StatsdClient(host or "127.0.0.1", int(port), prefix)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address="127.0.0.1"):
+    """Serves /metrics for Prometheus from a background thread"""
+    server = MetricsServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    return server
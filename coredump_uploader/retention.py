@@ -0,0 +1,256 @@
+"""Keeps the coredumps from filling up the disk.
+
+After a coredump was processed it is kept, deleted, compressed or moved as the
+policy says. On top of that the watched directories are held within a size and
+count budget. Duplicates are evicted first, then other processed coredumps and
+archives, then failed ones and only then coredumps that weren't processed yet,
+oldest first within each group.
+
+When free space runs low, processed coredumps are deleted right away whatever
+the policy, and the budget is enforced after every coredump instead of
+periodically.
+"""
+import os
+import re
+import shutil
+import threading
+import time
+
+from coredump_uploader import journal
+from coredump_uploader.envelope import get_compressor, iter_chunks
+
+KEEP = "keep"
+DELETE = "delete"
+COMPRESS = "compress"
+MOVE = "move"
+POLICIES = (KEEP, DELETE, COMPRESS, MOVE)
+
+_extensions = {"gzip": ".gz", "zstd": ".zst"}
+
+# Eviction order
+DUPLICATE = 0
+PROCESSED = 1
+FAILED = 2
+UNPROCESSED = 3
+
+
+def get_exclude(compression):
+    """Returns a regex for the compressed coredumps, which aren't new ones"""
+    return r".*%s(\.tmp)?$" % re.escape(_extensions[compression])
+
+
+def get_free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_unique_path(path):
+    """Appends a counter to the path if the file exists already"""
+    candidate = path
+    counter = 0
+    while os.path.exists(candidate):
+        counter += 1
+        candidate = "%s.%d" % (path, counter)
+    return candidate
+
+
+def compress_file(path, destination, compression="gzip"):
+    """Writes a compressed copy of the file, keeping its mtime"""
+    compressor = get_compressor(compression)
+    temporary = destination + ".tmp"
+    try:
+        with open(path, "rb") as source, open(temporary, "wb") as target:
+            for chunk in iter_chunks(source):
+                target.write(compressor.compress(chunk))
+            target.write(compressor.flush())
+        stat = os.stat(path)
+        os.utime(temporary, (stat.st_atime, stat.st_mtime))
+        os.rename(temporary, destination)
+    except Exception:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+class RetentionManager(object):
+    """Applies the retention policy and the disk budget to the coredumps.
+
+    coredump_filter tells which files in the watched directories are
+    coredumps, archive_dir receives moved and compressed coredumps.
+    """
+
+    def __init__(
+        self,
+        coredump_filter,
+        policy=KEEP,
+        archive_dir=None,
+        compression="gzip",
+        max_total_size=None,
+        max_count=None,
+        min_free_space=None,
+        journal=None,
+        interval=10,
+    ):
+        if policy == MOVE and archive_dir is None:
+            raise ValueError("moving coredumps requires an archive directory")
+        self.filter = coredump_filter
+        self.policy = policy
+        self.archive_dir = archive_dir and os.path.abspath(archive_dir)
+        self.compression = compression
+        self.max_total_size = max_total_size
+        self.max_count = max_count
+        self.min_free_space = min_free_space
+        self.journal = journal
+        self.interval = interval
+        self.next_enforce = 0
+        self.states = {}
+        self.processing = set()
+        self.lock = threading.Lock()
+        if archive_dir is not None and not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+
+    @property
+    def extension(self):
+        return _extensions[self.compression]
+
+    def under_pressure(self):
+        if self.min_free_space is None:
+            return False
+        try:
+            return get_free_space(self.filter.watch_dirs[0]) < self.min_free_space
+        except OSError:
+            return False
+
+    def started(self, path_to_core):
+        with self.lock:
+            self.processing.add(path_to_core)
+
+    def processed(self, path_to_core, duplicate=False, failed=False):
+        """Applies the policy to a coredump once the worker is done with it"""
+        with self.lock:
+            self.processing.discard(path_to_core)
+            if failed:
+                self.states[path_to_core] = FAILED
+            else:
+                self.states[path_to_core] = DUPLICATE if duplicate else PROCESSED
+
+        pressure = self.under_pressure()
+        if not failed:
+            try:
+                self.apply_policy(path_to_core, DELETE if pressure else self.policy)
+            except (IOError, OSError) as err:
+                print("Failed to clean up %s: %s" % (path_to_core, err))
+        if pressure:
+            self.enforce(force=True)
+
+    def apply_policy(self, path_to_core, policy):
+        if policy == KEEP:
+            return
+        if policy == DELETE:
+            os.remove(path_to_core)
+        elif policy == COMPRESS:
+            directory = self.archive_dir or os.path.dirname(path_to_core)
+            destination = os.path.join(
+                directory, os.path.basename(path_to_core) + self.extension
+            )
+            compress_file(path_to_core, get_unique_path(destination), self.compression)
+            os.remove(path_to_core)
+        elif policy == MOVE:
+            name = os.path.basename(path_to_core)
+            destination = os.path.join(self.archive_dir, name)
+            shutil.move(path_to_core, get_unique_path(destination))
+        with self.lock:
+            self.states.pop(path_to_core, None)
+
+    def get_rank(self, path):
+        rank = self.states.get(path)
+        if rank is not None:
+            return rank
+        # Coredumps processed before a restart
+        if self.journal is not None:
+            state = self.journal.get_state(path)
+            if state == journal.DONE:
+                return PROCESSED
+            if state == journal.FAILED:
+                return FAILED
+        return UNPROCESSED
+
+    def iter_files(self):
+        """Yields (rank, mtime, size, path) of coredumps and archives"""
+        directories = [(d, self.filter.recursive) for d in self.filter.watch_dirs]
+        if self.archive_dir is not None:
+            directories.append((self.archive_dir, True))
+        seen = set()
+        for directory, recursive in directories:
+            for root, dirnames, filenames in os.walk(directory):
+                if not recursive:
+                    del dirnames[:]
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if path in seen:
+                        continue
+                    seen.add(path)
+                    if self.filter.matches(path):
+                        rank = self.get_rank(path)
+                    elif self.is_archive(path):
+                        rank = PROCESSED
+                    else:
+                        continue
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield rank, stat.st_mtime, stat.st_size, path
+
+    def is_archive(self, path):
+        if self.archive_dir is not None and path.startswith(
+            os.path.join(self.archive_dir, "")
+        ):
+            return True
+        base, extension = os.path.splitext(path)
+        return extension == self.extension and self.filter.matches(base)
+
+    def over_budget(self, total_size, count):
+        if self.max_total_size is not None and total_size > self.max_total_size:
+            return True
+        return self.max_count is not None and count > self.max_count
+
+    def enforce(self, force=False, now=None):
+        """Evicts coredumps until they fit into the budget, returns their paths"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not force and now < self.next_enforce:
+                return []
+            self.next_enforce = now + self.interval
+        if (
+            self.max_total_size is None
+            and self.max_count is None
+            and self.min_free_space is None
+        ):
+            return []
+
+        files = sorted(self.iter_files())
+        total_size = sum(size for _, _, size, _ in files)
+        count = len(files)
+        pressure = self.under_pressure()
+        evicted = []
+        for rank, _, size, path in files:
+            if not pressure and not self.over_budget(total_size, count):
+                break
+            with self.lock:
+                if path in self.processing:
+                    continue
+                self.states.pop(path, None)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            count -= 1
+            evicted.append(path)
+            if pressure:
+                pressure = self.under_pressure()
+        if evicted:
+            print("Removed %d coredumps to free disk space" % len(evicted))
+        return evicted
@@ -0,0 +1,167 @@
+"""Bounds the work spent on coredumps when a bug crashes over and over.
+
+Every executable and every crash signature has a token bucket that caps the
+coredumps analyzed per minute. On top of that, signatures that crash more often
+than the target rate are sampled with a probability of target / observed rate,
+so a crash loop costs about as much as a handful of crashes. The coredumps that
+are left out are counted and reported periodically.
+"""
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+RATE_LIMITED = "rate_limited"
+SAMPLED = "sampled"
+
+
+class TokenBucket(object):
+    """Allows `rate` events per second on average and bursts of `burst`"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateEstimate(object):
+    """Number of events within the last `window` seconds, decaying exponentially"""
+
+    def __init__(self, window, now):
+        self.window = window
+        self.count = 0.0
+        self.updated = now
+
+    def add(self, now):
+        elapsed = max(now - self.updated, 0)
+        self.count = self.count * math.exp(-elapsed / self.window) + 1
+        self.updated = now
+        return self.count
+
+
+class SignatureState(object):
+    def __init__(self, bucket, estimate):
+        self.bucket = bucket
+        self.estimate = estimate
+
+
+class CrashSampler(object):
+    """Decides which coredumps are analyzed.
+
+    executable_rate and signature_rate are coredumps per minute, with bursts of
+    a minute's worth. sample_target is the number of coredumps per hour of one
+    signature that are all analyzed, more frequent crashes are sampled. Unset
+    limits don't apply. At most `max_keys` executables and signatures are
+    tracked, the least recently seen are forgotten.
+    """
+
+    def __init__(
+        self,
+        executable_rate=None,
+        signature_rate=None,
+        sample_target=None,
+        report_interval=300,
+        max_keys=1000,
+        random=random.random,
+    ):
+        self.executable_rate = executable_rate
+        self.signature_rate = signature_rate
+        self.sample_target = sample_target
+        self.report_interval = report_interval
+        self.max_keys = max_keys
+        self.random = random
+        self.executables = OrderedDict()
+        self.signatures = OrderedDict()
+        self.skipped = {}
+        self.next_report = None
+        self.lock = threading.Lock()
+
+    def get_bucket(self, rate, now):
+        if rate is None:
+            return None
+        return TokenBucket(rate / 60.0, max(rate, 1), now)
+
+    def get_entry(self, entries, key, factory):
+        entry = entries.pop(key, None)
+        if entry is None:
+            entry = factory()
+        entries[key] = entry
+        while len(entries) > self.max_keys:
+            entries.popitem(last=False)
+        return entry
+
+    def sample(self, executable, signature=None, check_executable=True, now=None):
+        """Returns True if the coredump should be analyzed, counts it otherwise.
+
+        The signature is checked first so that its crash loop doesn't use up
+        the tokens of the executable. Signatures should include the build-id,
+        the same stack in two executables is a different crash.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.next_report is None:
+                self.next_report = now + self.report_interval
+            reason = None
+            if signature is not None:
+                reason = self.sample_signature(signature, now)
+            if reason is None and check_executable and self.executable_rate:
+                bucket = self.get_entry(
+                    self.executables,
+                    executable,
+                    lambda: self.get_bucket(self.executable_rate, now),
+                )
+                if not bucket.take(now):
+                    reason = RATE_LIMITED
+            if reason is None:
+                return True
+            key = (executable, signature, reason)
+            self.skipped[key] = self.skipped.get(key, 0) + 1
+            return False
+
+    def sample_signature(self, signature, now):
+        if self.signature_rate is None and self.sample_target is None:
+            return None
+        state = self.get_entry(
+            self.signatures,
+            signature,
+            lambda: SignatureState(
+                self.get_bucket(self.signature_rate, now), RateEstimate(3600, now)
+            ),
+        )
+        rate = state.estimate.add(now)
+        if self.sample_target is not None and rate > self.sample_target:
+            if self.random() >= self.sample_target / rate:
+                return SAMPLED
+        if state.bucket is not None and not state.bucket.take(now):
+            return RATE_LIMITED
+        return None
+
+    def pop_skipped(self, now=None, force=False):
+        """Returns the counts of skipped coredumps once per report interval.
+
+        The counts are (executable, signature, reason, count) tuples.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not force and (self.next_report is None or now < self.next_report):
+                return []
+            self.next_report = now + self.report_interval
+            skipped = self.skipped
+            self.skipped = {}
+        return sorted(
+            (key + (count,) for key, count in skipped.items()),
+            key=lambda item: (item[0] or "", item[1] or "", item[2]),
+        )
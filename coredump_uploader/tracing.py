@@ -0,0 +1,244 @@
+"""Per-core traces of where the time goes, for --profile.
+
+Every coredump gets a trace of its stages: spawning and waiting for gdb,
+eu-unstrip and file, parsing their output, serializing and sending the event.
+The stages timed for the metrics are spans of the trace as well. Traces are
+written as JSON lines, one per coredump, or in the Chrome trace format that
+chrome://tracing and Perfetto open. The parsing spans can also be profiled
+with cProfile, the statistics are written next to the trace.
+"""
+import atexit
+import cProfile
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+JSON_LINES = "jsonl"
+CHROME = "chrome"
+
+# Only one cProfile profiler can be active at a time since Python 3.12
+_profile_lock = threading.Lock()
+
+
+class Span(object):
+    """A timed part of the work, args are added to the trace"""
+
+    __slots__ = ("name", "start", "duration", "args", "thread_id")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = time.time()
+        self.duration = None
+        self.thread_id = threading.current_thread().ident
+
+    def finish(self):
+        self.duration = time.time() - self.start
+
+
+class CoreTrace(object):
+    def __init__(self, path_to_core):
+        self.id = uuid.uuid4().hex[:16]
+        self.span = Span("core", {"core": path_to_core})
+        self.spans = []
+        self.profiler = None
+
+
+class Tracer(object):
+    """Writes the traces to a file, which is appended to"""
+
+    def __init__(self, path, format=JSON_LINES, profile_python=False):
+        self.path = path
+        self.format = format
+        self.profile_python = profile_python
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread_names = set()
+        self.file = open(path, "a")
+        if format == CHROME and self.file.tell() == 0:
+            # Viewers accept the array without the closing bracket
+            self.file.write("[\n")
+
+    def get_trace(self):
+        return getattr(self.local, "trace", None)
+
+    @contextmanager
+    def trace(self, path_to_core):
+        trace = CoreTrace(path_to_core)
+        self.local.trace = trace
+        try:
+            yield trace
+        finally:
+            self.local.trace = None
+            trace.span.finish()
+            self.write_trace(trace)
+
+    @contextmanager
+    def profile(self):
+        """Runs cProfile for the current trace, unless another thread does"""
+        trace = self.get_trace()
+        if (
+            not self.profile_python
+            or trace is None
+            or not _profile_lock.acquire(False)
+        ):
+            yield
+            return
+        try:
+            if trace.profiler is None:
+                trace.profiler = cProfile.Profile()
+            trace.profiler.enable()
+            try:
+                yield
+            finally:
+                trace.profiler.disable()
+        finally:
+            _profile_lock.release()
+
+    def record(self, span):
+        trace = self.get_trace()
+        if trace is not None:
+            trace.spans.append(span)
+        else:
+            self.write_trace(None, [span])
+
+    def get_profile_path(self, trace):
+        return "%s.%s.pstats" % (os.path.splitext(self.path)[0], trace.id)
+
+    def write_trace(self, trace, spans=None):
+        if trace is not None:
+            spans = trace.spans
+            if trace.profiler is not None:
+                trace.span.args["profile"] = self.get_profile_path(trace)
+                trace.profiler.dump_stats(trace.span.args["profile"])
+        if self.format == CHROME:
+            if trace is not None:
+                spans = [trace.span] + spans
+            lines = [json.dumps(event) + ",\n" for event in self.iter_events(spans)]
+        else:
+            lines = [json.dumps(get_record(trace, spans)) + "\n"]
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.writelines(lines)
+            self.file.flush()
+
+    def iter_events(self, spans):
+        """Yields complete events of the Chrome trace format"""
+        pid = os.getpid()
+        for span in spans:
+            if span.thread_id not in self.thread_names:
+                self.thread_names.add(span.thread_id)
+                yield {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": {"name": get_thread_name(span.thread_id)},
+                }
+            yield {
+                "name": span.name,
+                "ph": "X",
+                "ts": int(span.start * 1000000),
+                "dur": int(span.duration * 1000000),
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": span.args,
+            }
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def get_thread_name(thread_id):
+    for thread in threading.enumerate():
+        if thread.ident == thread_id:
+            return thread.name
+    return str(thread_id)
+
+
+def get_record(trace, spans):
+    """Returns the JSON lines record of a trace, or of spans outside of one"""
+    if trace is None:
+        start = 0
+        record = {}
+    else:
+        start = trace.span.start
+        record = {
+            "core": trace.span.args.pop("core"),
+            "start": trace.span.start,
+            "duration": trace.span.duration,
+        }
+        record.update(trace.span.args)
+    # Spans are recorded when they end, enclosing spans after their parts
+    record["spans"] = []
+    for span in sorted(spans, key=lambda span: span.start):
+        span_record = {
+            "name": span.name,
+            "start": span.start - start,
+            "duration": span.duration,
+            "thread": span.thread_id,
+        }
+        span_record.update(span.args)
+        record["spans"].append(span_record)
+    return record
+
+
+_tracer = None
+
+
+def configure(path, format=JSON_LINES, profile_python=False):
+    """Writes the traces of all coredumps to path"""
+    global _tracer
+    _tracer = Tracer(path, format, profile_python)
+    atexit.register(_tracer.close)
+    return _tracer
+
+
+def close():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+@contextmanager
+def trace(path_to_core):
+    """Collects the spans of processing a coredump in the current thread"""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.trace(path_to_core) as core_trace:
+        yield core_trace
+
+
+@contextmanager
+def span(name, profile=False, **args):
+    """Times a part of the work, yields the Span to add args.
+
+    With profile, Python code in the span is profiled if enabled.
+    """
+    tracer = _tracer
+    current = Span(name, args)
+    try:
+        if profile and tracer is not None:
+            with tracer.profile():
+                yield current
+        else:
+            yield current
+    finally:
+        current.finish()
+        if tracer is not None:
+            tracer.record(current)
+
+
+def set_result(**args):
+    """Adds args to the trace of the current coredump"""
+    if _tracer is not None:
+        trace = _tracer.get_trace()
+        if trace is not None:
+            trace.span.args.update(args)
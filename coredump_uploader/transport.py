@@ -0,0 +1,350 @@
+"""Transport sending events to Sentry, made for crash storms.
+
+Envelopes are queued and posted by worker threads over a pool of keep-alive
+connections. Failed requests are retried with exponential backoff and rate
+limits announced by Sentry are honored. Envelopes that can't be sent, or that
+don't fit into the queue, are spooled to disk and sent again later instead of
+being dropped.
+"""
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import urllib3
+from sentry_sdk.envelope import Envelope
+from sentry_sdk.transport import Transport
+
+from coredump_uploader import metrics, tracing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+SPOOL_SUFFIX = ".envelope"
+
+# Rate limits for other categories, e.g. transactions, don't affect us
+_categories = ("error", "attachment", "default")
+
+
+def get_retry_after(headers):
+    """Returns the seconds to wait according to the rate limit headers, or None"""
+    limits = headers.get("x-sentry-rate-limits")
+    if limits:
+        delay = None
+        for limit in limits.split(","):
+            parts = limit.strip().split(":")
+            try:
+                seconds = float(parts[0])
+            except ValueError:
+                continue
+            categories = []
+            if len(parts) > 1:
+                categories = [c for c in parts[1].split(";") if c]
+            if categories and not any(c in _categories for c in categories):
+                continue
+            delay = seconds if delay is None else max(delay, seconds)
+        return delay
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return 60.0
+    return None
+
+
+class EnvelopeFile(object):
+    """A queued envelope kept in a file, which is deleted once it is sent"""
+
+    __slots__ = ("path",)
+
+    def __init__(self, path):
+        self.path = path
+
+
+class UploaderTransport(Transport):
+    """Queued, pooled and retrying transport with a disk spool.
+
+    Queue items are either serialized envelopes (bytes) or EnvelopeFiles.
+    """
+
+    def __init__(
+        self,
+        options,
+        queue_size=1000,
+        workers=2,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=300.0,
+        spool_dir=None,
+        spool_interval=60,
+        timeout=60,
+        http=None,
+    ):
+        Transport.__init__(self, options)
+        auth = self.parsed_dsn.to_auth("coredump.uploader.sdk/0.0.1")
+        self.url = auth.get_api_url("envelope")
+        self.auth_header = auth.to_header()
+        if http is None:
+            http = urllib3.PoolManager(
+                num_pools=1,
+                maxsize=max(workers, 1),
+                retries=False,
+                timeout=urllib3.Timeout(connect=10, read=timeout),
+            )
+        self.http = http
+        self.queue = queue.Queue(queue_size)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.spool_dir = os.path.abspath(spool_dir) if spool_dir else None
+        self.spool_interval = spool_interval
+        self.next_requeue = 0
+        self.spooled = 0
+        self.disabled_until = 0
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        if self.spool_dir is not None and not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def capture_event(self, event):
+        envelope = Envelope(headers={"event_id": event["event_id"]})
+        envelope.add_event(event)
+        self.capture_envelope(envelope)
+
+    def capture_envelope(self, envelope):
+        self.submit(envelope.serialize())
+
+    def capture_file(self, body):
+        """Queues an envelope read from a file-like object.
+
+        Used for envelopes too large to be kept in memory, like the ones with
+        the core dump attached. The body is copied to the spool directory, or
+        to a temporary file without one. Returns False if it was dropped.
+        """
+        directory = self.spool_dir or tempfile.gettempdir()
+        fd, path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(body, f)
+            if self.spool_dir is not None:
+                path = self.rename_spooled(path)
+        except Exception:
+            os.remove(path)
+            raise
+        return self.submit(EnvelopeFile(path))
+
+    def submit(self, item):
+        """Queues or spools an envelope, returns False if it was dropped"""
+        if isinstance(item, EnvelopeFile):
+            with self.lock:
+                self.queued.add(item.path)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if isinstance(item, EnvelopeFile):
+                with self.lock:
+                    self.queued.discard(item.path)
+            if not self.spool(item):
+                print("Event queue is full, dropping event")
+                metrics.inc("events_dropped_total", reason="queue_full")
+                return False
+        return True
+
+    def is_spooled(self, item):
+        return (
+            self.spool_dir is not None
+            and isinstance(item, EnvelopeFile)
+            and os.path.dirname(item.path) == self.spool_dir
+        )
+
+    def rename_spooled(self, path):
+        """Moves a file into the spool directory under a name sorting by age"""
+        with self.lock:
+            self.spooled += 1
+            name = "%013d-%06d-%s%s" % (
+                time.time() * 1000,
+                self.spooled % 1000000,
+                uuid.uuid4().hex,
+                SPOOL_SUFFIX,
+            )
+        spooled = os.path.join(self.spool_dir, name)
+        shutil.move(path, spooled)
+        return spooled
+
+    def spool(self, item):
+        """Keeps an envelope on disk to be sent later, returns False without spool"""
+        if self.is_spooled(item):
+            return True
+        if self.spool_dir is None:
+            self.discard(item)
+            return False
+        if isinstance(item, EnvelopeFile):
+            path = item.path
+        else:
+            fd, path = tempfile.mkstemp(suffix=".tmp", dir=self.spool_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(item)
+        self.rename_spooled(path)
+        return True
+
+    def discard(self, item):
+        if isinstance(item, EnvelopeFile):
+            try:
+                os.remove(item.path)
+            except OSError:
+                pass
+
+    def requeue_spooled(self):
+        """Queues the spooled envelopes again, oldest first"""
+        if self.spool_dir is None:
+            return
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(SPOOL_SUFFIX):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            with self.lock:
+                if path in self.queued:
+                    continue
+                self.queued.add(path)
+            try:
+                self.queue.put_nowait(EnvelopeFile(path))
+            except queue.Full:
+                with self.lock:
+                    self.queued.discard(path)
+                return
+
+    def post(self, item):
+        """Posts an envelope, returns the HTTP status and headers or None"""
+        if isinstance(item, EnvelopeFile):
+            body, length = open(item.path, "rb"), os.path.getsize(item.path)
+        else:
+            body, length = item, len(item)
+        try:
+            response = self.http.urlopen(
+                "POST",
+                self.url,
+                body=body,
+                headers={
+                    "Content-Type": "application/x-sentry-envelope",
+                    "Content-Length": str(length),
+                    "X-Sentry-Auth": self.auth_header,
+                },
+                preload_content=True,
+                retries=False,
+            )
+        except (urllib3.exceptions.HTTPError, OSError) as err:
+            print("Sending to sentry failed: %s" % err)
+            return None, None
+        finally:
+            if isinstance(item, EnvelopeFile):
+                body.close()
+        return response.status, response.headers
+
+    def send(self, item):
+        """Sends an envelope, returns False if it should be sent again later"""
+        # Spooled envelopes were already retried, they get a single attempt
+        retries = 0 if self.is_spooled(item) else self.max_retries
+        attempt = 0
+        while True:
+            delay = self.disabled_until - time.time()
+            if delay > 0 and self.stopping.wait(delay):
+                return False
+
+            with tracing.span("post", attempt=attempt) as span:
+                status, headers = self.post(item)
+                span.args["status"] = status
+            retry_after = get_retry_after(headers) if headers is not None else None
+            if retry_after is not None or status == 429:
+                with self.lock:
+                    self.disabled_until = max(
+                        self.disabled_until, time.time() + (retry_after or 60)
+                    )
+
+            if status is not None and 200 <= status < 300:
+                return True
+            if status is not None and 400 <= status < 500 and status != 429:
+                print("Sentry rejected the event with status %d" % status)
+                metrics.inc("events_dropped_total", reason="rejected")
+                return True
+
+            attempt += 1
+            if attempt > retries or self.stopping.is_set():
+                return False
+            if status != 429:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                if self.stopping.wait(delay * random.uniform(0.5, 1)):
+                    return False
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                item = self.queue.get(timeout=1)
+            except queue.Empty:
+                with self.lock:
+                    requeue = time.time() >= self.next_requeue
+                    if requeue:
+                        self.next_requeue = time.time() + self.spool_interval
+                if requeue:
+                    self.requeue_spooled()
+                continue
+            self.process(item)
+
+    def process(self, item):
+        try:
+            if self.send(item):
+                self.discard(item)
+            elif not self.spool(item):
+                print("Sending to sentry failed, dropping event")
+                metrics.inc("events_dropped_total", reason="send_failed")
+        except Exception as err:
+            print("Sending to sentry failed: %s" % err)
+            self.spool(item)
+        finally:
+            if isinstance(item, EnvelopeFile):
+                with self.lock:
+                    self.queued.discard(item.path)
+            self.queue.task_done()
+
+    def flush(self, timeout, callback=None):
+        """Waits until the queued envelopes are sent or spooled"""
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            if self.queue.unfinished_tasks and callback is not None:
+                callback(self.queue.unfinished_tasks, timeout)
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.queue.all_tasks_done.wait(remaining)
+
+    def kill(self):
+        """Stops the workers and spools what is still queued"""
+        self.stopping.set()
+        dropped = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if not self.spool(item):
+                dropped += 1
+            self.queue.task_done()
+        if dropped:
+            print("Dropped %d events that could not be sent" % dropped)
+            metrics.inc("events_dropped_total", dropped, reason="shutdown")
@@ -1,18 +1,34 @@
+import os
+import threading
 import pytest
-import re
 
 from coredump_uploader import code_id_to_debug_id
 from coredump_uploader import get_frame
 from coredump_uploader import Frame
 from coredump_uploader import get_image
 from coredump_uploader import Image
-from coredump_uploader import _frame_re
-from coredump_uploader import _image_re
+from coredump_uploader import get_images
 from coredump_uploader import Thread
 from coredump_uploader import Stacktrace
 from coredump_uploader import get_threads
 from coredump_uploader import signal_name_to_signal_number
 from coredump_uploader import get_stacktrace
+from coredump_uploader import get_gdb_commands
+from coredump_uploader import get_gdb_arguments
+from coredump_uploader import prune_index_cache
+from coredump_uploader import touch_index
+from coredump_uploader import iter_gdb_sections
+from coredump_uploader import get_registers
+from coredump_uploader import CoredumpUploader
+from coredump_uploader import CoredumpWorkerPool
+from coredump_uploader import FingerprintCache
+from coredump_uploader import get_fingerprint
+from coredump_uploader import get_duplicate_summary
+from coredump_uploader import BacktraceParser
+from coredump_uploader import PendingCoredumps
+from coredump_uploader import CoredumpFilter
+from coredump_uploader import CoredumpHandler
+from coredump_uploader import find_coredumps
 
 
 def test_code_id_to_debug_id():
@@ -84,8 +100,7 @@ def test_code_id_to_debug_id():
     ],
 )
 def test_get_frame(gdb_output, parsed):
-    for match in re.finditer(_frame_re, gdb_output):
-        frame_test = get_frame(match)
+    frame_test = get_frame(gdb_output)
 
     assert frame_test.instruction_addr == parsed.instruction_addr
     assert frame_test.function == parsed.function
@@ -108,7 +123,7 @@ def test_get_frame(gdb_output, parsed):
         [
             "0x55ee7d69e000+0x201018 b814d9f87debe4b312c06a03fa8d6b44a7b41199@0x55ee7d69e284 ./a.out . a.out",
             Image(
-                code_file="/a.out",
+                code_file="./a.out",
                 code_id="b814d9f87debe4b312c06a03fa8d6b44a7b41199",
                 image_addr="0x55ee7d69e000",
                 image_size=2101272,
@@ -126,9 +141,7 @@ def test_get_frame(gdb_output, parsed):
     ],
 )
 def test_get_image(unstrip_output, parsed):
-    image_test = Image()
-    for match in re.finditer(_image_re, unstrip_output):
-        image_test = get_image(match)
+    image_test = get_image(unstrip_output)
 
     assert image_test.code_file == parsed.code_file
     assert image_test.code_id == parsed.code_id
@@ -136,6 +149,30 @@ def test_get_image(unstrip_output, parsed):
     assert image_test.image_size == parsed.image_size
 
 
+def test_get_frame_rejects():
+    assert get_frame("Thread 1 (LWP 3421):") is None
+    assert get_frame("#0  0x000055a7df18760a in crashing_function") is None
+    assert get_frame("#0  0x000055a7df18760a in f (a=(1)) at test.c:3") is None
+    # unbalanced arguments don't make the parser backtrack
+    assert get_frame("#1  0x000055a7df18760a in f" + " (x" * 100000) is None
+
+
+def test_get_images():
+    output = (
+        "0x7ffedbaee000+0x1000 09e243c2fb482669406caba88fad799413f2a375@0x7ffedbaee7c0"
+        " . - linux-vdso.so.1\n"
+        "0x7fb45a000000+0x1000 - - - [vdso: 1234]\n"
+        "\n"
+        "eu-unstrip: no matching address range\n"
+        "0x55ee7d69e000+0x201018 b814d9f87debe4b312c06a03fa8d6b44a7b41199@0x55ee7d69e284"
+        " - - a.out\n"
+    )
+    assert [(image.image_addr, image.code_file) for image in get_images(output)] == [
+        ("0x7ffedbaee000", "linux-vdso.so.1"),
+        ("0x55ee7d69e000", "a.out"),
+    ]
+
+
 def test_frame_to_json():
     frame = Frame(
         0x000055EE7D69E60A,
@@ -368,3 +405,430 @@ def test_get_stacktrace(gdb_output):
         ],
         "registers": {},
     }
+
+
+def test_get_gdb_commands():
+    commands = get_gdb_commands(all_threads=True).splitlines()
+    assert commands == [
+        "echo \\n----- coredump-uploader: backtrace -----\\n",
+        "thread apply all bt",
+        "echo \\n----- coredump-uploader: registers -----\\n",
+        "info registers",
+        "echo \\n----- coredump-uploader: version -----\\n",
+        "show version",
+    ]
+    assert get_gdb_commands(all_threads=False).splitlines()[1] == "bt"
+
+
+def test_get_gdb_arguments():
+    assert get_gdb_arguments("gdb", "a.out", "core") == ["gdb", "-c", "core", "a.out"]
+    assert get_gdb_arguments("gdb", "a.out", "core", index_cache="/cache") == [
+        "gdb",
+        "-iex",
+        "set index-cache directory /cache",
+        "-iex",
+        "set index-cache on",
+        "-c",
+        "core",
+        "a.out",
+    ]
+
+
+def test_prune_index_cache(tmpdir):
+    old = tmpdir.join("b814d9f8.gdb-index")
+    old.write("index")
+    os.utime(str(old), (1000, 1000))
+    new = tmpdir.join("f8d914b8.gdb-index")
+    new.write("index")
+    other = tmpdir.join("notes.txt")
+    other.write("")
+    os.utime(str(other), (1000, 1000))
+
+    prune_index_cache(str(tmpdir), max_age=3600)
+    assert sorted(os.listdir(str(tmpdir))) == ["f8d914b8.gdb-index", "notes.txt"]
+
+    # using an index keeps it, whatever the atime says
+    os.utime(str(new), (1000, 1000))
+    touch_index(str(tmpdir), "f8d914b8")
+    os.utime(str(new), (1000, os.stat(str(new)).st_mtime))
+    prune_index_cache(str(tmpdir), max_age=3600)
+    assert new.check()
+
+
+BATCHED_GDB_OUTPUT = """GNU gdb (Ubuntu 8.1-0ubuntu3.2) 8.1.0.20180409-git
+Reading symbols from a.out...done.
+[New LWP 3421]
+Core was generated by `./a.out'.
+Program terminated with signal SIGSEGV, Segmentation fault.
+#0  0x000055931ccfe60a in crashing_function () at test.c:3
+3	  *bad_pointer = 1;
+(gdb) 
+----- coredump-uploader: backtrace -----
+(gdb) 
+Thread 2 (LWP 45):
+#0  0x00005594565cfeab in test_function () at test_file.c:7
+
+Thread 1 (LWP 3421):
+#0  0x000055931ccfe60a in crashing_function () at test.c:3
+#1  0x000055931ccfe61c in main () at test.c:7
+(gdb) 
+----- coredump-uploader: registers -----
+(gdb) rax            0x0	0
+rip            0x55931ccfe60a	0x55931ccfe60a <crashing_function+16>
+(gdb) 
+----- coredump-uploader: version -----
+(gdb) GNU gdb (Ubuntu 8.1-0ubuntu3.2) 8.1.0.20180409-git
+Copyright (C) 2018 Free Software Foundation, Inc.
+(gdb) quit
+"""
+
+
+def test_iter_gdb_sections():
+    parser = BacktraceParser(True)
+    other = {}
+    for section, line in iter_gdb_sections(BATCHED_GDB_OUTPUT.splitlines(True)):
+        if section in ("header", "backtrace"):
+            parser.feed(line)
+        other[section] = other.get(section, "") + line
+    assert other["header"].startswith("GNU gdb")
+    assert "coredump-uploader" not in other["backtrace"]
+    assert other["backtrace"].endswith("main () at test.c:7\n\n")
+    assert other["version"].startswith("GNU gdb")
+
+    thread_list, exit_signal, stacktrace, crashed_thread_id = parser.get_threads()
+    assert exit_signal == "SIGSEGV"
+    assert [thread.id for thread in thread_list] == ["1", "2"]
+    assert [frame.function for frame in stacktrace.frames] == [
+        "main",
+        "crashing_function",
+    ]
+
+    stacktrace, gdb_version, message = get_registers(
+        other["header"] + other["registers"] + other["version"], stacktrace
+    )
+    assert gdb_version == "8.1.0.20180409-git"
+    assert message == (
+        "Core was generated by `./a.out'.\n"
+        "Program terminated with signal SIGSEGV, Segmentation fault."
+    )
+    assert stacktrace.registers == {"rax": "0x0", "rip": "0x55931ccfe60a"}
+
+
+def test_read_gdb(tmpdir):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    output = tmpdir.join("gdb-output")
+    output.write(BATCHED_GDB_OUTPUT)
+    gdb = tmpdir.join("gdb")
+    gdb.write("#!/bin/sh\ncat > /dev/null\ncat %s\n" % output)
+    gdb.chmod(0o755)
+    core = tmpdir.join("core")
+    core.write("")
+    uploader = CoredumpUploader(str(executable), None, str(gdb), None, True)
+
+    parser, registers, gdb_version, message = uploader.read_gdb(str(core))
+    assert not parser.timed_out
+    thread_list, exit_signal, stacktrace, crashed_thread_id = parser.get_threads()
+    assert exit_signal == "SIGSEGV"
+    assert [thread.id for thread in thread_list] == ["1", "2"]
+    assert [frame.function for frame in stacktrace.frames] == [
+        "main",
+        "crashing_function",
+    ]
+    assert registers == [("rax", "0x0"), ("rip", "0x55931ccfe60a")]
+    assert gdb_version == "8.1.0.20180409-git"
+    assert message.startswith("Core was generated by `./a.out'.")
+
+
+def test_worker_pool():
+    class Uploader(object):
+        def __init__(self):
+            self.uploaded = []
+
+        def upload(self, path_to_core):
+            if path_to_core == "broken":
+                raise SystemExit(1)
+            self.uploaded.append(path_to_core)
+
+    uploader = Uploader()
+    pool = CoredumpWorkerPool(uploader, workers=3, max_queue=2)
+    pool.start()
+    for path_to_core in ["core.1", "broken", "core.2", "core.3"]:
+        pool.submit(path_to_core)
+    pool.queue.join()
+    pool.stop()
+    assert sorted(uploader.uploaded) == ["core.1", "core.2", "core.3"]
+
+
+def test_worker_pool_stop(capsys):
+    started = threading.Event()
+    release = threading.Event()
+
+    class Uploader(object):
+        def __init__(self):
+            self.uploaded = []
+
+        def upload(self, path_to_core):
+            started.set()
+            release.wait(10)
+            self.uploaded.append(path_to_core)
+
+    uploader = Uploader()
+    pool = CoredumpWorkerPool(uploader)
+    pool.start()
+    for path_to_core in ["core.1", "core.2", "core.3"]:
+        pool.submit(path_to_core)
+    started.wait(10)
+    threading.Timer(0.2, release.set).start()
+    # the core being processed is finished, the queued ones are left
+    pool.stop()
+    assert uploader.uploaded == ["core.1"]
+    # without a journal the dropped coredumps are listed
+    output = capsys.readouterr().out
+    assert "Dropped 2 queued coredumps:\n  core.2\n  core.3\n" in output
+
+
+def test_get_fingerprint():
+    def stacktrace(instruction_addr):
+        stacktrace = Stacktrace()
+        stacktrace.append_frame(
+            Frame(instruction_addr=instruction_addr, function="main", filename="a.c")
+        )
+        stacktrace.append_frame(Frame(instruction_addr=instruction_addr))
+        return stacktrace
+
+    fingerprint = get_fingerprint("b814d9f8", stacktrace("0x1"), "SIGSEGV")
+    # function frames don't depend on the load address
+    assert fingerprint != get_fingerprint("b814d9f8", stacktrace("0x2"), "SIGSEGV")
+    assert fingerprint == get_fingerprint("b814d9f8", stacktrace("0x1"), "SIGSEGV")
+    assert fingerprint != get_fingerprint("b814d9f8", stacktrace("0x1"), "SIGABRT")
+    assert fingerprint != get_fingerprint("00000000", stacktrace("0x1"), "SIGSEGV")
+
+
+def test_fingerprint_cache():
+    cache = FingerprintCache(ttl=60, max_size=2)
+    assert not cache.seen("a", now=0)
+    cache.set_event("a", {"event_id": "1"})
+    assert cache.seen("a", now=10)
+    assert cache.seen("a", now=20)
+    assert cache.pop_expired(now=30) == []
+
+    # expired entries are reported with their number of duplicates
+    entries = cache.pop_expired(now=60)
+    assert [(entry.data, entry.duplicates) for entry in entries] == [
+        ({"event_id": "1"}, 2)
+    ]
+    assert not cache.seen("a", now=61)
+
+    # the least recently seen entry is evicted first
+    cache.set_event("a", {"event_id": "2"})
+    assert not cache.seen("b", now=62)
+    assert cache.seen("a", now=63)
+    assert not cache.seen("c", now=64)
+    assert [entry.data for entry in cache.pop_expired(now=65)] == []
+    assert cache.seen("a", now=66)
+    assert [entry.duplicates for entry in cache.pop_expired(now=67, force=True)] == [
+        2
+    ]
+
+
+def test_get_duplicate_summary():
+    stacktrace = Stacktrace()
+    for i in range(20):
+        stacktrace.append_frame(Frame(function="f%d" % i))
+    stacktrace.ad_register("rip", "0x1")
+    data = {
+        "message": {"message": "Core was generated by `./a.out'."},
+        "exception": {"type": "SIGSEGV", "value": "Segfault", "stacktrace": stacktrace},
+        "threads": {"values": [Thread(id="1")]},
+        "debug_meta": {"images": [Image(code_file="/lib/libc.so.6")]},
+    }
+    summary = get_duplicate_summary(data)
+    assert sorted(summary) == ["exception", "message"]
+    assert summary["exception"]["type"] == "SIGSEGV"
+    assert summary["exception"]["value"] == "Segfault"
+    frames = summary["exception"]["stacktrace"].frames
+    # the crashing frame is the last one
+    assert [frame.function for frame in frames] == ["f%d" % i for i in range(4, 20)]
+    assert summary["exception"]["stacktrace"].registers == {}
+    assert len(data["exception"]["stacktrace"].frames) == 20
+
+
+def test_fingerprint_cache_failed_upload():
+    cache = FingerprintCache(ttl=60)
+    assert not cache.seen("a", now=0)
+    assert cache.seen("a", now=1)
+    # crashes that are still being uploaded don't expire
+    assert cache.pop_expired(now=100) == []
+    assert cache.seen("a", now=101)
+
+    cache.forget("a")
+    assert not cache.seen("a", now=102)
+    entries = cache.pop_expired(now=103)
+    assert [(entry.failed, entry.duplicates) for entry in entries] == [(True, 2)]
+
+    # entries with an event are kept
+    cache.set_event("a", {"event_id": "1"})
+    cache.forget("a")
+    assert cache.seen("a", now=104)
+
+
+@pytest.mark.parametrize(
+    "signal_name, signal_number",
+    [
+        ["SIGSEGV", 11],
+        ["SIGABRT", 6],
+        ["SIG34", 34],
+        ["Core", None],
+        ["SIG_IGN", None],
+        ["SIGFOO", None],
+        [None, None],
+    ],
+)
+def test_signal_name_to_signal_number(signal_name, signal_number):
+    assert signal_name_to_signal_number(signal_name) == signal_number
+
+
+def test_backtrace_parser_limits():
+    lines = ["[Current thread is 3 (LWP 3)]\n"]
+    for thread_id in range(6, 0, -1):
+        lines.append("\n")
+        lines.append("Thread %d (LWP %d):\n" % (thread_id, thread_id))
+        # threads 1 and 2 have the same stack as the crashed thread 3
+        depth = 10 if thread_id <= 3 else thread_id
+        for i in range(depth):
+            lines.append("#%d  0x%016x in function_%d () at a.c:%d\n" % (i, i, i, i))
+    lines.append("(gdb) quit\n")
+
+    parser = BacktraceParser(all_threads=True, max_threads=3, max_frames=5)
+    for line in lines:
+        parser.feed(line)
+    thread_list, _, stacktrace, crashed_thread_id = parser.get_threads()
+
+    assert crashed_thread_id == "3"
+    assert [(thread.id, thread.name) for thread in thread_list] == [
+        ("1", "LWP 1 (+1 threads with the same stack)"),
+        ("3", "LWP 3"),
+        ("4", "LWP 4"),
+    ]
+    assert parser.threads_omitted == 2
+
+    # the three innermost and the two outermost frames are kept
+    assert [frame.lineno for frame in stacktrace.frames] == [9, 8, 2, 1, 0]
+    assert stacktrace.frames_omitted == [2, 7]
+    assert thread_list[2].stacktrace.frames_omitted is None
+
+
+def test_backtrace_parser_shares_frames():
+    lines = []
+    for thread in (3, 2, 1):
+        lines += [
+            "Thread %d (LWP %d):\n" % (thread, thread),
+            "#0  0x00007f0000001234 in read () from /lib/libc.so.6\n",
+            "#1  0x00007f00000%05x in worker () from /lib/libc.so.6\n" % thread,
+            "\n",
+        ]
+    parser = BacktraceParser(all_threads=True)
+    for line in lines:
+        parser.feed(line)
+    thread_list, _, stacktrace, _ = parser.get_threads()
+
+    frames = [thread.stacktrace.frames for thread in thread_list[1:]]
+    frames.append(stacktrace.frames)
+    # identical lines are parsed once, equal strings are stored once
+    assert frames[0][1] is frames[1][1] is frames[2][1]
+    assert frames[0][0] is not frames[1][0]
+    assert frames[0][0].package is frames[1][0].package
+    assert parser.cache_hits == 2
+
+
+def test_backtrace_parser_drops_unused_cache():
+    parser = BacktraceParser(all_threads=False)
+    parser.cache_check_size = 10
+    for i in range(20):
+        parser.feed("#%d  0x%016x in f () at test.c:%d\n" % (i, i, i))
+    assert parser.frame_cache is None
+    assert len(parser.get_stacktrace()[0].frames) == 20
+
+
+def test_pending_coredumps(tmpdir):
+    dispatched = []
+    pending = PendingCoredumps(dispatched.append, settle_time=5)
+    core = tmpdir.join("core.1")
+    core.write("ELF")
+    pending.created(str(core), now=0)
+
+    pending.poll(now=4)
+    core.write("ELF and more")
+    pending.poll(now=6)
+    assert dispatched == []
+    pending.poll(now=10)
+    assert dispatched == []
+    pending.poll(now=11)
+    assert dispatched == [str(core)]
+
+    # closing after writing dispatches right away, but only once
+    other = tmpdir.join("core.2")
+    other.write("ELF")
+    pending.created(str(other), now=20)
+    pending.closed(str(other))
+    pending.closed(str(other))
+    pending.poll(now=100)
+    assert dispatched == [str(core), str(other)]
+
+    # coredumps deleted while being written are forgotten
+    gone = tmpdir.join("core.3")
+    gone.write("ELF")
+    pending.created(str(gone), now=30)
+    gone.remove()
+    pending.poll(now=100)
+    assert dispatched == [str(core), str(other)]
+    assert pending.pending == {}
+
+
+def test_coredump_filter(tmpdir):
+    service = tmpdir.mkdir("crash").mkdir("service")
+    paths = []
+    for path in ["crash/core.1", "crash/service/core.2", "crash/service/core.2.tmp"]:
+        tmpdir.join(path).write("ELF")
+        paths.append(str(tmpdir.join(path)))
+
+    coredump_filter = CoredumpFilter([str(tmpdir.join("crash"))])
+    assert find_coredumps(coredump_filter) == paths[:1]
+    assert not coredump_filter.matches(str(tmpdir.join("core.0")))
+
+    coredump_filter = CoredumpFilter(
+        [str(tmpdir.join("crash")), str(service)],
+        exclude=[r".*\.tmp$"],
+        recursive=True,
+    )
+    assert sorted(find_coredumps(coredump_filter)) == paths[:2]
+    # patterns match the path relative to the innermost watched directory
+    coredump_filter = CoredumpFilter(
+        [str(tmpdir)], include=["crash/service/"], recursive=True
+    )
+    assert coredump_filter.matches(paths[1])
+    coredump_filter = CoredumpFilter([str(tmpdir)], include=["service/"], recursive=True)
+    assert not coredump_filter.matches(paths[1])
+
+
+def test_coredump_handler(tmpdir):
+    class Event(object):
+        def __init__(self, event_type, src_path, dest_path="", is_directory=False):
+            self.event_type = event_type
+            self.src_path = src_path
+            self.dest_path = dest_path
+            self.is_directory = is_directory
+
+    dispatched = []
+    handler = CoredumpHandler(
+        PendingCoredumps(dispatched.append, settle_time=0),
+        CoredumpFilter([str(tmpdir)], recursive=True),
+    )
+    handler.dispatch(Event("created", str(tmpdir.join("a", "core.1"))))
+    handler.dispatch(Event("created", str(tmpdir.join("cores")), is_directory=True))
+    handler.dispatch(Event("created", str(tmpdir.join("other"))))
+    handler.dispatch(
+        Event("moved", str(tmpdir.join("tmp")), str(tmpdir.join("core.2")))
+    )
+    assert dispatched == [str(tmpdir.join("a", "core.1")), str(tmpdir.join("core.2"))]
@@ -0,0 +1,186 @@
+import os
+import struct
+
+from coredump_uploader import ExecutableIndex
+from coredump_uploader import get_core_fingerprint
+from coredump_uploader import get_native_images
+from coredump_uploader.elf import CoreFile
+from coredump_uploader.elf import ElfFile
+from coredump_uploader.elf import get_build_id
+from coredump_uploader.elf import get_executable
+
+
+def note(name, note_type, desc):
+    name += b"\0"
+    return (
+        struct.pack("<III", len(name), len(desc), note_type)
+        + name.ljust((len(name) + 3) & ~3, b"\0")
+        + desc.ljust((len(desc) + 3) & ~3, b"\0")
+    )
+
+
+def prstatus(pid, signal, pc):
+    """x86_64 prstatus with pr_reg at 112 and rip as 17th register"""
+    desc = bytearray(336)
+    struct.pack_into("<h", desc, 12, signal)
+    struct.pack_into("<i", desc, 32, pid)
+    struct.pack_into("<Q", desc, 112 + 16 * 8, pc)
+    return note(b"CORE", 1, bytes(desc))
+
+
+def nt_file(mappings, page_size=4096):
+    desc = struct.pack("<QQ", len(mappings), page_size)
+    for start, end, offset, _ in mappings:
+        desc += struct.pack("<QQQ", start, end, offset // page_size)
+    desc += b"".join(path.encode("utf-8") + b"\0" for _, _, _, path in mappings)
+    return note(b"CORE", 0x46494C45, desc)
+
+
+def auxv(entry):
+    return note(b"CORE", 6, struct.pack("<QQQQQQ", 6, 4096, 9, entry, 0, 0))
+
+
+def elf(e_type, notes):
+    """ELF64 file with a single PT_NOTE segment"""
+    header = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+    header += struct.pack(
+        "<HHIQQQIHHHHHH", e_type, 62, 1, 0, 64, 0, 0, 64, 56, 1, 64, 0, 0
+    )
+    phdr = struct.pack("<IIQQQQQQ", 4, 0, 120, 0, 0, len(notes), 0, 4)
+    return header + phdr + notes
+
+
+def write_core(tmpdir, pc, signal=11, name="core", entry=0x401000):
+    mappings = [
+        (0x400000, 0x401000, 0, "/usr/bin/app"),
+        (0x401000, 0x405000, 0x1000, "/usr/bin/app"),
+        (0x7F0000000000, 0x7F0000100000, 0, "/lib/libc.so.6"),
+    ]
+    path = tmpdir.join(name)
+    notes = prstatus(42, signal, pc) + prstatus(43, 0, 0x10) + nt_file(mappings)
+    if entry is not None:
+        notes += auxv(entry)
+    path.write_binary(elf(4, notes))
+    return str(path)
+
+
+def test_core_file(tmpdir):
+    with CoreFile.open(write_core(tmpdir, 0x401234)) as core:
+        threads = core.threads()
+        assert [(t.pid, t.signal, t.pc) for t in threads] == [
+            (42, 11, 0x401234),
+            (43, 0, 0x10),
+        ]
+        assert core.mapped_files()[1] == (0x401000, 0x405000, 0x1000, "/usr/bin/app")
+
+
+def test_build_id(tmpdir):
+    path = tmpdir.join("lib.so")
+    path.write_binary(elf(3, note(b"GNU", 3, b"\xb8\x14\xd9\xf8")))
+    assert get_build_id(str(path)) == "b814d9f8"
+    with ElfFile.open(str(path)) as lib:
+        assert lib.build_id() == "b814d9f8"
+
+    path = tmpdir.join("empty")
+    path.write_binary(b"")
+    assert get_build_id(str(path)) is None
+
+
+def test_get_core_fingerprint(tmpdir):
+    fingerprint = get_core_fingerprint(write_core(tmpdir, 0x401234, name="a"), "b8")
+    assert fingerprint is not None
+    assert fingerprint == get_core_fingerprint(
+        write_core(tmpdir, 0x401234, name="b"), "b8"
+    )
+    assert fingerprint != get_core_fingerprint(
+        write_core(tmpdir, 0x401238, name="c"), "b8"
+    )
+    assert fingerprint != get_core_fingerprint(
+        write_core(tmpdir, 0x401234, signal=6, name="d"), "b8"
+    )
+
+    path = tmpdir.join("not-a-core")
+    path.write_binary(b"hello")
+    assert get_core_fingerprint(str(path), "b8") is None
+
+    # crashes in libraries, e.g. in abort(), need the backtrace
+    path = write_core(tmpdir, 0x7F0000001234, name="e")
+    assert get_core_fingerprint(path, "b8") is None
+    # so do cores that don't tell where the executable is
+    path = write_core(tmpdir, 0x401234, name="f", entry=None)
+    assert get_core_fingerprint(path, "b8") is None
+
+
+def test_get_native_images(tmpdir):
+    lib = tmpdir.join("lib.so")
+    lib.write_binary(elf(3, note(b"GNU", 3, b"\xb8\x14\xd9\xf8")))
+    locale = tmpdir.join("locale-archive")
+    locale.write_binary(b"not an elf file")
+    mappings = [
+        (0x7F0000000000, 0x7F0000001000, 0, str(lib)),
+        (0x7F0000001000, 0x7F0000003000, 0x1000, str(lib)),
+        (0x7F0000010000, 0x7F0000020000, 0, str(locale)),
+    ]
+    core = tmpdir.join("core")
+    core.write_binary(elf(4, prstatus(42, 11, 0) + nt_file(mappings)))
+
+    images = get_native_images(str(core))
+    assert [image.to_json() for image in images] == [
+        {
+            "type": "elf",
+            "image_addr": "0x7f0000000000",
+            "image_size": 0x3000,
+            "code_id": "b814d9f8",
+            "debug_id": "f8d914b8-0000-0000-0000-000000000000",
+            "code_file": str(lib),
+            "arch": "",
+        }
+    ]
+
+    # without NT_FILE note eu-unstrip has to be used
+    core.write_binary(elf(4, prstatus(42, 11, 0)))
+    assert get_native_images(str(core)) is None
+
+
+def test_get_executable(tmpdir):
+    app = tmpdir.join("app")
+    app.write_binary(elf(2, note(b"GNU", 3, b"\xb8\x14\xd9\xf8")))
+    mappings = [
+        (0x400000, 0x401000, 0, str(app)),
+        (0x401000, 0x405000, 0x1000, str(app)),
+        (0x7F0000000000, 0x7F0000100000, 0, "/lib/libc.so.6"),
+    ]
+    core = tmpdir.join("core")
+    core.write_binary(
+        elf(4, prstatus(42, 11, 0) + auxv(0x401100) + nt_file(mappings))
+    )
+    with CoreFile.open(str(core)) as core_file:
+        assert core_file.auxv() == {6: 4096, 9: 0x401100}
+        executable = get_executable(core_file)
+    assert executable.path == str(app)
+    assert (executable.start, executable.end) == (0x400000, 0x405000)
+    assert executable.build_id == "b814d9f8"
+
+    core.write_binary(elf(4, prstatus(42, 11, 0) + nt_file(mappings)))
+    with CoreFile.open(str(core)) as core_file:
+        assert get_executable(core_file) is None
+
+
+def test_executable_index(tmpdir):
+    bin_dir = tmpdir.mkdir("bin")
+    app = bin_dir.mkdir("service").join("app")
+    app.write_binary(elf(2, note(b"GNU", 3, b"\xb8\x14\xd9\xf8")))
+    app.chmod(0o755)
+    data = bin_dir.join("data")
+    data.write_binary(elf(2, note(b"GNU", 3, b"\x01\x02")))
+
+    index = ExecutableIndex([str(bin_dir)], rescan_interval=60)
+    assert index.find("b814d9f8", now=0) == str(app)
+    # not executable
+    assert index.find("0102", now=1) is None
+
+    # a new build is found right away when the old one is replaced
+    app.write_binary(elf(2, note(b"GNU", 3, b"\xf8\xd9\x14\xb8")))
+    os.utime(str(app), (0, 0))
+    assert index.find("b814d9f8", now=2) is None
+    assert index.find("f8d914b8", now=3) == str(app)
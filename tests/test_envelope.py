@@ -0,0 +1,114 @@
+import gzip
+import json
+
+import pytest
+
+from coredump_uploader.envelope import AttachmentTooLarge
+from coredump_uploader.envelope import CoreAttachment
+from coredump_uploader import Frame
+from coredump_uploader import Stacktrace
+from coredump_uploader import Thread
+from coredump_uploader.envelope import build_envelope
+from coredump_uploader.envelope import build_event_envelope
+from coredump_uploader.envelope import dump_event
+from coredump_uploader.envelope import iter_chunks
+
+
+@pytest.fixture
+def sparse_core(tmpdir):
+    path = tmpdir.join("core.42")
+    with open(str(path), "wb") as f:
+        f.write(b"\x7fELF")
+        f.seek(5 * 1024 * 1024)
+        f.write(b"stack")
+        f.truncate(7 * 1024 * 1024)
+    return str(path)
+
+
+def test_iter_chunks(sparse_core):
+    with open(sparse_core, "rb") as f:
+        content = b"".join(bytes(chunk) for chunk in iter_chunks(f))
+    with open(sparse_core, "rb") as f:
+        assert content == f.read()
+
+
+def test_core_attachment(sparse_core):
+    attachment = CoreAttachment(sparse_core, "gzip")
+    try:
+        assert attachment.filename == "core.42.gz"
+        assert attachment.content_type == "application/gzip"
+        compressed = attachment.file.read()
+        assert len(compressed) == attachment.size
+        with open(sparse_core, "rb") as f:
+            assert gzip.decompress(compressed) == f.read()
+    finally:
+        attachment.close()
+
+    with pytest.raises(AttachmentTooLarge):
+        CoreAttachment(sparse_core, "gzip", max_size=100)
+
+
+def test_build_envelope(sparse_core):
+    attachment = CoreAttachment(sparse_core, "gzip")
+    event = {"event_id": "ab" * 16, "platform": "native"}
+    try:
+        body, length = build_envelope(event, attachment)
+        envelope = b""
+        while True:
+            data = body.read(1000)
+            if not data:
+                break
+            envelope += data
+    finally:
+        attachment.close()
+
+    assert len(envelope) == length
+    header, item, payload, rest = envelope.split(b"\n", 3)
+    assert json.loads(header.decode("utf-8")) == {"event_id": "ab" * 16}
+    assert json.loads(item.decode("utf-8")) == {"type": "event", "length": len(payload)}
+    assert json.loads(payload.decode("utf-8")) == event
+
+    item, rest = rest.split(b"\n", 1)
+    item = json.loads(item.decode("utf-8"))
+    assert item["type"] == "attachment"
+    assert item["filename"] == "core.42.gz"
+    assert len(rest) == item["length"] + 1
+
+
+def test_dump_event():
+    stacktrace = Stacktrace()
+    stacktrace.append_frame(Frame("0x1", "main", "test.c", 7))
+    stacktrace.frames_omitted = [0, 3]
+    event = {
+        "event_id": "ab" * 16,
+        "exception": {"stacktrace": stacktrace},
+        "threads": {"values": [Thread("1", "LWP 1", True, stacktrace)]},
+    }
+    payload = dump_event(event)
+    # the models are left unchanged, so the event can be sent again
+    assert dump_event(event) == payload
+    assert isinstance(stacktrace.frames[0], Frame)
+
+    frames = [
+        {
+            "instruction_addr": "0x1",
+            "function": "main",
+            "filename": "test.c",
+            "lineno": 7,
+            "package": None,
+        }
+    ]
+    data = json.loads(payload)
+    assert data["exception"]["stacktrace"] == {
+        "frames": frames,
+        "registers": {},
+        "frames_omitted": [0, 3],
+    }
+    assert data["threads"]["values"][0]["stacktrace"]["frames"] == frames
+
+    lines = build_event_envelope(event).split(b"\n")
+    assert json.loads(lines[1]) == {"type": "event", "length": len(payload)}
+    assert lines[2] == payload
+
+    with pytest.raises(TypeError):
+        dump_event({"event_id": object()})
@@ -0,0 +1,232 @@
+import sys
+
+import pytest
+
+from coredump_uploader import CoredumpUploader
+from coredump_uploader.limits import ChildLimits
+from coredump_uploader.gdbmi import GdbMiError
+from coredump_uploader.gdbmi import GdbSession
+from coredump_uploader.gdbmi import GdbSessionPool
+from coredump_uploader.gdbmi import MiRecord
+from coredump_uploader.gdbmi import parse_record
+
+FAKE_GDB = r'''#!%s
+import re
+import sys
+
+RESPONSES = {
+    "-target-select": [
+        '~"[New LWP 1001]\\n"',
+        '~"Core was generated by `./a.out\'.\\n"',
+        '~"Program terminated with signal SIGSEGV, Segmentation fault.\\n"',
+        '~"#0  0x000055931ccfe60a in crashing_function () at test.c:3\\n"',
+        "^connected,frame={level=\"0\",addr=\"0x000055931ccfe60a\"}",
+    ],
+    "-thread-info": [
+        '^done,threads=[{id="1",target-id="LWP 1000",state="stopped"},'
+        '{id="2",target-id="Thread 0x7f3c2d8f0700 (LWP 1001)",state="stopped"}],'
+        'current-thread-id="1"',
+    ],
+    "-stack-list-frames": [
+        '^done,stack=[frame={level="0",addr="0x000055931ccfe60a",'
+        'func="crashing_function",file="test.c",fullname="/src/test.c",line="3",'
+        'arch="i386:x86-64"},frame={level="1",addr="0x00007f3c2e0f1b97",'
+        'func="__libc_start_main",from="/lib/x86_64-linux-gnu/libc.so.6"}]',
+    ],
+    "-data-list-register-names": ['^done,register-names=["rax","rip","","xmm0"]'],
+    "-data-list-register-values": [
+        '^done,register-values=[{number="0",value="0x1c"},'
+        '{number="1",value="0x55931ccfe60a"},{number="2",value="0x0"},'
+        '{number="3",value="{v4_float = {0x0, 0x0}}"}]'
+    ],
+    "-gdb-version": ['~"GNU gdb (GDB) 12.1\\n"', "^done"],
+    "-interpreter-exec": ['~"No core file now.\\n"', "^done"],
+    "-break-insert": ['^error,msg="No symbol table is loaded."'],
+}
+
+print('~"Reading symbols from a.out...\\n"')
+print("(gdb) ")
+sys.stdout.flush()
+for line in sys.stdin:
+    token, command = re.match(r"(\d*)(\S+)", line).groups()
+    if command == "-gdb-exit":
+        break
+    for response in RESPONSES[command]:
+        if response.startswith("^"):
+            response = token + response
+        print(response)
+    print("(gdb) ")
+    sys.stdout.flush()
+'''
+
+
+@pytest.fixture
+def fake_gdb(tmpdir):
+    path = tmpdir.join("gdb")
+    path.write(FAKE_GDB % sys.executable)
+    path.chmod(0o755)
+    return [str(path)]
+
+
+def test_parse_record():
+    record = parse_record(
+        '12^done,stack=[frame={level="0",func="main",file="a \\"b\\".c"},'
+        'frame={level="1",from="/lib/libc.so.6"}],names=["a","b"],empty=[]\n'
+    )
+    assert isinstance(record, MiRecord)
+    assert record.token == "12"
+    assert record.kind == "^"
+    assert record.record_class == "done"
+    assert record.results == {
+        "stack": [
+            {"level": "0", "func": "main", "file": 'a "b".c'},
+            {"level": "1", "from": "/lib/libc.so.6"},
+        ],
+        "names": ["a", "b"],
+        "empty": [],
+    }
+
+    assert parse_record('~"Core was generated by `./a.out\'.\\n"') == (
+        "~",
+        "Core was generated by `./a.out'.\n",
+    )
+    assert parse_record('~"caf\\303\\251\\t"') == ("~", u"caf\xe9\t")
+    assert parse_record("*stopped").record_class == "stopped"
+    assert parse_record("(gdb) \n") is None
+
+    with pytest.raises(GdbMiError):
+        parse_record('^done,stack=[frame={level="0"')
+
+
+def test_gdb_session(fake_gdb):
+    session = GdbSession(fake_gdb)
+    try:
+        output = session.load_core("/tmp/core")
+        assert "Program terminated with signal SIGSEGV" in output
+        threads, current_thread_id = session.thread_info()
+        assert [thread["id"] for thread in threads] == ["1", "2"]
+        assert current_thread_id == "1"
+        frames = session.frames("1")
+        assert frames[0]["func"] == "crashing_function"
+        assert frames[1]["from"] == "/lib/x86_64-linux-gnu/libc.so.6"
+        assert session.registers("1") == [("rax", "0x1c"), ("rip", "0x55931ccfe60a")]
+        assert session.version() == "GNU gdb (GDB) 12.1\n"
+        session.unload_core()
+        with pytest.raises(GdbMiError):
+            session.command("-break-insert main")
+    finally:
+        session.close()
+    assert not session.alive()
+
+
+def test_gdb_session_pool(fake_gdb, tmpdir):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    started = []
+
+    def factory(path_to_executable):
+        started.append(path_to_executable)
+        return GdbSession(fake_gdb)
+
+    pool = GdbSessionPool(factory, max_uses=2)
+    session = pool.acquire(str(executable))
+    session.uses = 1
+    pool.release(session)
+    assert pool.acquire(str(executable)) is session
+    assert len(started) == 1
+
+    # sessions are replaced after max_uses and when they failed
+    session.uses = 2
+    pool.release(session)
+    assert not session.alive()
+    session = pool.acquire(str(executable))
+    pool.release(session, reusable=False)
+    assert not session.alive()
+
+    # and when the executable changed
+    session = pool.acquire(str(executable))
+    pool.release(session)
+    executable.setmtime(0)
+    assert pool.acquire(str(executable)) is not session
+    assert not session.alive()
+    assert len(started) == 4
+    pool.release(pool.acquire(str(executable)))
+    pool.close()
+
+
+def test_read_gdb_mi(fake_gdb, tmpdir):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    core = tmpdir.join("core")
+    core.write("")
+    uploader = CoredumpUploader(
+        str(executable), None, fake_gdb[0], None, all_threads=True, gdb_mi=True
+    )
+    try:
+        parser, registers, gdb_version, message = uploader.read_gdb_mi(str(core))
+        thread_list, exit_signal, stacktrace, crashed_thread_id = parser.get_threads()
+    finally:
+        uploader.close()
+
+    assert [(thread.id, thread.name) for thread in thread_list] == [
+        ("1", "LWP 1000"),
+        ("2", "LWP 1001"),
+    ]
+    assert exit_signal == "SIGSEGV"
+    assert crashed_thread_id == "1"
+    assert [frame.to_json() for frame in stacktrace.frames] == [
+        {
+            "instruction_addr": "0x00007f3c2e0f1b97",
+            "function": "__libc_start_main",
+            "filename": None,
+            "lineno": None,
+            "package": "/lib/x86_64-linux-gnu/libc.so.6",
+        },
+        {
+            "instruction_addr": "0x000055931ccfe60a",
+            "function": "crashing_function",
+            "filename": "test.c",
+            "lineno": 3,
+            "package": None,
+        },
+    ]
+    assert registers == [("rax", "0x1c"), ("rip", "0x55931ccfe60a")]
+    assert gdb_version == "12.1"
+    assert message.startswith("Core was generated by `./a.out'.\nProgram terminated")
+
+
+HANGING_GDB = r"""#!%s
+import sys
+import time
+
+if "--interpreter=mi2" in sys.argv:
+    # loading the executable never finishes
+    time.sleep(30)
+print("#0  0x000055931ccfe60a in crashing_function () at test.c:3")
+"""
+
+
+def test_read_gdb_mi_startup_timeout(tmpdir):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    core = tmpdir.join("core")
+    core.write("")
+    gdb = tmpdir.join("gdb")
+    gdb.write(HANGING_GDB % sys.executable)
+    gdb.chmod(0o755)
+    uploader = CoredumpUploader(
+        str(executable),
+        None,
+        str(gdb),
+        None,
+        all_threads=False,
+        gdb_mi=True,
+        child_limits=ChildLimits(timeout=0.5),
+    )
+    try:
+        # falls back to a gdb for the core alone
+        parser = uploader.read_gdb_mi(str(core))[0]
+        stacktrace, _ = parser.get_stacktrace()
+    finally:
+        uploader.close()
+    assert [frame.function for frame in stacktrace.frames] == ["crashing_function"]
@@ -0,0 +1,62 @@
+import os
+
+from coredump_uploader import CoredumpFilter
+from coredump_uploader import CoredumpWorkerPool
+from coredump_uploader import find_coredumps
+from coredump_uploader import journal
+from coredump_uploader.journal import CoredumpJournal
+
+
+def test_journal(tmpdir):
+    core = tmpdir.join("core.1")
+    core.write("ELF")
+    coredump_journal = CoredumpJournal(str(tmpdir.join("journal.db")))
+    assert coredump_journal.discover(str(core))
+    assert coredump_journal.get_state(str(core)) == journal.DISCOVERED
+
+    coredump_journal.set_state(str(core), journal.PROCESSING)
+    assert coredump_journal.discover(str(core))
+    coredump_journal.close()
+
+    # in flight coredumps are processed again after a restart
+    coredump_journal = CoredumpJournal(str(tmpdir.join("journal.db")))
+    assert coredump_journal.unfinished() == [str(core)]
+    coredump_journal.set_state(str(core), journal.DONE)
+    assert coredump_journal.unfinished() == []
+    assert not coredump_journal.discover(str(core))
+
+    # a new coredump with the same name
+    os.utime(str(core), (0, 0))
+    assert coredump_journal.discover(str(core))
+    assert coredump_journal.get_state(str(core)) == journal.DISCOVERED
+
+    core.remove()
+    coredump_journal.prune()
+    assert coredump_journal.get_state(str(core)) is None
+
+
+def test_worker_pool_journal(tmpdir):
+    class Uploader(object):
+        def upload(self, path_to_core):
+            if path_to_core.endswith("broken"):
+                raise SystemExit(1)
+
+    paths = []
+    for name in ["core.1", "core.broken", "other"]:
+        tmpdir.join(name).write("ELF")
+        paths.append(str(tmpdir.join(name)))
+    assert sorted(find_coredumps(CoredumpFilter([str(tmpdir)]))) == paths[:2]
+
+    coredump_journal = CoredumpJournal(str(tmpdir.join("journal.db")))
+    pool = CoredumpWorkerPool(Uploader(), journal=coredump_journal)
+    pool.start()
+    for path in paths:
+        pool.submit(path)
+    pool.queue.join()
+    pool.stop()
+
+    assert [coredump_journal.get_state(path) for path in paths] == [
+        journal.DONE,
+        journal.FAILED,
+        journal.DONE,
+    ]
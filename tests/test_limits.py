@@ -0,0 +1,157 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+import sentry_sdk
+import sentry_sdk.integrations.argv  # noqa: F401, loaded by sentry_sdk.init()
+import sentry_sdk.integrations.modules  # noqa: F401
+
+from coredump_uploader import CoredumpUploader
+from coredump_uploader.limits import ChildLimits
+from coredump_uploader.limits import ChildTimeout
+
+# Prints the start of a backtrace and hangs
+SLOW_GDB = r"""#!%s
+import sys
+import time
+
+if "--version" in sys.argv:
+    sys.exit()
+sys.stdin.read()
+print("Core was generated by `./a.out'.")
+print("Program terminated with signal SIGSEGV, Segmentation fault.")
+print("#0  0x000055931ccfe60a in crashing_function () at test.c:3")
+print("----- coredump-uploader: backtrace -----")
+print("Thread 1 (LWP 3421):")
+print("#0  0x000055931ccfe60a in crashing_function () at test.c:3")
+sys.stdout.flush()
+time.sleep(30)
+"""
+
+# Hangs before it prints anything, e.g. while loading the symbols
+SILENT_GDB = r"""#!%s
+import sys
+import time
+
+if "--version" in sys.argv:
+    sys.exit()
+time.sleep(30)
+"""
+
+
+def test_child_limits():
+    limits = ChildLimits()
+    assert limits.get_arguments(["gdb", "-batch"]) == ["gdb", "-batch"]
+
+    limits = ChildLimits(ionice_class="best-effort", ionice_level=7)
+    assert limits.get_arguments(["gdb"])[1:] == ["-c", "2", "-n", "7", "gdb"]
+    limits = ChildLimits(ionice_class="idle", ionice_level=7)
+    assert limits.get_arguments(["gdb"])[1:] == ["-c", "3", "gdb"]
+
+    limits = ChildLimits(nice=5, max_memory=512 * 1024 * 1024)
+    arguments = limits.get_arguments(["gdb"])
+    assert [os.path.basename(argument) for argument in arguments] == [
+        "nice",
+        "-n",
+        "5",
+        "prlimit",
+        "--as=536870912",
+        "gdb",
+    ]
+    process = limits.popen(
+        [
+            sys.executable,
+            "-c",
+            "import os, resource; "
+            "print(os.nice(0), resource.getrlimit(resource.RLIMIT_AS)[0])",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    output, _ = process.communicate()
+    nice, max_memory = output.split()
+    assert int(nice) >= 5
+    assert int(max_memory) == 512 * 1024 * 1024
+
+
+def test_child_watchdog():
+    limits = ChildLimits(timeout=0.2)
+    process = limits.popen(["sleep", "30"])
+    start = time.time()
+    with limits.watch(process) as watchdog:
+        process.wait()
+    assert watchdog.timed_out
+    assert time.time() - start < 10
+
+    process = limits.popen(["true"])
+    with limits.watch(process) as watchdog:
+        process.wait()
+    assert not watchdog.timed_out
+
+
+@pytest.fixture
+def slow_uploader(tmpdir):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    gdb = tmpdir.join("gdb")
+    gdb.write(SLOW_GDB % sys.executable)
+    gdb.chmod(0o755)
+    return CoredumpUploader(
+        str(executable),
+        None,
+        str(gdb),
+        str(gdb),
+        all_threads=True,
+        child_limits=ChildLimits(timeout=1),
+    )
+
+
+def test_gdb_timeout(slow_uploader, tmpdir):
+    core = tmpdir.join("core")
+    core.write("")
+    parser, registers, gdb_version, message = slow_uploader.read_gdb(str(core))
+    assert parser.timed_out
+    thread_list, exit_signal, stacktrace, crashed_thread_id = parser.get_threads()
+    assert exit_signal == "SIGSEGV"
+    assert [frame.function for frame in stacktrace.frames] == ["crashing_function"]
+    assert registers == []
+
+    with pytest.raises(ChildTimeout) as excinfo:
+        slow_uploader.execute_elfutils(str(core))
+    assert excinfo.value.name == "eu-unstrip"
+
+
+def test_upload_timeout_without_output(tmpdir, monkeypatch):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    gdb = tmpdir.join("gdb")
+    gdb.write(SILENT_GDB % sys.executable)
+    gdb.chmod(0o755)
+    elfutils = tmpdir.join("eu-unstrip")
+    elfutils.write("#!/bin/sh\n")
+    elfutils.chmod(0o755)
+    core = tmpdir.join("core")
+    core.write("")
+    events = []
+
+    def capture_event(event):
+        events.append(event)
+        return event["event_id"]
+
+    monkeypatch.setattr(sentry_sdk, "capture_event", capture_event)
+    uploader = CoredumpUploader(
+        str(executable),
+        None,
+        str(gdb),
+        str(elfutils),
+        all_threads=True,
+        child_limits=ChildLimits(timeout=0.5),
+    )
+
+    uploader.upload(str(core))
+    assert len(events) == 1
+    assert events[0]["tags"] == {"partial": "true"}
+    assert events[0]["extra"]["timed_out"] == ["gdb"]
+    assert events[0]["message"] == {"message": None}
+    assert events[0]["exception"]["value"] is None
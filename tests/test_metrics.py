@@ -0,0 +1,88 @@
+import socket
+
+import pytest
+
+from coredump_uploader import metrics
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_render():
+    metrics.inc("cores_total", result="uploaded")
+    metrics.inc("cores_total", 2, result="uploaded")
+    metrics.inc("subprocess_failures_total", tool="gdb", reason="timeout")
+    metrics.set_gauge("queue_depth", 3)
+    metrics.set_gauge("queue_depth", 1)
+    metrics.observe("stage_seconds", 0.07, stage="gdb")
+    metrics.observe("stage_seconds", 20, stage="gdb")
+    metrics.inc("events_dropped_total", reason='a "quoted"\nreason')
+
+    assert metrics.get("cores_total", result="uploaded") == 3
+    assert metrics.get("queue_depth") == 1
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE coredump_uploader_cores_total counter" in lines
+    assert 'coredump_uploader_cores_total{result="uploaded"} 3' in lines
+    assert (
+        'coredump_uploader_subprocess_failures_total{tool="gdb",reason="timeout"} 1'
+        in lines
+    )
+    assert "coredump_uploader_queue_depth 1" in lines
+    assert 'coredump_uploader_stage_seconds_bucket{stage="gdb",le="0.05"} 0' in lines
+    assert 'coredump_uploader_stage_seconds_bucket{stage="gdb",le="0.1"} 1' in lines
+    assert 'coredump_uploader_stage_seconds_bucket{stage="gdb",le="30"} 2' in lines
+    assert 'coredump_uploader_stage_seconds_bucket{stage="gdb",le="+Inf"} 2' in lines
+    assert 'coredump_uploader_stage_seconds_count{stage="gdb"} 2' in lines
+    assert (
+        'coredump_uploader_events_dropped_total{reason="a \\"quoted\\"\\nreason"} 1'
+        in lines
+    )
+
+
+def test_stage():
+    with pytest.raises(ValueError):
+        with metrics.stage("send"):
+            raise ValueError()
+    histogram = metrics.get("stage_seconds", stage="send")
+    assert histogram.count == 1
+
+
+def test_http_server():
+    metrics.inc("cores_total", result="duplicate")
+    server = metrics.start_http_server(0)
+    try:
+        response = urlopen("http://127.0.0.1:%d/metrics" % server.server_port)
+        body = response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'coredump_uploader_cores_total{result="duplicate"} 1' in body
+
+
+def test_statsd():
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.settimeout(5)
+    try:
+        metrics.configure_statsd("127.0.0.1:%d" % sink.getsockname()[1], "cu")
+        metrics.inc("cores_total", result="sampled")
+        metrics.observe("stage_seconds", 1.5, stage="eu-unstrip")
+        metrics.set_gauge("queue_depth", 4)
+        received = [sink.recv(1024).decode("utf-8") for _ in range(3)]
+    finally:
+        sink.close()
+    assert received == [
+        "cu.cores_total.sampled:1|c",
+        "cu.stage.eu-unstrip:1500|ms",
+        "cu.queue_depth:4|g",
+    ]
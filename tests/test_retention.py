@@ -0,0 +1,142 @@
+import gzip
+import os
+
+import pytest
+
+from coredump_uploader import CoredumpFilter
+from coredump_uploader import CoredumpWorkerPool
+from coredump_uploader import error
+from coredump_uploader import retention
+from coredump_uploader.retention import RetentionManager
+
+
+def make_core(directory, name, size=10, mtime=1000):
+    path = directory.join(name)
+    path.write(b"x" * size, mode="wb")
+    path.setmtime(mtime)
+    return str(path)
+
+
+@pytest.fixture
+def watch_dir(tmpdir):
+    return tmpdir.mkdir("cores")
+
+
+def make_manager(watch_dir, **kwargs):
+    exclude = ()
+    if kwargs.get("policy") == retention.COMPRESS:
+        exclude = (retention.get_exclude("gzip"),)
+    coredump_filter = CoredumpFilter([str(watch_dir)], exclude=exclude)
+    return RetentionManager(coredump_filter, **kwargs)
+
+
+def test_policies(watch_dir, tmpdir):
+    manager = make_manager(watch_dir, policy=retention.DELETE)
+    path = make_core(watch_dir, "core.1")
+    manager.started(path)
+    manager.processed(path)
+    assert not os.path.exists(path)
+
+    # failed coredumps are kept for another try
+    path = make_core(watch_dir, "core.2")
+    manager.processed(path, failed=True)
+    assert os.path.exists(path)
+    os.remove(path)
+
+    manager = make_manager(watch_dir, policy=retention.COMPRESS)
+    path = make_core(watch_dir, "core.3")
+    manager.processed(path)
+    assert os.listdir(str(watch_dir)) == ["core.3.gz"]
+    with gzip.open(path + ".gz") as f:
+        assert f.read() == b"x" * 10
+    assert os.path.getmtime(path + ".gz") == 1000
+    assert not manager.filter.matches(path + ".gz")
+    os.remove(path + ".gz")
+
+    archive_dir = tmpdir.join("archive")
+    with pytest.raises(ValueError):
+        make_manager(watch_dir, policy=retention.MOVE)
+    manager = make_manager(
+        watch_dir, policy=retention.MOVE, archive_dir=str(archive_dir)
+    )
+    make_core(archive_dir, "core.4")
+    path = make_core(watch_dir, "core.4")
+    manager.processed(path)
+    assert os.listdir(str(watch_dir)) == []
+    assert sorted(os.listdir(str(archive_dir))) == ["core.4", "core.4.1"]
+
+
+def test_enforce_budget(watch_dir):
+    manager = make_manager(watch_dir, max_count=2, interval=10)
+    unprocessed = make_core(watch_dir, "core.old", mtime=1000)
+    failed = make_core(watch_dir, "core.failed", mtime=2000)
+    processed = make_core(watch_dir, "core.processed", mtime=3000)
+    duplicate = make_core(watch_dir, "core.duplicate", mtime=4000)
+    make_core(watch_dir, "unrelated", mtime=0)
+    manager.processed(processed)
+    manager.processed(duplicate, duplicate=True)
+    manager.processed(failed, failed=True)
+
+    # duplicates go first, then processed and failed coredumps, oldest first
+    assert manager.enforce(now=100) == [duplicate, processed]
+    manager.max_count = 1
+    assert manager.enforce(now=105) == []
+    assert manager.enforce(now=110) == [failed]
+
+    # coredumps still being processed are skipped
+    manager.max_count = 0
+    manager.started(unprocessed)
+    assert manager.enforce(force=True) == []
+    manager.processed(unprocessed, failed=True)
+    assert manager.enforce(force=True) == [unprocessed]
+    assert os.listdir(str(watch_dir)) == ["unrelated"]
+
+    manager = make_manager(watch_dir, max_total_size=25)
+    paths = [make_core(watch_dir, "core.%d" % i, mtime=i) for i in range(3)]
+    assert manager.enforce() == paths[:1]
+
+
+def test_disk_pressure(watch_dir, monkeypatch):
+    free_space = [50]
+    monkeypatch.setattr(retention, "get_free_space", lambda path: free_space[0])
+    manager = make_manager(watch_dir, policy=retention.KEEP, min_free_space=100)
+
+    old = make_core(watch_dir, "core.old", mtime=1000)
+    path = make_core(watch_dir, "core.new", mtime=2000)
+
+    # processed coredumps are deleted whatever the policy, the oldest ones after
+    original_remove = os.remove
+
+    def remove(path):
+        original_remove(path)
+        free_space[0] += 30
+
+    monkeypatch.setattr(os, "remove", remove)
+    manager.processed(path)
+    assert os.listdir(str(watch_dir)) == []
+    assert not os.path.exists(old)
+
+    free_space[0] = 500
+    path = make_core(watch_dir, "core.kept")
+    manager.processed(path)
+    assert os.path.exists(path)
+
+
+def test_worker_pool_keeps_failed(watch_dir):
+    class Uploader(object):
+        def upload(self, path_to_core):
+            if path_to_core.endswith("failed"):
+                error("Sending the event of %s failed" % path_to_core)
+            # None is a skipped duplicate
+            return None
+
+    manager = make_manager(watch_dir, policy=retention.DELETE)
+    duplicate = make_core(watch_dir, "core.duplicate")
+    failed = make_core(watch_dir, "core.failed")
+    pool = CoredumpWorkerPool(Uploader(), retention=manager)
+    pool.start()
+    pool.submit(duplicate)
+    pool.submit(failed)
+    pool.queue.join()
+    pool.stop()
+    assert os.listdir(str(watch_dir)) == ["core.failed"]
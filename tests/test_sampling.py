@@ -0,0 +1,166 @@
+import os
+
+import pytest
+import sentry_sdk
+import sentry_sdk.integrations.argv  # noqa: F401, loaded by sentry_sdk.init()
+import sentry_sdk.integrations.modules  # noqa: F401
+
+import coredump_uploader
+from coredump_uploader import BacktraceParser
+from coredump_uploader import CoredumpUploader
+from coredump_uploader.sampling import CrashSampler
+from coredump_uploader.sampling import RATE_LIMITED
+from coredump_uploader.sampling import SAMPLED
+from coredump_uploader.sampling import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=0.5, burst=2, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [True, True, False]
+    assert not bucket.take(1)
+    assert bucket.take(2)
+    # tokens don't pile up beyond the burst
+    assert [bucket.take(100) for _ in range(3)] == [True, True, False]
+
+
+def test_rate_limits():
+    sampler = CrashSampler(executable_rate=3, signature_rate=1, report_interval=60)
+    decisions = [sampler.sample("a.out", "sig1", now=0) for _ in range(3)]
+    assert decisions == [True, False, False]
+    # the loop of sig1 left tokens for other crashes of a.out
+    assert sampler.sample("a.out", "sig2", now=0)
+    assert sampler.sample("a.out", None, now=0)
+    assert not sampler.sample("a.out", None, now=0)
+    assert sampler.sample("b.out", None, now=0)
+    assert sampler.sample("a.out", "sig1", now=60)
+
+    assert sampler.pop_skipped(now=30) == []
+    assert sampler.pop_skipped(now=60) == [
+        ("a.out", None, RATE_LIMITED, 1),
+        ("a.out", "sig1", RATE_LIMITED, 2),
+    ]
+    assert sampler.pop_skipped(now=120) == []
+
+
+def test_adaptive_sampling():
+    draws = []
+
+    def random():
+        draws.append(None)
+        return 0.5
+
+    sampler = CrashSampler(sample_target=4, random=random)
+    decisions = [sampler.sample("a.out", "sig", now=0) for _ in range(10)]
+    # sampled with a probability of 4 / crashes within the last hour
+    assert decisions == [True] * 7 + [False] * 3
+    assert len(draws) == 6
+    assert sampler.pop_skipped(force=True) == [("a.out", "sig", SAMPLED, 3)]
+
+    # the rate decays while the signature doesn't crash
+    assert sampler.sample("a.out", "sig", now=36000)
+    assert len(draws) == 6
+
+
+def test_max_keys():
+    sampler = CrashSampler(signature_rate=1, max_keys=2)
+    assert sampler.sample("a.out", "sig1", now=0)
+    assert sampler.sample("a.out", "sig2", now=0)
+    assert sampler.sample("a.out", "sig3", now=0)
+    assert list(sampler.signatures) == ["sig2", "sig3"]
+    assert sampler.sample("a.out", "sig1", now=0)
+
+
+def test_report_skipped(tmpdir, monkeypatch):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    events = []
+    monkeypatch.setattr(sentry_sdk, "capture_event", events.append)
+    uploader = CoredumpUploader(str(executable), None, None, None, False)
+    uploader.sampler = CrashSampler(executable_rate=1)
+    uploader.sampler.sample("a.out", "sig")
+    uploader.sampler.sample("a.out", "sig")
+    uploader.flush_aggregates()
+    assert events == []
+
+    uploader.flush_aggregates(force=True)
+    assert len(events) == 1
+    assert events[0]["level"] == "info"
+    assert events[0]["extra"]["skipped"] == [
+        {
+            "executable": "a.out",
+            "signature": "sig",
+            "reason": "rate_limited",
+            "count": 1,
+        }
+    ]
+
+
+def test_sampled_crashes_leave_no_duplicates(tmpdir, monkeypatch):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    monkeypatch.setattr(sentry_sdk, "capture_event", lambda event: event["event_id"])
+    # The core names are their signatures
+    monkeypatch.setattr(
+        coredump_uploader,
+        "get_core_fingerprint",
+        lambda path_to_core, build_id: os.path.basename(path_to_core)[0],
+    )
+    uploader = CoredumpUploader(
+        str(executable), None, None, None, False, dedup_window=600
+    )
+
+    def read_gdb(path_to_core, path_to_executable):
+        parser = BacktraceParser(False)
+        parser.feed("#0  0x000055931ccfe60a in crashing_function () at test.c:3\n")
+        return parser, [], "", ""
+
+    monkeypatch.setattr(uploader, "read_gdb", read_gdb)
+    monkeypatch.setattr(uploader, "execute_elfutils", lambda *args: "")
+    uploader.sampler = CrashSampler(executable_rate=1)
+
+    cores = []
+    for name in ("x1", "y1", "y2"):
+        cores.append(tmpdir.join(name))
+        cores[-1].write("")
+    assert [uploader.upload(str(core)) is not None for core in cores] == [
+        True,
+        False,
+        False,
+    ]
+    assert uploader.sampler.pop_skipped(force=True) == [
+        (str(executable), "y", RATE_LIMITED, 2)
+    ]
+    assert uploader.duplicates.pop_expired(force=True) == []
+
+
+def test_failed_upload_leaves_no_duplicates(tmpdir, monkeypatch):
+    executable = tmpdir.join("a.out")
+    executable.write("")
+    monkeypatch.setattr(sentry_sdk, "capture_event", lambda event: event["event_id"])
+    monkeypatch.setattr(
+        coredump_uploader,
+        "get_core_fingerprint",
+        lambda path_to_core, build_id: "signature",
+    )
+    uploader = CoredumpUploader(
+        str(executable), None, None, None, False, dedup_window=600
+    )
+    monkeypatch.setattr(uploader, "execute_elfutils", lambda *args: "")
+    core = tmpdir.join("core")
+    core.write("")
+
+    # gdb fails on the first crash of the signature
+    parser = BacktraceParser(False)
+    monkeypatch.setattr(uploader, "read_gdb", lambda *args: (parser, [], "", ""))
+    with pytest.raises(SystemExit):
+        uploader.upload(str(core))
+
+    parser.feed("#0  0x000055931ccfe60a in crashing_function () at test.c:3\n")
+    # sending the event fails
+    monkeypatch.setattr(sentry_sdk, "capture_event", lambda event: None)
+    with pytest.raises(SystemExit):
+        uploader.upload(str(core))
+
+    monkeypatch.setattr(sentry_sdk, "capture_event", lambda event: event["event_id"])
+    assert uploader.upload(str(core)) is not None
+    assert uploader.upload(str(core)) is None
@@ -0,0 +1,85 @@
+import json
+import os
+import pstats
+
+import pytest
+
+from coredump_uploader import metrics, tracing
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    metrics.reset()
+    yield
+    tracing.close()
+    metrics.reset()
+
+
+def test_json_lines(tmpdir):
+    path = str(tmpdir.join("trace.jsonl"))
+    tracing.configure(path)
+    with tracing.trace("/tmp/core"):
+        with metrics.stage("gdb"):
+            with tracing.span("gdb.read") as span:
+                span.args["output_size"] = 42
+        tracing.set_result(event_id="abc")
+    with tracing.span("post", status=200):
+        pass
+    tracing.close()
+
+    with open(path) as f:
+        core_record, post_record = [json.loads(line) for line in f]
+    assert core_record["core"] == "/tmp/core"
+    assert core_record["event_id"] == "abc"
+    assert [span["name"] for span in core_record["spans"]] == ["gdb", "gdb.read"]
+    assert core_record["spans"][1]["output_size"] == 42
+    assert core_record["spans"][0]["duration"] >= core_record["spans"][1]["duration"]
+    # The stage timer is shared with the metrics
+    histogram = metrics.get("stage_seconds", stage="gdb")
+    assert histogram.sum == core_record["spans"][0]["duration"]
+    assert "core" not in post_record
+    assert post_record["spans"][0]["status"] == 200
+
+
+def test_chrome_trace(tmpdir):
+    path = str(tmpdir.join("trace.json"))
+    tracing.configure(path, tracing.CHROME)
+    for _ in range(2):
+        with tracing.trace("/tmp/core"):
+            with tracing.span("parse.threads"):
+                pass
+    tracing.close()
+
+    with open(path) as f:
+        events = json.loads(f.read().rstrip().rstrip(",") + "]")
+    assert [event["ph"] for event in events] == ["M", "X", "X", "X", "X"]
+    assert [event["name"] for event in events[1:3]] == ["core", "parse.threads"]
+    assert events[1]["args"] == {"core": "/tmp/core"}
+    assert events[1]["ts"] <= events[2]["ts"]
+    assert events[1]["dur"] >= events[2]["dur"]
+
+
+def test_profile_python(tmpdir):
+    path = str(tmpdir.join("trace.jsonl"))
+    tracing.configure(path, profile_python=True)
+    with tracing.trace("/tmp/core"):
+        with tracing.span("parse.images", profile=True):
+            sorted(range(1000), key=lambda value: -value)
+        with tracing.span("not profiled"):
+            pass
+    tracing.close()
+
+    with open(path) as f:
+        record = json.loads(f.read())
+    assert os.path.exists(record["profile"])
+    stats = pstats.Stats(record["profile"])
+    assert any(function == "<lambda>" for _, _, function in stats.stats)
+
+
+def test_disabled():
+    with tracing.trace("/tmp/core") as trace:
+        with metrics.stage("file") as span:
+            pass
+    assert trace is None
+    assert span.duration is not None
+    assert metrics.get("stage_seconds", stage="file").count == 1
@@ -0,0 +1,113 @@
+import io
+import os
+
+from coredump_uploader.transport import UploaderTransport
+from coredump_uploader.transport import get_retry_after
+
+DSN = "https://public@sentry.example.com/1"
+
+
+class Response(object):
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+
+class FakeHttp(object):
+    """Returns the given responses in order, None raises a connection error"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def urlopen(self, method, url, body=None, headers=None, **kwargs):
+        if not isinstance(body, bytes):
+            body = body.read()
+        self.bodies.append(body)
+        response = self.responses.pop(0) if self.responses else Response(200)
+        if response is None:
+            raise OSError("connection refused")
+        return response
+
+
+def make_transport(responses, **kwargs):
+    kwargs.setdefault("workers", 0)
+    kwargs.setdefault("backoff", 0)
+    return UploaderTransport({"dsn": DSN}, http=FakeHttp(responses), **kwargs)
+
+
+def test_get_retry_after():
+    assert get_retry_after({}) is None
+    assert get_retry_after({"retry-after": "12"}) == 12
+    assert get_retry_after({"x-sentry-rate-limits": "60::organization"}) == 60
+    limits = "120:transaction:key, 30:error;attachment:project"
+    assert get_retry_after({"x-sentry-rate-limits": limits}) == 30
+    assert get_retry_after({"x-sentry-rate-limits": "120:transaction:key"}) is None
+
+
+def test_send_retries():
+    transport = make_transport([None, Response(503), Response(200)], max_retries=2)
+    assert transport.send(b"envelope")
+    assert transport.http.bodies == [b"envelope"] * 3
+
+    transport = make_transport([None, None], max_retries=1)
+    assert not transport.send(b"envelope")
+
+    # rejected events are not sent again
+    transport = make_transport([Response(400)])
+    assert transport.send(b"envelope")
+    assert len(transport.http.bodies) == 1
+
+
+def test_rate_limit():
+    transport = make_transport(
+        [Response(429, {"retry-after": "0.1"}), Response(200)], max_retries=1
+    )
+    assert transport.send(b"envelope")
+    assert transport.disabled_until > 0
+    assert len(transport.http.bodies) == 2
+
+
+def test_capture_file(tmpdir):
+    transport = make_transport([])
+    transport.capture_file(io.BytesIO(b"with core"))
+    item = transport.queue.get_nowait()
+    transport.process(item)
+    # the body is the envelope, not the path of the file holding it
+    assert transport.http.bodies == [b"with core"]
+    assert not os.path.exists(item.path)
+
+
+def test_spool(tmpdir):
+    spool_dir = str(tmpdir.join("spool"))
+    transport = make_transport([None], max_retries=0, spool_dir=spool_dir)
+    transport.capture_event({"event_id": "ab" * 16})
+    transport.capture_file(io.BytesIO(b"with core"))
+
+    # the network is down while the first one is sent
+    transport.process(transport.queue.get_nowait())
+    transport.kill()
+    assert len(os.listdir(spool_dir)) == 2
+
+    # a new transport sends the spooled envelopes in the order they were spooled
+    transport = make_transport([], spool_dir=spool_dir, workers=1)
+    transport.flush(5)
+    transport.requeue_spooled()
+    transport.flush(5)
+    assert len(transport.http.bodies) == 2
+    assert transport.http.bodies[0] == b"with core"
+    assert os.listdir(spool_dir) == []
+    transport.kill()
+
+
+def test_queue_full(tmpdir):
+    transport = make_transport([], queue_size=1)
+    assert transport.submit(b"first")
+    assert not transport.submit(b"second")
+    assert transport.queue.qsize() == 1
+
+    spool_dir = str(tmpdir.join("spool"))
+    transport = make_transport([], queue_size=1, spool_dir=spool_dir)
+    transport.submit(b"first")
+    transport.submit(b"second")
+    assert len(os.listdir(spool_dir)) == 1